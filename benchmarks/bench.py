@@ -0,0 +1,177 @@
+"""
+Benchmarks of the ahri pipeline on simulated data
+
+Each stage is timed (wall-clock seconds) and its peak Python memory
+(MB, from tracemalloc, which also traces NumPy and pandas buffers but
+not the memory of pool workers) recorded, for each number of
+individuals. The stages are:
+
+    sim        simulate and write the .dta datasets (SimData)
+    proc_bst   DataProc.proc_bst_dta
+    proc_hiv   DataProc.proc_hiv_dta
+    proc_epi   DataProc.proc_epi_dta
+    hiv_data   SetData.hiv_data, read and standardize
+    repeat     DataMethods.get_repeat_testers
+    idat       CalcInc.idat, with the birth year and age of repeat-testers
+    pop_n      CalcInc.pop_n
+    split      cypy.pre_split and cypy.split_data of a midpoint imputation
+    midpoint   CalcInc.inc_midpoint
+    rand_<nsim>_<mcores>   CalcInc.inc_randpoint on the worker pool
+    batch_<nsim>           CalcInc.inc_randpoint with the batched engine
+
+Results are compared to the stored baselines in baselines.json. A stage
+is flagged if it takes more than --tolerance times its baseline (and at
+least --floor seconds longer), and the run exits with status 1.
+
+    $ python benchmarks/bench.py --sizes 1000 10000
+    $ python benchmarks/bench.py --sizes 1000 10000 --update
+    $ python benchmarks/bench.py --sizes 1000000 --nsim 100 --mcores 8
+
+The baselines depend on the machine, so record them with --update on the
+machine the benchmarks run on before comparing.
+
+SimData writes each .dta dataset from memory, which takes about 2 KB per
+individual (0.45 GB at 200k, 2 GB at 1M and 9 GB at 5M individuals), so
+the largest size that can be run is set by the memory of the machine.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from ahri import cypy
+from ahri import calc
+from ahri.args import SetArgs
+from ahri.simdata import SimData
+from ahri.dataproc import DataProc
+from ahri.calc import CalcInc
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "baselines.json")
+
+
+def measure(res, name, fun, memory = True):
+    """Run fun, record its time and peak memory in res[name]"""
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fun()
+    secs = time.perf_counter() - t0
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    res[name] = {"secs": round(secs, 4), "peak_mb": round(peak, 2)}
+    print(f"  {name:<16} {secs:10.3f} s {peak:10.1f} MB", flush = True)
+    return(out)
+
+
+def split_stage(dtest):
+    dat = dtest.idat
+    idat = [dat[0], calc.imp_midpoint(dat[1][:, :6])]
+    pdat = calc.pre_split_idat(idat)
+    return(cypy.split_data(pdat))
+
+
+def run_size(n, nsims, mcores, seed, memory, fmt):
+    res = {}
+    with tempfile.TemporaryDirectory() as tdir:
+        args = SetArgs(root = tdir, verbose = False, seed = seed,
+                file_format = fmt)
+        args.path_hiv_dta("hiv.dta")
+        args.path_epi_dta("epi.dta")
+        args.path_bst_dta("bst.dta")
+        measure(res, "sim",
+                lambda: SimData(args, n = n, seed = seed).write_dta(), memory)
+        dread = DataProc(args)
+        measure(res, "proc_bst", dread.proc_bst_dta, memory)
+        measure(res, "proc_hiv", dread.proc_hiv_dta, memory)
+        measure(res, "proc_epi", dread.proc_epi_dta, memory)
+        dtest = CalcInc(args)
+        hiv = measure(res, "hiv_data", lambda: dtest.hiv_data, memory)
+        measure(res, "repeat", lambda: dtest.get_repeat_testers(hiv), memory)
+        measure(res, "idat", lambda: dtest.idat, memory)
+        measure(res, "pop_n", lambda: dtest.pop_n, memory)
+        measure(res, "split", lambda: split_stage(dtest), memory)
+        measure(res, "midpoint", dtest.inc_midpoint, memory)
+        for nsim in nsims:
+            args.update_nsim(nsim)
+            for mc in mcores:
+                args.mcores = mc
+                measure(res, f"rand_{nsim}_{mc}", dtest.inc_randpoint, memory)
+            dtest.close_pool()
+            measure(res, f"batch_{nsim}",
+                    lambda: dtest.inc_randpoint(batch = True), memory)
+    return(res)
+
+
+def compare(results, baselines, tolerance, floor):
+    slow = []
+    for size, stages in results.items():
+        base = baselines.get("results", {}).get(size, {})
+        for name, val in stages.items():
+            if name not in base:
+                continue
+            old = base[name]["secs"]
+            if val["secs"] > old * tolerance and val["secs"] - old > floor:
+                slow.append(f"{size} {name}: {val['secs']:.3f} s, "
+                    f"baseline {old:.3f} s")
+    return(slow)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[1],
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+",
+            default = [1000, 10000], help = "numbers of individuals")
+    parser.add_argument("--nsim", type = int, nargs = "+", default = [10],
+            help = "numbers of imputations")
+    parser.add_argument("--mcores", type = int, nargs = "+", default = [1, 2],
+            help = "numbers of pool workers")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--format", default = "pkl", choices = ["pkl", "col"],
+            help = "file format of the processed datasets")
+    parser.add_argument("--no-memory", action = "store_true",
+            help = "do not trace memory, which slows down the stages")
+    parser.add_argument("--tolerance", type = float, default = 1.5)
+    parser.add_argument("--floor", type = float, default = 0.05,
+            help = "ignore slow-downs of less than this many seconds")
+    parser.add_argument("--update", action = "store_true",
+            help = "store the results as the new baselines")
+    parser.add_argument("--out", help = "write the results to this file")
+    opts = parser.parse_args(argv)
+
+    results = {}
+    for n in opts.sizes:
+        print(f"{n} individuals", flush = True)
+        results[str(n)] = run_size(n, opts.nsim, opts.mcores, opts.seed,
+                not opts.no_memory, opts.format)
+    run = {"machine": platform.platform(), "python": platform.python_version(),
+            "options": vars(opts), "results": results}
+    if opts.out:
+        with open(opts.out, "w") as f:
+            json.dump(run, f, indent = 2)
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    if opts.update:
+        baselines.setdefault("results", {}).update(results)
+        baselines["machine"] = run["machine"]
+        baselines["python"] = run["python"]
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent = 2)
+        print(f"Baselines saved to {BASELINES}")
+        return(0)
+    slow = compare(results, baselines, opts.tolerance, opts.floor)
+    for line in slow:
+        print(f"slower than baseline: {line}")
+    return(1 if slow else 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
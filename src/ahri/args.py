@@ -19,6 +19,9 @@ class SetFiles:
     wgh_pkl : name of women's .pkl general health dataset
     mgh_pkl : name of men's .pkl general health dataset
     bst_pkl : name of bounded structures .pkl dataset
+    hiv_col : name of hiv column cache folder
+    epi_col : name of surviellance column cache folder
+    bst_col : name of bounded structures column cache folder
 
     Methods
     -------
@@ -33,8 +36,12 @@ class SetFiles:
     path_wgh_pkl : str : change path name of women's .pkl general health dataset
     path_mgh_pkl : str : change path name of men's .pkl general health dataset
     path_bst_pkl : str : change path name of bounded structurs .pkl dataset
+    path_hiv_col : str : change path name of hiv column cache
+    path_epi_col : str : change path name of surveillance column cache
+    path_bst_col : str : change path name of bounded structures column cache
     show_dta_paths : Show the dta file names
     show_pkl_paths : Show the pkl file names
+    show_col_paths : Show the column cache folder names
     """
 
     def setpath(self, x): 
@@ -63,6 +70,9 @@ class SetFiles:
         self.wgh_pkl = self.setpath("ACDIS_WGH_ALL.pkl") 
         self.mgh_pkl = self.setpath("ACDIS_MGH_ALL.pkl") 
         self.bst_pkl = self.setpath("ACDIS_BoundedStructures.pkl")
+        self.hiv_col = self.setpath("ACDIS_HIV_All.col") 
+        self.epi_col = self.setpath("SurveillanceEpisodes.col")
+        self.bst_col = self.setpath("ACDIS_BoundedStructures.col")
 
     def path_hiv_dta(self, file = "RD05-99 ACDIS HIV All.dta"):
         """
@@ -154,6 +164,33 @@ class SetFiles:
         self.bst_pkl = self.setpath(file)
         return self.bst_pkl
 
+    def path_hiv_col(self, file = "ACDIS_HIV_All.col"):
+        """
+        Parameters 
+        ---------
+        file : str : change path name of HIV column cache folder
+        """
+        self.hiv_col = self.setpath(file)
+        return self.hiv_col
+
+    def path_epi_col(self, file = "SurveillanceEpisodes.col"):
+        """
+        Parameters 
+        ---------
+        file : str : change path name of surviellance column cache folder
+        """
+        self.epi_col = self.setpath(file)
+        return self.epi_col
+
+    def path_bst_col(self, file = "ACDIS_BoundedStructures.col"):
+        """
+        Parameters 
+        ---------
+        file : str : change path name of Bounded Structures column cache folder
+        """
+        self.bst_col = self.setpath(file)
+        return self.bst_col
+
     def show_dta_paths(self): 
         """
         Print out the file paths to the ahri .dta datasets
@@ -170,6 +207,13 @@ class SetFiles:
         print(self.hiv_pkl, self.epi_pkl, self.bst_pkl,
                 self.mgh_pkl, self.wgh_pkl, sep = "\n")
 
+    def show_col_paths(self): 
+        """
+        Print out the folder paths to the ahri column caches
+        """
+
+        print(self.hiv_col, self.epi_col, self.bst_col, sep = "\n")
+
 
 class SetArgs(SetFiles):
     """
@@ -193,6 +237,12 @@ class SetArgs(SetFiles):
         number of imputations for the HIV seroconversion dates
     drop_tasp : bool 
         drop observations from the Northern (TasP) areas
+    area : list 
+        keep only the IsUrbanOrRural areas listed, None keeps all areas
+    drop_bsid : list 
+        BSIntIDs to drop
+    profiler : object 
+        an instrument.Profiler that times the pipeline stages, or None
     impute_method: str 
         type of imputation: random-point or midpoint
     mcores : int 
@@ -200,6 +250,14 @@ class SetArgs(SetFiles):
         uses the multiprocessing library to select cores
     verbose : bool 
         show the progress bar
+    seed : int 
+        master seed for the imputations, None draws fresh entropy
+    file_format : str 
+        format of the processed datasets: "pkl" or "col" (column cache)
+    cache_dir : str 
+        folder for the cache of derived datasets, None turns it off
+    cache_hash : bool 
+        also hash the contents of the input files for the cache key
     """
 
     def __init__(self, root, 
@@ -208,7 +266,8 @@ class SetArgs(SetFiles):
         ageby = 5,
         drop_tasp = True, verbose = False,
         nsim = 1, imp_method = None,
-        mcores = mp.cpu_count()):
+        mcores = mp.cpu_count(), seed = None, file_format = "pkl",
+        cache_dir = None, area = None, drop_bsid = None, profiler = None):
         """Parameters
         -------------
         paths : object  
@@ -231,6 +290,27 @@ class SetArgs(SetFiles):
         mcores : int 
             number of cores to use for incidence rate estimation, 
             uses the multiprocessing library to select cores
+        seed : int 
+            master seed from which each imputation gets its own random 
+            stream. Default is None, which draws fresh entropy per run.
+        file_format : str 
+            format of the processed datasets, either "pkl" for pickle files
+            or "col" for column caches with one .npy file per column, which
+            can be read column by column and memory-mapped. 
+        cache_dir : str 
+            folder to keep the repeat-tester, imputation and population 
+            datasets in, keyed on the input files and the arguments that
+            change them. Default is None, which turns the cache off.
+        area : list 
+            keep only observations from these IsUrbanOrRural areas of 
+            the Bounded Structures dataset, e.g. ["Rural"]. Observations
+            with an unknown area are kept. Default is None, which keeps 
+            all areas.
+        drop_bsid : list 
+            drop observations from these BSIntIDs. Default is None.
+        profiler : object 
+            an instrument.Profiler that records the time, rows and memory
+            of each stage of the pipeline. Default is None.
 
         """
         super().__init__(root)
@@ -245,6 +325,13 @@ class SetArgs(SetFiles):
         self.mcores = mcores
         self.verbose = verbose
         self.drop_tasp = drop_tasp
+        self.area = area
+        self.drop_bsid = drop_bsid
+        self.profiler = profiler
+        self.seed = seed
+        self.file_format = self.update_file_format(file_format)
+        self.cache_dir = cache_dir
+        self.cache_hash = False
         self.agecat = self.update_age_cat()
         self.sex = self.update_sex()
 
@@ -317,6 +404,39 @@ class SetArgs(SetFiles):
         self.drop_tasp = drop
         return self.drop_tasp
 
+    def update_area(self, area):
+        """
+        Update the IsUrbanOrRural areas to keep, None keeps all areas
+
+        Parameters
+        ----------
+        area : list
+        """
+        self.area = area
+        return self.area
+
+    def update_drop_bsid(self, bsid):
+        """
+        Update the BSIntIDs to drop, None drops none
+
+        Parameters
+        ----------
+        bsid : list
+        """
+        self.drop_bsid = bsid
+        return self.drop_bsid
+
+    def update_profiler(self, profiler):
+        """
+        Update the Profiler of the pipeline stages, None turns it off
+
+        Parameters
+        ----------
+        profiler : object
+        """
+        self.profiler = profiler
+        return self.profiler
+
     def update_nsim(self, nsim):
         """
         Update value for number of imputations 
@@ -327,3 +447,43 @@ class SetArgs(SetFiles):
         """
         self.nsim = nsim
         return self.nsim
+
+    def update_seed(self, seed):
+        """
+        Update the master seed for the imputations
+
+        Parameters
+        ----------
+        seed : int
+        """
+        self.seed = seed
+        return self.seed
+
+    def update_file_format(self, file_format):
+        """
+        Update the format of the processed datasets
+
+        Parameters
+        ----------
+        file_format : str : "pkl" or "col"
+        """
+        if file_format not in ["pkl", "col"]:
+            raise ValueError(f"ahri: file_format must be 'pkl' or 'col', "
+                    f"not {file_format}")
+        self.file_format = file_format
+        return self.file_format
+
+    def update_cache_dir(self, cache_dir, hash_files = False):
+        """
+        Update the folder for the cache of derived datasets
+
+        Parameters
+        ----------
+        cache_dir : str : None turns the cache off
+        hash_files : bool : 
+            key the cache on a hash of the input file contents, not only
+            their size and modification time
+        """
+        self.cache_dir = cache_dir
+        self.cache_hash = hash_files
+        return self.cache_dir
@@ -1,8 +1,13 @@
 from datetime import datetime
-from ahri.dataproc import SetData
+from ahri.dataproc import SetData, date_origin, id_lookup
+from ahri.instrument import Profiler, stage
 from ahri import cypy
 import multiprocessing as mp
+import weakref
+from multiprocessing import shared_memory
+from functools import partial
 from scipy.stats import t
+from scipy import sparse
 import numpy as np
 import pandas as pd
 import sys
@@ -29,27 +34,189 @@ def prep_for_imp(dat, origin = datetime(2000, 1, 1)):
     dat1 = dat[~np.isnan(dat[:, 3]), :]
     return([dat0, dat1])
 
-def imp_random(dat1):
+def imp_rng(entropy, i):
+    """Random generator for imputation i, derived from the master entropy"""
+    return(np.random.default_rng(
+        np.random.SeedSequence(entropy, spawn_key = (i,))))
+
+def imp_random(dat1, rng = None):
     """Impute random dates in censored interval"""
-    idates = np.random.randint(dat1[:, 2] + 1,  dat1[:, 3])
+    if rng is None:
+        idates = np.random.randint(dat1[:, 2] + 1,  dat1[:, 3])
+    else:
+        idates = rng.integers(dat1[:, 2] + 1,  dat1[:, 3])
     return(np.c_[dat1, idates])
 
+def imp_random_batch(dat1, nsim, entropy = None, start = 0):
+    """Impute nsim random dates in censored interval, one row per imputation
+
+    If entropy is given, row k uses the stream of imputation start + k
+    """
+    if entropy is None:
+        idates = np.random.randint(dat1[:, 2] + 1,  dat1[:, 3], 
+                size = (nsim, dat1.shape[0]))
+    else:
+        idates = np.array([imp_rng(entropy, i).integers(
+            dat1[:, 2] + 1,  dat1[:, 3]) 
+            for i in range(start, start + nsim)]).reshape(nsim, len(dat1))
+    return(idates)
+
 def imp_midpoint(dat1):
     """Impute mid-point dates in censored interval"""
     idates = np.floor((dat1[:, 2] +  dat1[:, 3]) / 2)
     return(np.c_[dat1, idates])
 
+def age_lut(agecat):
+    """Lookup table from single-year age to the index of the age category"""
+    amin = int(np.floor(agecat[0]))
+    ages = np.arange(amin, int(np.ceil(agecat[-1])))
+    # intervals are closed on the left, as in calc_age_cat
+    lut = np.searchsorted(agecat, ages, side = "right") - 1
+    lut[ages >= agecat[-1]] = -1
+    return(lut.astype(np.intc), amin)
+
+def agg_cells(pdat, agecat):
+    """Sum events and person-days by year and age category"""
+    lut, amin = age_lut(agecat)
+    year0 = int(np.min(pdat[:, 2]))
+    nyear = int(np.max(pdat[:, 3])) - year0 + 1
+    events, days, seen = cypy.agg_split(pdat, lut, amin, 
+            year0, nyear, len(agecat) - 1)
+    seen = seen[0].astype(bool)
+    years = np.arange(year0, year0 + nyear, dtype = np.intc)[seen]
+    return(years, events[0, seen], days[0, seen])
+
+def pre_split_idat(dat):
+    """Pre-split imputation data, the imputed date is in column 6"""
+    ndat0 = dat[0][:, [0, 1, 2,  4, 5]]
+    # replace early_pos with imp date at 6
+    ndat1 = dat[1][:, [0, 1, 6,  4, 5]]
+    ndat = np.concatenate([ndat0, ndat1],
+            dtype = np.intc, casting = 'unsafe')
+    return(cypy.pre_split(ndat))
+
+def period_breaks(year0, year1, per_year = 1):
+    """Starts of the calendar periods from year0 to the end of year1, as
+    days since date_origin, with per_year periods a year: 1 for years,
+    2 for half-years, 4 for quarters or 12 for months"""
+    if per_year < 1 or 12 % per_year != 0:
+        raise ValueError("ahri: per_year must be 1, 2, 3, 4, 6 or 12")
+    months = np.arange((year0 - 1970) * 12, (year1 - 1969) * 12 + 1,
+            12 // per_year).astype("datetime64[M]")
+    origin = np.datetime64(date_origin.date(), "D")
+    return((months.astype("datetime64[D]") - origin).astype(np.intc))
+
+def birthdays(dob, ages):
+    """The birthdays at each of ages (in years, with months as 
+    fractions), one row per date of birth, as days since date_origin. 
+    dob is in days since date_origin. Birthdays of 29 February fall on
+    1 March in other years."""
+    origin = np.datetime64(date_origin.date(), "D")
+    dob = origin + np.asarray(dob, dtype = np.int64).astype("timedelta64[D]")
+    month = dob.astype("datetime64[M]")
+    mday = dob - month.astype("datetime64[D]")
+    step = np.rint(12 * np.asarray(ages, dtype = np.float64)).astype(np.int64)
+    res = (month[:, None] + step[None, :].astype("timedelta64[M]")).astype(
+            "datetime64[D]") + mday[:, None]
+    return((res - origin).astype(np.intc))
+
+def pop_array(pop_n):
+    """Year and N columns of the population data as a float array"""
+    return(pop_n.iloc[:, [0, 2]].to_numpy(dtype = np.float64))
+
+def year_cells(years, year, values, ncat):
+    """Values of rows in year, age category order as a year by age 
+    category array, for each of years
+    
+    year is the year of each row, with ncat rows per year
+    """
+    order = np.argsort(year, kind = "stable")
+    ryears, counts = np.unique(year, return_counts = True)
+    if np.any(counts != ncat):
+        raise ValueError("ahri: need one row per year and age category")
+    tab = np.asarray(values)[order].reshape(len(ryears), ncat)
+    idx = np.searchsorted(ryears, years)
+    found = idx < len(ryears)
+    found[found] = ryears[idx[found]] == years[found]
+    if not np.all(found):
+        raise ValueError(f"ahri: no rows for years {years[~found]}")
+    return(np.ascontiguousarray(tab[idx]))
+
+def calc_gamma_cells(years, events, days, pop_dat, seen = None):
+    """Age-adjusted rates from year by age category cells
+
+    events and days are year by age category arrays, or have a leading
+    imputation dimension, in which case the estimates of the years in the
+    seen (imputation, year) mask are stacked by imputation. pop_dat is the
+    Year, N array from pop_array
+    """
+    if events.ndim == 2:
+        events = events[np.newaxis]; days = days[np.newaxis]
+    if seen is None:
+        seen = np.ones(events.shape[:2], dtype = bool)
+    pyears = (days / 365).astype(np.intc)
+    # years not seen in any imputation need no population counts
+    anyseen = seen.any(axis = 0)
+    stpop = np.zeros((len(years), events.shape[2]))
+    stpop[anyseen] = year_cells(years[anyseen], pop_dat[:, 0], 
+            pop_dat[:, 1], events.shape[2])
+    out = cypy.age_adjust_all(np.ascontiguousarray(events, dtype = np.intc),
+        pyears, stpop)
+    k, y = np.nonzero(seen)
+    return(np.c_[years[y], out[k, y]])
+
+def calc_gamma_strata(years, events, days, stpop, seen):
+    """Age-adjusted rates from imputation by stratum by year by age
+    category cells
+
+    stpop is the stratum by year by age category population from
+    get_pop_cells, and seen the (imputation, stratum, year) mask. The
+    estimates are stacked by imputation, with the Year and stratum code
+    before the rate and variance. The strata and years are flattened to
+    one axis so all cells go through the age_adjust_all kernel at once.
+    """
+    nimp, nstrata, nyear, ncat = events.shape
+    pyears = (days / 365).astype(np.intc).reshape(nimp, -1, ncat)
+    if np.any(seen.any(axis = 0) & (stpop.sum(axis = 2) == 0)):
+        raise ValueError("ahri: no population for a stratum and year "
+            "with repeat-testers")
+    out = cypy.age_adjust_all(np.ascontiguousarray(
+        events.reshape(nimp, -1, ncat), dtype = np.intc), pyears,
+        np.ascontiguousarray(stpop.reshape(-1, ncat), dtype = np.float64))
+    k, s, y = np.nonzero(seen)
+    return(np.c_[years[y], s, out[k, s * nyear + y]])
+
+def rand_gamma(dat, agecat, pop_dat, rng = None, prof = None):
+    """Gamma estimates for one random-point imputation
+
+    prof is a Profiler that times the stages, or None
+    """
+    with stage(prof, "impute", len(dat[1])):
+        # drop any imputed date left in column 6 by an earlier run
+        idat = [dat[0], imp_random(dat[1][:, :6], rng)]
+    with stage(prof, "pre_split", len(idat[0]) + len(idat[1])) as rec:
+        pdat = pre_split_idat(idat)
+        rec["rows_out"] = len(pdat)
+    with stage(prof, "split", len(pdat)) as rec:
+        years, events, days = agg_cells(pdat, agecat)
+        rec["rows_out"] = events.size
+    with stage(prof, "calc_gamma", events.size) as rec:
+        res = calc_gamma_cells(years, events, days, pop_dat)
+        rec["rows_out"] = len(res)
+    return(res)
 
 def calc_gamma(dat, pop_dat):
+    """Age-adjusted rates from the Year, AgeCat, Events, PYears frame of 
+    agg_data, with all years in one call to the age_adjust_all kernel"""
     years = np.unique(dat.Year.values)
+    ncat = len(dat) // max(len(years), 1)
     dat = dat.iloc[:, [0, 2, 3]].to_numpy(dtype = np.intc)
     pop_dat = pop_dat.iloc[:, [0, 2]].to_numpy(dtype = np.float64)
-    out = [cypy.age_adjust(
-        dat[dat[:, 0] == year, 1],
-        dat[dat[:, 0] == year, 2],
-        pop_dat[pop_dat[:, 0] == year, 1])
-            for year in years]
-    out = np.c_[years, out]
+    count = year_cells(years, dat[:, 0], dat[:, 1], ncat)
+    pop = year_cells(years, dat[:, 0], dat[:, 2], ncat)
+    stpop = year_cells(years, pop_dat[:, 0], pop_dat[:, 1], ncat)
+    out = cypy.age_adjust_all(count[np.newaxis], pop[np.newaxis], stpop)
+    out = np.c_[years, out[0]]
     return(out)
 
 
@@ -77,73 +244,1066 @@ def calc_rubin(rates, variances, year = 0):
     res = [year, cbar, se, lci, uci]
     return(res)
 
-def est_combine(est):
-    sp_est = [est[est[:, 0] == k] 
-            for k in np.unique(est[:, 0])]
-    res = [calc_rubin(x[:, 1], x[:, 2], x[0, 0]) 
-            for x in sp_est]
-    out = pd.DataFrame(res, 
-            columns = ["Year", "Rate",  "SE", "LCI", "UCI"])
-    out["Year"] = out["Year"].astype(int)
+def est_combine(est, keys = ("Year",)):
+    """Combine the imputation estimates with Rubin's rules, as calc_rubin
+    does, for all years and strata in one pass
+
+    est has the key columns (Year, then any strata) followed by the rate
+    and variance of each imputation
+    """
+    nkey = len(keys)
+    ukeys, inv, m = np.unique(est[:, :nkey], axis = 0, 
+            return_inverse = True, return_counts = True)
+    inv = inv.ravel()
+    rates = est[:, nkey]
+    # mean est and var within
+    cbar = np.bincount(inv, rates) / m
+    vbar = np.bincount(inv, est[:, nkey + 1]) / m
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        # var between, 0 with a single imputation
+        evar = np.bincount(inv, (rates - cbar[inv])**2) / np.maximum(m - 1, 1)
+        variances = vbar + evar * (m + 1) / m
+        r = (1 + 1/m) * evar/vbar
+        ok = (m > 1) & (r > 0)
+        df = np.where(ok, (m - 1) * (1 + 1/np.where(ok, r, 1))**2, 1.96)
+    variances = np.where(m > 1, variances, vbar)
+    se = np.sqrt(variances)
+    # Calc 95\% CI
+    crit = t.ppf(1 - 0.05/2, df)
+    out = pd.DataFrame(ukeys, columns = list(keys)).astype(int)
+    out = out.assign(Rate = cbar, SE = se, LCI = cbar - crit * se, 
+            UCI = cbar + crit * se)
+    return(out)
+
+def merge_shards(paths):
+    """Combine imputation shards written by CalcInc.inc_shard"""
+    shards = []
+    for path in paths:
+        with np.load(path) as f:
+            shards.append(dict(f))
+    shards = sorted(shards, key = lambda x: int(x["start"]))
+    if len(set(int(x["seed"]) for x in shards)) > 1:
+        raise ValueError("ahri: shards were run with different seeds")
+    for left, right in zip(shards[:-1], shards[1:]):
+        if int(left["stop"]) != int(right["start"]):
+            raise ValueError(f"ahri: shards do not cover imputations "
+                f"{int(left['stop'])} to {int(right['start'])} exactly")
+    res = est_combine(np.vstack([x["est"] for x in shards]))
+    return(res)
+
+
+def boot_rng(entropy, b):
+    """Random generator for bootstrap replicate b, derived from the master
+    entropy. The second key word keeps it apart from the imp_rng streams"""
+    return(np.random.default_rng(
+        np.random.SeedSequence(entropy, spawn_key = (b, 1))))
+
+def boot_weights(ncl, entropy, start, stop, method = "poisson"):
+    """Bootstrap weights of ncl clusters for replicates start to stop - 1,
+    one row per replicate
+
+    method is "poisson" for Poisson(1) counts, or "multinomial" for the
+    counts of a resample of ncl clusters with replacement
+    """
+    w = np.empty((stop - start, ncl), dtype = np.uint8)
+    for k, b in enumerate(range(start, stop)):
+        rng = boot_rng(entropy, b)
+        if method == "poisson":
+            x = rng.poisson(1.0, ncl)
+        elif method == "multinomial":
+            x = rng.multinomial(ncl, np.full(ncl, 1 / max(ncl, 1)))
+        else:
+            raise ValueError(f"ahri: unknown bootstrap method {method}")
+        # counts above 255 have a negligible chance for Poisson(1) weights
+        w[k] = np.minimum(x, 255)
+    return(w)
+
+def contrib_cells(ndat, lut, amin, year0, nyear, ncat):
+    """Events and person-days of each row of ndat (IIntID, start, end, 
+    event, Age) in the year by age category cells, as row by cell sparse 
+    matrices, and the years with episodes"""
+    pdat = cypy.pre_split(ndat)
+    sdat = cypy.split_data(pdat)
+    row = np.repeat(np.arange(len(pdat)), pdat[:, 3] - pdat[:, 2] + 1)
+    seen = np.zeros(nyear, dtype = bool)
+    seen[sdat[:, 0] - year0] = True
+    a = sdat[:, 3] - amin
+    ok = (a >= 0) & (a < len(lut))
+    cat = np.where(ok, lut[a.clip(0, len(lut) - 1)], -1)
+    ok &= cat >= 0
+    cell = (sdat[ok, 0] - year0) * ncat + cat[ok]
+    shape = (len(pdat), nyear * ncat)
+    events = sparse.csr_matrix((sdat[ok, 2].astype(np.float64), 
+        (row[ok], cell)), shape = shape)
+    days = sparse.csr_matrix((sdat[ok, 1].astype(np.float64), 
+        (row[ok], cell)), shape = shape)
+    return(events, days, seen)
+
+def boot_range(dat, agecat, pop_dat, cluster, entropy, start, stop, nsim,
+        method = "poisson", midpoint = False, chunk = None):
+    """Age-adjusted rates of bootstrap replicates start to stop - 1, summed
+    over the imputations
+
+    Each replicate weights the events and person-days of the individuals,
+    the rows of dat[0] then dat[1], by the weight of their cluster, so no 
+    data are copied. The weighted sums of the non-seroconverters are the 
+    same in every imputation and are computed once. Imputation i imputes 
+    the dates of inc_randpoint, or the mid-points with midpoint. Returns 
+    the years, the (replicate, year) sums of the rates and the number of 
+    imputations in which each year has episodes.
+    """
+    dat0, dat1 = dat
+    lut, amin = age_lut(agecat)
+    ncat = len(agecat) - 1
+    ndat0 = np.array(dat0[:, [0, 1, 2, 4, 5]], dtype = np.intc)
+    # early_pos bounds the imputed dates, so it bounds the years too
+    ndat1 = np.array(dat1[:, [0, 1, 3, 4, 5]], dtype = np.intc)
+    pdat = cypy.pre_split(np.concatenate([ndat0, ndat1]))
+    year0 = int(np.min(pdat[:, 2]))
+    nyear = int(np.max(pdat[:, 3])) - year0 + 1
+    years = np.arange(year0, year0 + nyear, dtype = np.intc)
+    have = np.isin(years, pop_dat[:, 0])
+    stpop = np.zeros((nyear, ncat))
+    stpop[have] = year_cells(years[have], pop_dat[:, 0], pop_dat[:, 1], 
+            ncat)
+    nboot, n0 = stop - start, len(dat0)
+    ncl = int(cluster.max()) + 1 if len(cluster) else 0
+    if chunk is None:
+        # keep the dense weights of a chunk to about 32 MB
+        chunk = max(1, min(nboot, 2**22 // max(len(cluster), 1)))
+    ev0, dy0, seen0 = contrib_cells(ndat0, lut, amin, year0, nyear, ncat)
+    tev0 = np.empty((nboot, nyear * ncat))
+    tdy0 = np.empty((nboot, nyear * ncat))
+    w1 = np.empty((nboot, len(dat1)), dtype = np.uint8)
+    for j in range(0, nboot, chunk):
+        wc = boot_weights(ncl, entropy, start + j, 
+                start + min(j + chunk, nboot), method)
+        w0 = wc[:, cluster[:n0]].astype(np.float64)
+        tev0[j:j + chunk] = (ev0.T @ w0.T).T
+        tdy0[j:j + chunk] = (dy0.T @ w0.T).T
+        w1[j:j + chunk] = wc[:, cluster[n0:]]
+    sums = np.zeros((nboot, nyear))
+    nseen = np.zeros(nyear, dtype = np.int64)
+    for i in range(1 if midpoint else nsim):
+        ndat = ndat1.copy()
+        if midpoint:
+            ndat[:, 2] = np.floor((dat1[:, 2] + dat1[:, 3]) / 2)
+        else:
+            ndat[:, 2] = imp_rng(entropy, i).integers(dat1[:, 2] + 1, 
+                    dat1[:, 3])
+        ev1, dy1, seen1 = contrib_cells(ndat, lut, amin, year0, nyear, 
+                ncat)
+        seen = seen0 | seen1
+        if np.any(seen & ~have):
+            raise ValueError(f"ahri: no rows for years {years[seen & ~have]}")
+        for j in range(0, nboot, chunk):
+            wj = w1[j:j + chunk].astype(np.float64)
+            ev = tev0[j:j + chunk] + (ev1.T @ wj.T).T
+            dy = tdy0[j:j + chunk] + (dy1.T @ wj.T).T
+            shape = (len(wj), nyear, ncat)
+            out = cypy.age_adjust_all(
+                np.rint(ev).astype(np.intc).reshape(shape),
+                (np.rint(dy) / 365).astype(np.intc).reshape(shape), stpop)
+            sums[j:j + chunk] += out[:, :, 0] * seen
+        nseen += seen
+    return(years, sums, nseen)
+
+def boot_combine(years, sums, nseen, point):
+    """Bootstrap SE and percentile CIs of the rates averaged over the 
+    imputations, with the Rate of the point estimates from est_combine"""
+    keep = nseen > 0
+    rates = sums[:, keep] / nseen[keep]
+    out = pd.DataFrame({"Year": years[keep].astype(int),
+        "SE": rates.std(axis = 0, ddof = 1) if len(rates) > 1 else 
+            np.full(keep.sum(), np.nan),
+        "LCI": np.percentile(rates, 2.5, axis = 0),
+        "UCI": np.percentile(rates, 97.5, axis = 0)})
+    out = point[["Year", "Rate"]].merge(out, on = "Year", how = "left")
     return(out)
 
+def share_array(x):
+    """Copy an array into a new shared memory block"""
+    shm = shared_memory.SharedMemory(create = True, size = max(x.nbytes, 1))
+    np.ndarray(x.shape, dtype = x.dtype, buffer = shm.buf)[:] = x
+    return(shm)
+
+def _release_pool(pool, blocks):
+    """Stop the workers of a pool and free its shared memory blocks"""
+    pool.close(); pool.join()
+    for shm in blocks:
+        shm.close(); shm.unlink()
+
+# per-process state of the ImpPool workers, set by _init_worker
+_worker = {}
+
+def _init_worker(specs, agecat, verbose):
+    """Attach a worker process to the shared imputation data"""
+    _worker["shm"] = [shared_memory.SharedMemory(name = name) 
+            for name, shape, dtype in specs]
+    arrs = [np.ndarray(shape, dtype = dtype, buffer = shm.buf) 
+            for shm, (name, shape, dtype) in zip(_worker["shm"], specs)]
+    _worker["idat"] = arrs[:2]
+    _worker["pop"] = arrs[2]
+    _worker["agecat"] = agecat
+    _worker["verbose"] = verbose
+
+def _rand_imp(i, nsim, entropy, profile = False):
+    """Run one random-point imputation in an ImpPool worker
+
+    With profile, also return the stage records of the imputation
+    """
+    if _worker["verbose"]:
+        timer(i, nsim)
+    prof = Profiler() if profile else None
+    res = rand_gamma(_worker["idat"], _worker["agecat"], _worker["pop"],
+        imp_rng(entropy, i), prof)
+    if not profile:
+        return(res)
+    for rec in prof.records:
+        rec["imp"] = i
+    return(res, prof.records)
+
+
+def _boot_range(span, nsim, entropy, cluster, method, midpoint):
+    """Run bootstrap replicates span[0] to span[1] - 1 in an ImpPool 
+    worker"""
+    return(boot_range(_worker["idat"], _worker["agecat"], _worker["pop"],
+        cluster, entropy, span[0], span[1], nsim, method, midpoint))
+
+
+class ImpPool:
+    """
+    A process pool for random-point imputation. The imputation data and
+    the population counts are copied once into shared memory, which each
+    worker attaches to when it starts, so tasks only carry an imputation
+    index. The pool can be reused by repeated calls to map. The workers
+    and the shared memory are released by close, or when the pool is 
+    garbage collected.
+
+    Methods
+    -------
+    map(self, nsim, entropy, start = 0, prof = None)
+        run imputations start to start + nsim - 1 and return the stacked 
+        gamma estimates
+    boot(self, nboot, nsim, entropy, cluster, method, midpoint)
+        run bootstrap replicates 0 to nboot - 1, split among the workers
+    matches(self, idat, pop_n, agecat, mcores)
+        check if the pool was started for these data and arguments
+    update_pop(self, pop_n)
+        write new population counts to the shared block
+    close(self)
+        stop the workers and free the shared memory
+    """
+
+    def __init__(self, idat, pop_n, agecat, mcores, verbose = False):
+        self.src = [idat[0], idat[1]]
+        self.agecat = np.array(agecat)
+        self.mcores = mcores
+        arrs = [np.ascontiguousarray(idat[0]), 
+                np.ascontiguousarray(idat[1][:, :6]), pop_array(pop_n)]
+        self.blocks = [share_array(x) for x in arrs]
+        specs = [(shm.name, x.shape, x.dtype.str) 
+                for shm, x in zip(self.blocks, arrs)]
+        self.pop = np.ndarray(arrs[2].shape, dtype = arrs[2].dtype,
+                buffer = self.blocks[2].buf)
+        self.pool = mp.Pool(mcores, initializer = _init_worker,
+                initargs = (specs, self.agecat, verbose))
+        self._finalizer = weakref.finalize(self, _release_pool, self.pool,
+                self.blocks)
+
+    def matches(self, idat, pop_n, agecat, mcores):
+        return(self.src[0] is idat[0] and self.src[1] is idat[1] and
+            self.pop.shape[0] == len(pop_n) and self.mcores == mcores and
+            np.array_equal(self.agecat, agecat))
+
+    def update_pop(self, pop_n):
+        self.pop[:] = pop_array(pop_n)
+
+    def map(self, nsim, entropy, start = 0, prof = None):
+        """With a Profiler that has workers set, the stage records of each
+        imputation are timed in the workers and added to prof"""
+        profile = prof is not None and prof.workers
+        chunksize = max(1, nsim // (self.mcores * 4))
+        res = self.pool.map(partial(_rand_imp, nsim = start + nsim, 
+                entropy = entropy, profile = profile), 
+                range(start, start + nsim), chunksize = chunksize)
+        if profile:
+            for est, records in res:
+                for rec in records:
+                    prof.add(rec)
+            res = [est for est, records in res]
+        return(np.vstack(res))
+
+    def boot(self, nboot, nsim, entropy, cluster, method = "poisson",
+            midpoint = False):
+        """The years, (replicate, year) rate sums and imputation counts of
+        boot_range, with each worker running a range of replicates over
+        all imputations"""
+        edges = np.linspace(0, nboot, min(self.mcores, nboot) + 1).astype(int)
+        res = self.pool.map(partial(_boot_range, nsim = nsim, 
+                entropy = entropy, cluster = cluster, method = method,
+                midpoint = midpoint), list(zip(edges[:-1], edges[1:])))
+        years, sums, nseen = res[0]
+        return(years, np.vstack([x[1] for x in res]), nseen)
+
+    def close(self):
+        # release the view before the block is closed
+        self.pop = None
+        self._finalizer()
+        self.blocks = []
+
+
+class IncCube:
+    """
+    The events and person-days of the repeat-testers by imputation, sex,
+    calendar year and single-year age, and the population under 
+    surveillance by sex, year and single-year age, from CalcInc.inc_cube.
+    Incidence for any age categories, age ranges and years is aggregated
+    from the cube, without splitting or imputing the episodes again.
+
+    The cube is built from the datasets selected by the SetArgs of the
+    CalcInc, which should have the widest age ranges and years to sweep.
+    An estimate from the cube then differs from one of a CalcInc rebuilt
+    with narrower SetArgs: the age ranges and years of the cube only 
+    select the person-time and population of its cells, while a rebuilt
+    CalcInc drops the HIV tests outside them, which can change who is a
+    repeat-tester, their censoring interval and their age. With the age
+    categories of the SetArgs it was built with, and without age ranges
+    or years, the cube gives the estimates of inc_randpoint with batch, 
+    or of inc_midpoint.
+
+    Attributes
+    ----------
+    years : array
+        calendar years of the cells
+    ages : array
+        single-year ages of the cells
+    sexes : array
+        Female codes of the cells
+    events, days : array
+        (imputation, sex, year, age) events and person-days
+    seen : array
+        (imputation, sex, year) mask of the years with episodes
+    pop : array
+        (sex, year, age) number of participants under surveillance
+
+    Methods
+    -------
+    cells(self, agecat, age = None, years = None)
+        events, person-days and population by year and age category
+    estimate(self, agecat = None, age = None, years = None, ageby = None,
+            age_adjust = True)
+        incidence rates by year, combined over the imputations
+    sweep(self, configs)
+        estimates for a list of estimate arguments
+    """
+
+    sdict = {"Fem": 1, "Mal": 0}
+
+    def __init__(self, years, ages, sexes, events, days, seen, pop, 
+            agecat, ageby):
+        self.years = years
+        self.ages = ages
+        self.sexes = sexes
+        self.events = events
+        self.days = days
+        self.seen = seen
+        self.pop = pop
+        # the defaults of estimate, from the SetArgs of the cube
+        self.agecat = np.asarray(agecat)
+        self.ageby = ageby
+
+    def cells(self, agecat, age = None, years = None):
+        """
+        Years and the events, person-days, seen years and population of
+        the cells in the age ranges and years, by year and age category
+
+        Parameters
+        ----------
+        agecat : list
+            the age intervals, closed on the left
+        age : dict
+            the age ranges of the sexes to keep, as in SetArgs, None 
+            keeps both sexes and all ages
+        years : list
+            the years to keep, None keeps all years
+        """
+        agecat = np.asarray(agecat)
+        ncat = len(agecat) - 1
+        cat = np.searchsorted(agecat, self.ages, side = "right") - 1
+        ok = (cat >= 0) & (self.ages < agecat[-1])
+        # a (sex, age, category) map of the single-year ages that are kept
+        amap = np.zeros((len(self.sexes), len(self.ages), ncat))
+        keep = np.ones(len(self.sexes), dtype = bool)
+        for s, code in enumerate(self.sexes):
+            inside = ok.copy()
+            if age is not None:
+                name = [k for k, v in self.sdict.items() if v == code]
+                if not name or name[0] not in age:
+                    keep[s] = False
+                    continue
+                lo, hi = age[name[0]]
+                inside &= ~(self.ages < lo) & ~(self.ages > hi)
+            amap[s, np.nonzero(inside)[0], cat[inside]] = 1
+        ysel = np.ones(len(self.years), dtype = bool) if years is None \
+            else np.isin(self.years, years)
+        events = np.tensordot(self.events[:, :, ysel], amap, 
+                axes = ([1, 3], [0, 1]))
+        days = np.tensordot(self.days[:, :, ysel], amap, 
+                axes = ([1, 3], [0, 1]))
+        seen = self.seen[:, keep][:, :, ysel].any(axis = 1)
+        pop = np.tensordot(self.pop[:, ysel], amap, axes = ([0, 2], [0, 1]))
+        return(self.years[ysel], events, days, seen, pop)
+
+    def estimate(self, agecat = None, age = None, years = None, 
+            ageby = None, age_adjust = True):
+        """
+        Incidence rates by year, combined over the imputations with 
+        Rubin's rules as in inc_randpoint
+
+        Parameters
+        ----------
+        agecat : list
+            the age intervals, by default made from the age ranges and 
+            ageby as in SetArgs, or the age intervals of the cube 
+        age : dict
+            the age ranges of the sexes to keep, e.g. {"Fem": [15, 24]}
+        years : list
+            the years to keep
+        ageby : int
+            width of the age intervals made from age, default is the 
+            ageby of the cube
+        age_adjust : bool
+        """
+        if agecat is None and age is not None:
+            ageby = self.ageby if ageby is None else ageby
+            agecat = np.arange(np.min(list(age.values())),
+                np.max(list(age.values())) + ageby, ageby)
+        elif agecat is None:
+            agecat = self.agecat
+        years, events, days, seen, pop = self.cells(agecat, age, years)
+        if (age_adjust is not True):
+            pop = np.ones_like(pop)
+        if np.any(seen.any(axis = 0) & (pop.sum(axis = 1) == 0)):
+            raise ValueError("ahri: no population for years with "
+                "repeat-testers")
+        out = cypy.age_adjust_all(np.rint(events).astype(np.intc), 
+            (np.rint(days) / 365).astype(np.intc), pop)
+        k, y = np.nonzero(seen)
+        return(est_combine(np.c_[years[y], out[k, y]]))
+
+    def sweep(self, configs):
+        """
+        Estimates for each dict of estimate arguments in configs, stacked
+        with a Config column of the position of the dict
+
+        Parameters
+        ----------
+        configs : list
+            dicts of estimate arguments, e.g. [{"ageby": 10, "age": 
+            {"Fem": [15, 49]}}, {"years": range(2010, 2020)}]
+        """
+        res = []
+        for i, cfg in enumerate(configs):
+            est = self.estimate(**cfg)
+            est.insert(0, "Config", i)
+            res.append(est)
+        return(pd.concat(res, ignore_index = True))
+
 
 class CalcInc(SetData):
-    def __init__(self, args):
-        SetData.__init__(self, args)
-        self.idat = prep_for_imp(self.repeat_tester_data)
-        self.pop_n = self.get_pop_n()
+    # the imputation data do not depend on the age categories, pop_n does
+    memo_fields = {**SetData.memo_fields, "idat": SetData.data_fields,
+            "pop_n": SetData.data_fields + ["ageby", "agecat"]}
+    memo_deps = {**SetData.memo_deps, 
+            "epi_data": SetData.memo_deps["epi_data"] + ["pop_n"],
+            "repeat_tester_data": ["idat"]}
+
+    def __init__(self, args, columns = None):
+        SetData.__init__(self, args, columns)
+
+    def __copy__(self):
+        # a copy starts its own imputation pool
+        new = SetData.__copy__(self)
+        new._pool = None
+        return(new)
+
+    @property
+    def idat(self):
+        return(self.memo("idat", lambda: self.make_derived("idat", 
+            self.make_idat, self.memo_fields["idat"])))
+
+    def make_idat(self):
+        rtdat = self.repeat_tester_data
+        with stage(self.args.profiler, "prep_for_imp", len(rtdat)) as rec:
+            dat = prep_for_imp(rtdat.copy())
+            rec["rows_out"] = len(dat[0]) + len(dat[1])
+        return(dat)
+
+    @idat.setter
+    def idat(self, dat):
+        self.set_memo("idat", dat)
+
+    @property
+    def pop_n(self):
+        return(self.memo("pop_n", 
+            lambda: self.make_derived("pop_n", self.get_pop_n, 
+                self.memo_fields["pop_n"])))
+
+    @pop_n.setter
+    def pop_n(self, dat):
+        self.set_memo("pop_n", dat)
 
     def agg_data(self, dat):
-        """Split repeat-tester data into episodes""" 
-        ndat0 = dat[0][:, [0, 1, 2,  4, 5]]
-        # replace early_pos with imp date at 6
-        ndat1 = dat[1][:, [0, 1, 6,  4, 5]]
-        ndat = np.concatenate([ndat0, ndat1],
-                dtype = np.intc, casting = 'unsafe')
-        pdat = cypy.pre_split(ndat) 
-        edat = cypy.split_data(pdat)
-        # aggregate the data by agecat and year
-        dat = pd.DataFrame(np.vstack(edat), 
-                columns = ["Year", "Days", "Event", "Age"])
-        dat["PYears"] = dat["Days"] / 365
-        dat = self.calc_age_cat(dat)
-        dat = dat.groupby(["Year", "AgeCat"]).agg(
-                Events = pd.NamedAgg("Event", sum),
-                PYears = pd.NamedAgg("PYears", sum)
-                ).reset_index()
+        """Aggregate repeat-tester episodes by year and age category"""
+        prof = self.args.profiler
+        with stage(prof, "pre_split", len(dat[0]) + len(dat[1])) as rec:
+            pdat = pre_split_idat(dat)
+            rec["rows_out"] = len(pdat)
+        # aggregate the episodes by agecat and year
+        with stage(prof, "split", len(pdat)) as rec:
+            years, events, days = agg_cells(pdat, self.args.agecat)
+            rec["rows_out"] = events.size
+        with stage(prof, "aggregate", events.size) as rec:
+            dat = self.agg_frame(years, events, days)
+            rec["rows_out"] = len(dat)
+        return(dat)
+
+    def agg_frame(self, years, events, days):
+        """The Year, AgeCat, Events, PYears frame of year by age category
+        cells"""
+        ncat = events.shape[1]
+        dat = pd.DataFrame({
+            "Year": np.repeat(years, ncat),
+            "AgeCat": pd.Categorical.from_codes(
+                np.tile(np.arange(ncat), len(years)),
+                categories = pd.IntervalIndex.from_breaks(
+                    self.args.agecat, closed = "left"),
+                ordered = True),
+            "Events": events.ravel(),
+            "PYears": days.ravel() / 365})
         return(dat)
 
 
+    def do_rand_batch(self, nsim, chunk = 100, entropy = None, start = 0,
+            strata = None):
+        """Run nsim random-point imputations as one vectorized batch
+
+        With entropy, imputation start + k uses its own seeded stream.
+        With strata, a dict from strata_data, the episodes are also split
+        by stratum and the estimates have a stratum code after the Year
+        """
+        prof = self.args.profiler
+        nstrata = 1 if strata is None else strata["nstrata"]
+        res, pop = [], None
+        for years, ev, dy, sn in self.batch_cells(nsim, chunk, entropy, 
+                start, strata):
+            if pop is None and strata is None:
+                pop = pop_array(self.pop_n)
+            elif pop is None:
+                pop = self.strata_pop(strata, years)
+            with stage(prof, "calc_gamma", ev.size) as rec:
+                if strata is None:
+                    res.append(calc_gamma_cells(years, ev, dy, pop, 
+                        sn.astype(bool)))
+                else:
+                    shape = (-1, nstrata) + ev.shape[1:]
+                    res.append(calc_gamma_strata(years, ev.reshape(shape),
+                        dy.reshape(shape), pop, 
+                        sn.astype(bool).reshape(shape[:3])))
+                rec["rows_out"] = len(res[-1])
+        return(np.vstack(res))
+
+    def batch_cells(self, nsim, chunk = 100, entropy = None, start = 0,
+            strata = None, agecat = None):
+        """Split and aggregate nsim random-point imputations in chunks
+
+        Yields the years and the events, person-days and seen years of 
+        each chunk of imputations, with one layer per imputation, or per
+        imputation and stratum (imputation * nstrata + stratum) with
+        strata. agecat is args.agecat by default.
+        """
+        dat0, dat1 = self.idat
+        agecat = self.args.agecat if agecat is None else agecat
+        lut, amin = age_lut(agecat)
+        ncat = len(agecat) - 1
+        prof = self.args.profiler
+        code0 = code1 = None
+        nstrata = 1
+        if strata is not None:
+            code0, code1 = strata["code"]
+            keep0, keep1 = code0 >= 0, code1 >= 0
+            # individuals without a stratum are dropped after imputation,
+            # so the others get the same dates as in an unstratified run
+            dat0, code0 = dat0[keep0], code0[keep0].astype(np.intc)
+            code1 = code1[keep1].astype(np.intc)
+            nstrata = strata["nstrata"]
+        with stage(prof, "pre_split", len(dat0) + len(dat1)) as rec:
+            pdat0 = cypy.pre_split(np.array(dat0[:, [0, 1, 2, 4, 5]],
+                dtype = np.intc))
+            # early_pos bounds the imputed dates, so it bounds the years too
+            ndat1 = np.array(dat1[:, [0, 1, 3, 4, 5]], dtype = np.intc)
+            if strata is not None:
+                ndat1 = ndat1[keep1]
+            pdat1 = cypy.pre_split(ndat1)
+            rec["rows_out"] = len(pdat0) + len(pdat1)
+        year0 = int(np.min(np.r_[pdat0[:, 2], pdat1[:, 2]]))
+        nyear = int(np.max(np.r_[pdat0[:, 3], pdat1[:, 3]])) - year0 + 1
+        years = np.arange(year0, year0 + nyear, dtype = np.intc)
+        # non-seroconverters are the same in every imputation
+        with stage(prof, "split", len(pdat0)) as rec:
+            ev0, dy0, sn0 = cypy.agg_split(pdat0, lut, amin, year0, nyear, 
+                    ncat, code0, nstrata)
+            rec["rows_out"] = ev0.size
+        with stage(prof, "impute", nsim * len(dat1)):
+            idates = imp_random_batch(dat1, nsim, entropy, start)
+            if strata is not None:
+                idates = idates[:, keep1]
+        for j in range(0, nsim, chunk):
+            jdates = idates[j:j + chunk]
+            m = jdates.shape[0]
+            with stage(prof, "pre_split", m * len(ndat1)) as rec:
+                ndat = np.tile(ndat1, (m, 1))
+                ndat[:, 2] = jdates.ravel()
+                pdat = cypy.pre_split(ndat)
+                rec["rows_out"] = len(pdat)
+            slot = np.repeat(np.arange(m, dtype = np.intc) * nstrata, 
+                    ndat1.shape[0])
+            if code1 is not None:
+                slot += np.tile(code1, m)
+            with stage(prof, "split", len(pdat)) as rec:
+                ev, dy, sn = cypy.agg_split(pdat, lut, amin, 
+                        year0, nyear, ncat, slot, m * nstrata)
+                ev += np.tile(ev0, (m, 1, 1)); dy += np.tile(dy0, (m, 1, 1))
+                sn |= np.tile(sn0, (m, 1))
+                rec["rows_out"] = ev.size
+            yield years, ev, dy, sn
+
     def inc_midpoint(self, age_adjust = True):
         self.idat[1] = imp_midpoint(self.idat[1]) 
         sdat = self.agg_data(self.idat)
         if (age_adjust is not True):
             self.pop_n["N"] = 1
-        res = calc_gamma(sdat, self.pop_n)
-        res = est_combine(res)
+        prof = self.args.profiler
+        with stage(prof, "calc_gamma", len(sdat)) as rec:
+            res = calc_gamma(sdat, self.pop_n)
+            rec["rows_out"] = len(res)
+        res = self.combine(res)
+        return(res)
+
+    def combine(self, est, keys = ("Year",)):
+        """est_combine, timed as a stage"""
+        with stage(self.args.profiler, "est_combine", len(est)) as rec:
+            res = est_combine(est, keys)
+            rec["rows_out"] = len(res)
         return(res)
 
-    def do_rand_imp(self, i):
-        # you have to reset random seed for each process
+    def do_rand_imp(self, i, entropy = None):
         if self.args.verbose:
             timer(i, self.args.nsim)
-        np.random.seed()
-        self.idat[1] = imp_random(self.idat[1]) 
-        sdat = self.agg_data(self.idat)
-        res = calc_gamma(sdat, self.pop_n)
+        if entropy is None:
+            # you have to reset random seed for each process
+            np.random.seed()
+            rng = None
+        else:
+            rng = imp_rng(entropy, i)
+        res = rand_gamma(self.idat, self.args.agecat, 
+                pop_array(self.pop_n), rng, self.args.profiler)
+        return(res)
+
+    def imp_entropy(self):
+        """Master entropy of the imputation streams, from args.seed"""
+        return(np.random.SeedSequence(self.args.seed).entropy)
+
+    def do_rand_range(self, start, stop, entropy, batch = False, 
+            strata = None):
+        """Gamma estimates for imputations start to stop - 1, by stratum
+        if strata is given, which needs the batched engine"""
+        if strata is not None and not batch:
+            raise ValueError("ahri: stratified imputations need batch")
+        prof = self.args.profiler
+        with stage(prof, "imputations", stop - start, 
+                batch = batch) as rec:
+            if batch:
+                res = self.do_rand_batch(stop - start, 
+                    entropy = entropy, start = start, strata = strata)
+            else:
+                res = self.get_pool().map(stop - start, entropy, start, 
+                        prof)
+            rec["rows_out"] = len(res)
         return(res)
 
-    def inc_randpoint(self, age_adjust = True):
+    def get_pool(self):
+        """Start the imputation pool, or reuse it if the data are unchanged"""
+        pool = getattr(self, "_pool", None)
+        if pool is not None and pool.matches(self.idat, self.pop_n, 
+                self.args.agecat, self.args.mcores):
+            pool.update_pop(self.pop_n)
+            return(pool)
+        self.close_pool()
+        self._pool = ImpPool(self.idat, self.pop_n, self.args.agecat, 
+                self.args.mcores, self.args.verbose)
+        return(self._pool)
+
+    def close_pool(self):
+        """Stop the imputation pool and free its shared memory"""
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.close()
+        self._pool = None
+
+    def inc_randpoint(self, age_adjust = True, batch = False):
         if (age_adjust is not True):
             self.pop_n["N"] = 1
-        # use parallel processing
-        pool = mp.Pool(self.args.mcores) 
-        res = pool.map_async(self.do_rand_imp,
-                [i for i in range(self.args.nsim)])
-        results = np.vstack(res.get())
-        pool.close(); pool.join()
-        res = est_combine(results)
+        results = self.do_rand_range(0, self.args.nsim, 
+                self.imp_entropy(), batch)
+        res = self.combine(results)
+        return(res)
+
+    def strata_data(self, by, age_adjust = True):
+        """The levels of the by variables and the stratum code of each row
+        of the imputation data, -1 for individuals without a stratum. The
+        area variables are taken at the BSIntID of the latest HIV visit."""
+        levels = self.strata_levels(by)
+        rtdat = self.repeat_tester_data
+        with stage(self.args.profiler, "strata", len(rtdat)) as rec:
+            dat = pd.DataFrame({"Female": rtdat["Female"].to_numpy()})
+            if any(var != "Female" for var in by):
+                bsid = self.get_resident_bsid(self.hiv_data)
+                dat["BSIntID"] = bsid.reindex(rtdat["IIntID"]).to_numpy(
+                        dtype = np.float64, na_value = np.nan)
+            code = self.strata_codes(dat, by, levels)
+            ids = rtdat["IIntID"].to_numpy()
+            codes = [id_lookup(ids, code, x[:, 0]) for x in self.idat]
+            rec["rows_out"] = sum((c >= 0).sum() for c in codes)
+        return({"by": list(by), "levels": levels, "code": codes,
+            "nstrata": int(np.prod([len(lev) for lev in levels])),
+            "age_adjust": age_adjust})
+
+    def strata_pop(self, strata, years):
+        """Population by stratum, year and age category, all ones without
+        age adjustment"""
+        if strata["age_adjust"] is not True:
+            return(np.ones((strata["nstrata"], len(years), 
+                len(self.args.agecat) - 1)))
+        return(self.get_pop_cells(strata["by"], strata["levels"], years))
+
+    def strata_midpoint(self, strata):
+        """Gamma estimates by stratum for the mid-point imputation"""
+        years, ev, dy, sn = self.midpoint_cells(strata)
+        shape = (1, strata["nstrata"]) + ev.shape[1:]
+        with stage(self.args.profiler, "calc_gamma", ev.size) as rec:
+            res = calc_gamma_strata(years, ev.reshape(shape), 
+                dy.reshape(shape), self.strata_pop(strata, years),
+                sn.astype(bool).reshape(shape[:3]))
+            rec["rows_out"] = len(res)
+        return(res)
+
+    def midpoint_cells(self, strata, agecat = None):
+        """The years and the events, person-days and seen years of the 
+        mid-point imputation, with one layer per stratum"""
+        dat0, dat1 = self.idat
+        code0, code1 = strata["code"]
+        keep0, keep1 = code0 >= 0, code1 >= 0
+        idat = [dat0[keep0], imp_midpoint(dat1[keep1][:, :6])]
+        prof = self.args.profiler
+        with stage(prof, "pre_split", len(idat[0]) + len(idat[1])) as rec:
+            pdat = pre_split_idat(idat)
+            rec["rows_out"] = len(pdat)
+        agecat = self.args.agecat if agecat is None else agecat
+        lut, amin = age_lut(agecat)
+        year0 = int(np.min(pdat[:, 2]))
+        nyear = int(np.max(pdat[:, 3])) - year0 + 1
+        years = np.arange(year0, year0 + nyear, dtype = np.intc)
+        slot = np.r_[code0[keep0], code1[keep1]].astype(np.intc)
+        with stage(prof, "split", len(pdat)) as rec:
+            ev, dy, sn = cypy.agg_split(pdat, lut, amin, year0, nyear,
+                    len(agecat) - 1, slot, strata["nstrata"])
+            rec["rows_out"] = ev.size
+        return(years, ev, dy, sn)
+
+    def inc_strata(self, by = ("Female",), age_adjust = True, 
+            midpoint = False):
+        """
+        Incidence rates by year for each stratum of the by variables in
+        one run. The episodes of all strata are split and aggregated 
+        together from the same imputed dates as inc_randpoint with batch, 
+        and the estimates of all strata are combined with Rubin's rules
+        in one pass. Each stratum is age-adjusted to its own population
+        under surveillance, so a sex stratum gives the estimates of a 
+        CalcInc restricted to that sex with args.update_age.
+
+        Individuals are in the stratum of their sex and of the area of
+        the BSIntID at their latest HIV visit, for the whole of their
+        follow-up. Individuals without a known stratum are left out.
+
+        Parameters
+        ----------
+        by : list
+            the variables to stratify by, from dataproc.strata_vars: 
+            "Female", "IsUrbanOrRural" and "PIPSA". More than one variable
+            gives a stratum for each combination of their levels.
+        age_adjust : bool
+        midpoint : bool
+            use the mid-point instead of args.nsim random-point 
+            imputations
+        """
+        strata = self.strata_data(by, age_adjust)
+        if midpoint:
+            est = self.strata_midpoint(strata)
+        else:
+            est = self.do_rand_range(0, self.args.nsim, self.imp_entropy(),
+                    batch = True, strata = strata)
+        levels = strata["levels"]
+        codes = np.unravel_index(est[:, 1].astype(np.int64), 
+                [len(lev) for lev in levels])
+        est = np.column_stack([est[:, 0], *codes, est[:, 2:]])
+        res = self.combine(est, keys = ("Year", *strata["by"]))
+        for var, lev in zip(strata["by"], levels):
+            if var != "Female":
+                res[var] = pd.Categorical.from_codes(res[var], lev)
         return(res)
 
+    def boot_clusters(self, cluster = False):
+        """Cluster index of each row of the imputation data, dat[0] then 
+        dat[1]: each individual, or with cluster the BSIntID of the latest
+        HIV visit. Individuals without a known BSIntID are clusters of 
+        their own."""
+        ids = np.concatenate([x[:, 0] for x in self.idat])
+        if not cluster:
+            return(np.arange(len(ids)))
+        bsid = self.get_resident_bsid(self.hiv_data)
+        bsid = id_lookup(bsid.index.to_numpy(), bsid.to_numpy(
+            dtype = np.float64, na_value = np.nan), ids, np.nan)
+        known = ~np.isnan(bsid)
+        _, inv = np.unique(bsid[known], return_inverse = True)
+        res = np.empty(len(ids), dtype = np.int64)
+        res[known] = inv.ravel()
+        res[~known] = len(np.unique(inv)) + np.arange((~known).sum())
+        return(res)
+
+    def inc_boot(self, nboot = 1000, cluster = False, method = "poisson",
+            age_adjust = True, midpoint = False, batch = False):
+        """
+        Incidence rates with bootstrap confidence intervals. Individuals,
+        or the bounded structures they live in with cluster, are 
+        resampled by weighting their events and person-days, so the 
+        intervals account for the clustering of individuals. Each 
+        replicate is run on the args.nsim random-point imputations (or
+        the mid-point) and its rates are averaged over them, so the 
+        intervals include the imputation uncertainty. SE is the standard
+        deviation and LCI and UCI the 2.5 and 97.5 percentiles of the 
+        replicates. Rate is the estimate of inc_randpoint, or of 
+        inc_midpoint. Replicate b always gets the same weights for the 
+        same args.seed, however the replicates are split up.
 
+        Parameters
+        ----------
+        nboot : int
+            number of bootstrap replicates
+        cluster : bool
+            resample the BSIntID of the latest HIV visit of each
+            individual instead of individuals
+        method : str
+            "poisson" for Poisson(1) weights, or "multinomial" for the 
+            weights of the classic bootstrap
+        age_adjust : bool
+        midpoint : bool
+            use the mid-point imputation
+        batch : bool
+            run the replicates in this process instead of the worker pool
+        """
+        if (age_adjust is not True):
+            self.pop_n["N"] = 1
+        # the same entropy imputes the dates of the point estimates
+        entropy = self.imp_entropy()
+        if midpoint:
+            point = self.inc_midpoint()
+        else:
+            point = self.combine(self.do_rand_range(0, self.args.nsim, 
+                entropy, batch = True))
+        clusters = self.boot_clusters(cluster)
+        with stage(self.args.profiler, "bootstrap", nboot, 
+                batch = batch) as rec:
+            if batch:
+                res = boot_range(self.idat, self.args.agecat, 
+                    pop_array(self.pop_n), clusters, entropy, 0, nboot,
+                    self.args.nsim, method, midpoint)
+            else:
+                res = self.get_pool().boot(nboot, self.args.nsim, entropy,
+                    clusters, method, midpoint)
+            rec["rows_out"] = res[1].size
+        return(boot_combine(*res, point))
+
+    def inc_cube(self, midpoint = False, chunk = 100):
+        """
+        Split and impute the episodes once by sex, calendar year and 
+        single-year age, for sweeps over age categories, age ranges and
+        years with IncCube.estimate. The args.nsim imputations have the 
+        dates of inc_randpoint.
+
+        Parameters
+        ----------
+        midpoint : bool
+            use the mid-point imputation
+        chunk : int
+            imputations split at a time
+        """
+        strata = self.strata_data(["Female"])
+        dat0, dat1 = self.idat
+        # the oldest age of a repeat-tester or of a participant
+        span = (np.nanmax(np.r_[dat0[:, 2], dat1[:, 3]]) - 
+                np.nanmin(np.r_[dat0[:, 1], dat1[:, 1]])) / 365.25
+        amax = max(np.nanmax(np.r_[dat0[:, 5], dat1[:, 5]]) + span, 
+                np.nanmax(self.epi_data["Age"]))
+        agecat = np.arange(0, int(amax) + 3)
+        if midpoint:
+            years, events, days, seen = self.midpoint_cells(strata, agecat)
+            events, days, seen = events[None], days[None], seen[None]
+        else:
+            cells = list(self.batch_cells(self.args.nsim, chunk, 
+                self.imp_entropy(), 0, strata, agecat))
+            nsex = strata["nstrata"]
+            years = cells[0][0]
+            events, days, seen = [np.concatenate([x[i].reshape(
+                (-1, nsex) + x[i].shape[1:]) for x in cells]) 
+                for i in range(1, 4)]
+        pop = self.get_pop_cells(["Female"], strata["levels"], years, 
+                agecat)
+        return(IncCube(years, agecat[:-1], strata["levels"][0], events,
+            days, seen.astype(bool), pop, self.args.agecat, 
+            self.args.ageby))
+
+    def lexis_cells(self, per_year = 1, midpoint = False, chunk = 100):
+        """
+        Exact events and person-days of the repeat-testers by calendar 
+        period and age category, for each of the args.nsim random-point
+        imputations of inc_randpoint, or the mid-point. Follow-up is cut
+        at the starts of the calendar periods and at the birthdays of the
+        args.agecat ages, from the DoB of the Surveillance dataset. 
+        Individuals without a DoB are left out after imputation. Returns
+        the period starts (days since date_origin) and the (imputation,
+        period, age category) events, person-days and seen periods.
+
+        Parameters
+        ----------
+        per_year : int
+            periods a year: 1 for years, 2 for half-years, 4 for quarters
+        midpoint : bool
+            use the mid-point imputation
+        chunk : int
+            imputations split at a time
+        """
+        dat0, dat1 = self.idat
+        bdate = self.birth_date
+        dob0, dob1 = [id_lookup(bdate.index.to_numpy(), bdate.to_numpy(), 
+            x[:, 0], np.nan) for x in (dat0, dat1)]
+        keep0, keep1 = ~np.isnan(dob0), ~np.isnan(dob1)
+        if midpoint:
+            idates = np.floor((dat1[:, 2] + dat1[:, 3]) / 2)[np.newaxis]
+        else:
+            idates = imp_random_batch(dat1, self.args.nsim, 
+                    self.imp_entropy())
+        idates = idates[:, keep1].astype(np.intc)
+        dat0, dat1 = dat0[keep0], dat1[keep1]
+        ab0 = birthdays(dob0[keep0], self.args.agecat)
+        ab1 = birthdays(dob1[keep1], self.args.agecat)
+        # early_pos bounds the imputed dates
+        days = np.r_[dat0[:, 1], dat0[:, 2], dat1[:, 1], dat1[:, 3]]
+        origin = np.datetime64(date_origin.date(), "D")
+        year0, year1 = (origin + np.array([np.min(days), np.max(days)], 
+            dtype = np.int64).astype("timedelta64[D]")).astype(
+                "datetime64[Y]").astype(int) + 1970
+        cbreak = period_breaks(year0, year1, per_year)
+        n0, n1 = len(dat0), len(dat1)
+        prof = self.args.profiler
+        # non-seroconverters are the same in every imputation
+        with stage(prof, "split", n0) as rec:
+            ev0, dy0, sn0 = cypy.lexis_split(dat0[:, 1].astype(np.intc), 
+                dat0[:, 2].astype(np.intc), np.zeros(n0, dtype = np.intc),
+                np.arange(n0, dtype = np.intc), cbreak, ab0)
+            rec["rows_out"] = ev0.size
+        start1 = dat1[:, 1].astype(np.intc)
+        event1 = dat1[:, 4].astype(np.intc)
+        res = []
+        for j in range(0, len(idates), chunk):
+            m = len(idates[j:j + chunk])
+            with stage(prof, "split", m * n1) as rec:
+                ev, dy, sn = cypy.lexis_split(np.tile(start1, m), 
+                    idates[j:j + chunk].ravel(), np.tile(event1, m), 
+                    np.tile(np.arange(n1, dtype = np.intc), m), cbreak, 
+                    ab1, np.repeat(np.arange(m, dtype = np.intc), n1), m)
+                res.append((ev + ev0, dy + dy0, sn | sn0))
+                rec["rows_out"] = ev.size
+        events, days, seen = [np.concatenate(x) for x in zip(*res)]
+        return(cbreak[:-1], events, days, seen)
+
+    def inc_lexis(self, per_year = 1, age_adjust = True, midpoint = False):
+        """
+        Incidence rates by calendar period from exact Lexis splitting of
+        the follow-up on calendar time and age (see lexis_cells), with
+        person-years of 365.25 days. Unlike the other estimates, age is
+        the exact age from the DoB, not the age at the latest HIV-negative
+        test increased each calendar year. The periods of a year are 
+        age-adjusted to the population of the year. Returns the Year and
+        the Period of the year (1 to per_year) with the rates combined 
+        over the imputations.
+
+        Parameters
+        ----------
+        per_year : int
+            periods a year: 1 for years, 2 for half-years, 4 for quarters
+        age_adjust : bool
+        midpoint : bool
+            use the mid-point imputation
+        """
+        if (age_adjust is not True):
+            self.pop_n["N"] = 1
+        starts, events, days, seen = self.lexis_cells(per_year, midpoint)
+        origin = np.datetime64(date_origin.date(), "D")
+        month = (origin + starts.astype("timedelta64[D]")).astype(
+                "datetime64[M]").astype(int)
+        year = month // 12 + 1970
+        period = month % 12 // (12 // per_year) + 1
+        seen = seen.astype(bool)
+        anyseen = seen.any(axis = 0)
+        pop = pop_array(self.pop_n)
+        stpop = np.zeros((len(starts), events.shape[2]))
+        with stage(self.args.profiler, "calc_gamma", events.size) as rec:
+            stpop[anyseen] = year_cells(year[anyseen], pop[:, 0], 
+                    pop[:, 1], events.shape[2])
+            out = cypy.age_adjust_all(events, days / 365.25, stpop)
+            k, p = np.nonzero(seen)
+            est = np.c_[year[p], period[p], out[k, p]]
+            rec["rows_out"] = len(est)
+        return(self.combine(est, keys = ("Year", "Period")))
+
+    def inc_shard(self, start, stop, path = None, 
+            age_adjust = True, batch = False):
+        """
+        Run imputations start to stop - 1 of a random-point run and
+        optionally save the raw gamma estimates to path (.npz). Shards run
+        with the same args.seed combine with merge_shards to the same
+        estimates as a single run of all imputations.
+
+        Parameters
+        ----------
+        start : int
+            index of the first imputation
+        stop : int
+            index after the last imputation
+        path : str
+            file to write the shard to
+        age_adjust : bool
+        batch : bool
+            use the batched engine instead of the worker pool
+        """
+        if self.args.seed is None:
+            raise ValueError("ahri: set args.seed to run imputation shards")
+        if (age_adjust is not True):
+            self.pop_n["N"] = 1
+        est = self.do_rand_range(start, stop, self.imp_entropy(), batch)
+        if path is not None:
+            np.savez(path, est = est, start = start, stop = stop, 
+                    seed = self.args.seed)
+        return(est)
@@ -5,6 +5,9 @@ cdef int add2(int origin , int day):
     return origin + day
 
 cdef double divide(double a, double b):
+    # cells without person-time contribute nothing to the rate
+    if b == 0:
+        return 0.0
     return a / b
 
 cdef double pow(double a):
@@ -36,9 +39,34 @@ def pre_split(int [:,:] ndat):
 
 
 def split_data(int [:,:] predat):
+    cdef int x, year, age, nyear
+    cdef Py_ssize_t i, k = 0, n = 0
     cdef Py_ssize_t nrow = predat.shape[0]
-    edat = [split_long(predat[di]) for di in range(nrow)]
-    return(edat)
+
+    # count the episodes first so the output is allocated only once
+    for i in range(nrow):
+        nyear = subtract(predat[i, 3], predat[i, 2]) + 1
+        if nyear < 1:
+            raise ValueError(f"ahri: end year before start year in row {i}")
+        n += nyear
+
+    result = np.zeros((n, 4), dtype = np.intc)
+    cdef int[:, :] res = result
+
+    for i in range(nrow):
+        year = predat[i, 2]
+        age = predat[i, 5]
+        nyear = subtract(predat[i, 3], year) + 1
+        for x in range(nyear):
+            res[k + x, 0] = year + x
+            res[k + x, 1] = 365
+            res[k + x, 3] = age + x
+        k += nyear
+        res[k - 1, 2] = predat[i, 4]
+        res[k - 1, 1] = predat[i, 1]
+        res[k - nyear, 1] = subtract(res[k - nyear, 1], predat[i, 0])
+
+    return result
 
 def split_long(int [:] di):
 
@@ -65,6 +93,50 @@ def split_long(int [:] di):
     return result
 
 
+def agg_split(int [:,:] predat, int [:] agelut, int agemin, 
+        int year0, int nyear, int ncat, int [:] slot = None, int nslot = 1):
+    cdef int x, y, c, d, nx, k = 0
+    cdef long long a
+    cdef Py_ssize_t i, nrow = predat.shape[0]
+    cdef Py_ssize_t nlut = agelut.shape[0]
+    cdef bint has_slot = slot is not None
+
+    # slot gives the output layer of each row, e.g. the imputation index
+    events = np.zeros((nslot, nyear, ncat), dtype = np.intc)
+    days = np.zeros((nslot, nyear, ncat), dtype = np.int64)
+    seen = np.zeros((nslot, nyear), dtype = np.uint8)
+    cdef int[:, :, :] ev = events
+    cdef long long[:, :, :] dy = days
+    cdef unsigned char[:, :] sn = seen
+
+    for i in range(nrow):
+        nx = subtract(predat[i, 3], predat[i, 2]) + 1
+        if nx < 1:
+            raise ValueError(f"ahri: end year before start year in row {i}")
+        if has_slot:
+            k = slot[i]
+        for x in range(nx):
+            y = predat[i, 2] - year0 + x
+            if y < 0 or y >= nyear:
+                continue
+            sn[k, y] = 1
+            # same day counts as split_data: full years are 365 days
+            d = predat[i, 1] if x == nx - 1 else 365
+            if x == 0:
+                d = subtract(d, predat[i, 0])
+            a = <long long> predat[i, 5] + x - agemin
+            if a < 0 or a >= nlut:
+                continue
+            c = agelut[a]
+            if c < 0:
+                continue
+            dy[k, y, c] += d
+            if x == nx - 1:
+                ev[k, y, c] += predat[i, 4]
+
+    return events, days, seen
+
+
 def age_adjust(int [:] count, int [:] pop, double [:] stpop):
 
     DTYPE = np.double
@@ -84,3 +156,112 @@ def age_adjust(int [:] count, int [:] pop, double [:] stpop):
         res[1] += divide(count[i], pow(pop[i])) * pow(wt)
 
     return out
+
+
+ctypedef fused pyear_t:
+    int
+    double
+
+
+def age_adjust_all(int [:,:,:] count, pyear_t [:,:,:] pop, double [:,:] stpop):
+    # count, pop: (imputation, year, age category); stpop: (year, category)
+    # pop is whole person-years (int) or exact person-years (double)
+    DTYPE = np.double
+    cdef Py_ssize_t k, y, i
+    cdef Py_ssize_t nk = count.shape[0], ny = count.shape[1]
+    cdef Py_ssize_t ni = count.shape[2]
+    cdef double wt, ptot
+
+    if (pop.shape[0] != nk or pop.shape[1] != ny or pop.shape[2] != ni or
+            stpop.shape[0] != ny or stpop.shape[1] != ni):
+        raise ValueError("ahri: count, pop and stpop cells do not match")
+
+    out = np.zeros((nk, ny, 2), dtype = DTYPE)
+    cdef double[:, :, :] res = out
+    wts = np.zeros((ny, ni), dtype = DTYPE)
+    cdef double[:, :] w = wts
+
+    for y in range(ny):
+        ptot = 0.0
+        for i in range(ni):
+            ptot += stpop[y, i]
+        for i in range(ni):
+            w[y, i] = divide(stpop[y, i], ptot)
+
+    for k in range(nk):
+        for y in range(ny):
+            for i in range(ni):
+                wt = w[y, i]
+                res[k, y, 0] += divide(count[k, y, i], pop[k, y, i]) * wt
+                res[k, y, 1] += divide(count[k, y, i], 
+                        pow(pop[k, y, i])) * pow(wt)
+
+    return out
+
+
+def lexis_split(int [:] start, int [:] end, int [:] event, int [:] person,
+        int [:] cbreak, int [:,:] abreak, int [:] slot = None, 
+        int nslot = 1):
+    # follow-up [start, end) in days, cut at the calendar breakpoints and
+    # at the age breakpoints (birthdays) of row person of abreak
+    cdef Py_ssize_t i, j, lo, hi, mid, p, a
+    cdef Py_ssize_t nrow = start.shape[0]
+    cdef Py_ssize_t nc = cbreak.shape[0], na = abreak.shape[1]
+    cdef int t, nxt, k = 0
+    cdef bint has_slot = slot is not None
+
+    if nc < 2 or na < 2:
+        raise ValueError("ahri: need at least two calendar and age breaks")
+    events = np.zeros((nslot, nc - 1, na - 1), dtype = np.intc)
+    days = np.zeros((nslot, nc - 1, na - 1), dtype = np.int64)
+    seen = np.zeros((nslot, nc - 1), dtype = np.uint8)
+    cdef int[:, :, :] ev = events
+    cdef long long[:, :, :] dy = days
+    cdef unsigned char[:, :] sn = seen
+
+    for i in range(nrow):
+        if end[i] < start[i]:
+            raise ValueError(f"ahri: end date before start date in row {i}")
+        j = person[i]
+        if has_slot:
+            k = slot[i]
+        t = start[i]
+        # p and a are the last breakpoints at or before t, -1 if none
+        lo = 0; hi = nc
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cbreak[mid] <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        p = lo - 1
+        lo = 0; hi = na
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if abreak[j, mid] <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        a = lo - 1
+        while t < end[i]:
+            nxt = end[i]
+            if p + 1 < nc and cbreak[p + 1] < nxt:
+                nxt = cbreak[p + 1]
+            if a + 1 < na and abreak[j, a + 1] < nxt:
+                nxt = abreak[j, a + 1]
+            if p >= 0 and p < nc - 1:
+                sn[k, p] = 1
+                if a >= 0 and a < na - 1:
+                    dy[k, p, a] += nxt - t
+            t = nxt
+            while p + 1 < nc and cbreak[p + 1] <= t:
+                p += 1
+            while a + 1 < na and abreak[j, a + 1] <= t:
+                a += 1
+        # the event is in the cell of the end date
+        if event[i] != 0 and p >= 0 and p < nc - 1:
+            sn[k, p] = 1
+            if a >= 0 and a < na - 1:
+                ev[k, p, a] += event[i]
+
+    return events, days, seen
@@ -1,14 +1,449 @@
+import os
+import json
+import hashlib
+import tempfile
 import pandas as pd
 import numpy as np
 from ahri.args import SetArgs
-from functools import reduce
+from ahri.instrument import stage
 
 
+# the processed datasets store dates as days since date_origin
+date_origin = pd.Timestamp("2000-01-01")
+
+# compact dtypes of the processed datasets, "days" are Int32 day offsets
+# from date_origin with missing dates as <NA>
+schema = {
+    "IIntID": "int32", "BSIntID": "Int32", "Female": "int8", 
+    "Year": "int16", "Age": "int16", "HIVResult": "category",
+    "PIPSA": "category", "IsUrbanOrRural": "category",
+    "VisitDate": "days", "HIVNegative": "days", "HIVPositive": "days",
+    "ObservationStart": "days", "ObservationEnd": "days", "DoB": "days"}
+
+# variables the incidence can be stratified by, the area variables are
+# looked up by BSIntID in the Bounded Structures dataset
+strata_vars = ("Female", "IsUrbanOrRural", "PIPSA")
+
+def to_days(col):
+    """
+    Dates as Int32 days since date_origin, day offsets are only cast
+
+    Parameters
+    ----------
+    col : pandas series
+        dates or day offsets
+    """
+    if pd.api.types.is_datetime64_any_dtype(col):
+        col = (col - date_origin).dt.days
+    return col.astype("Int32")
+
+def to_dates(col):
+    """
+    Day offsets from date_origin as dates, dates are returned unchanged
+
+    Parameters
+    ----------
+    col : pandas series
+        dates or day offsets
+    """
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col
+    return pd.to_datetime(col.astype("Float64"), unit = "D", 
+            origin = date_origin)
+
+def date_year(col):
+    """
+    Calendar year of dates or of day offsets from date_origin
+
+    Parameters
+    ----------
+    col : pandas series
+    """
+    return to_dates(col).dt.year
+
+def compact(dat, types = None):
+    """
+    Cast the columns of a dataframe to the compact schema. Integer columns
+    with missing values get the nullable integer type, columns not in the
+    schema are unchanged.
+
+    Parameters
+    ----------
+    dat : pandas dataframe
+    types : dict
+        dtypes by column name, default is schema
+    """
+    types = schema if types is None else types
+    cols = {}
+    for name in dat.columns:
+        dtype = types.get(name)
+        if dtype is None:
+            continue
+        col = dat[name]
+        if dtype == "days":
+            cols[name] = to_days(col)
+        elif dtype[0] == "i" and col.isna().any():
+            cols[name] = col.astype(dtype.capitalize())
+        else:
+            cols[name] = col.astype(dtype)
+    return dat.assign(**cols)
+
+def masked_values(col):
+    """
+    Values and missing-value mask of a column, the mask is None if the
+    column has no nullable dtype
+
+    Parameters
+    ----------
+    col : pandas series
+    """
+    if isinstance(col.array, (pd.arrays.IntegerArray, 
+            pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+        return (col.to_numpy(dtype = col.dtype.numpy_dtype, na_value = 0), 
+                col.isna().to_numpy())
+    return (col.to_numpy(), None)
+
+def masked_array(values, mask):
+    """
+    Nullable pandas array from values and a missing-value mask, the 
+    inverse of masked_values
+
+    Parameters
+    ----------
+    values : array
+    mask : array
+    """
+    if values.dtype.kind == "b":
+        return pd.arrays.BooleanArray(values, mask)
+    if values.dtype.kind == "f":
+        return pd.arrays.FloatingArray(values, mask)
+    return pd.arrays.IntegerArray(values, mask)
+
+def id_lookup(ids, values, x, fill = -1):
+    """
+    Values of the unique ids at each of x, fill where x is not found,
+    such as NaN
+
+    Parameters
+    ----------
+    ids : array
+        unique IDs, in any order
+    values : array
+        value of each of ids
+    x : array
+        IDs to look up
+    fill : scalar
+        value where x is not in ids
+    """
+    order = np.argsort(ids, kind = "stable")
+    ids, values = np.asarray(ids)[order], np.asarray(values)[order]
+    if len(ids) == 0:
+        return np.full(len(x), fill)
+    pos = np.searchsorted(ids, x).clip(max = len(ids) - 1)
+    return np.where(ids[pos] == x, values[pos], fill)
+
+
+class ColWriter:
+    """
+    Write dataframe chunks to a column cache: a folder with one .npy file
+    per column and a meta.json file with the column order and categories.
+    Each chunk is appended to the columns as it arrives, so only one chunk
+    needs to be in memory. String columns are stored as categoricals, 
+    nullable columns with a .mask.npy file of the missing values.
+
+    Methods
+    -------
+    append(self, dat)
+        append a chunk of rows
+    close(self)
+        write the .npy files and the meta.json file
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            name of the folder
+        """
+        os.makedirs(path, exist_ok = True)
+        self.path = path
+        self.columns = None
+        self.cats = {}
+        self.segments = {}
+        self.nrows = 0
+
+    def part(self, name, ext = "npy"):
+        return os.path.join(self.path, f"{name}.{ext}.part")
+
+    def append(self, dat):
+        if self.columns is None:
+            self.columns = dat.columns.tolist()
+            for name in self.columns:
+                open(self.part(name), "wb").close()
+                self.segments[name] = []
+        for name in self.columns:
+            col = dat[name]
+            if col.dtype == object:
+                col = col.astype("category")
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                info = self.cats.setdefault(name, 
+                        {"categories": [], "ordered": bool(col.cat.ordered)})
+                # categories not seen in earlier chunks go to the end
+                info["categories"] += [c for c in col.cat.categories.tolist()
+                        if c not in info["categories"]]
+                values = pd.Categorical(col, 
+                        categories = info["categories"]).codes
+                mask = None
+            else:
+                values, mask = masked_values(col)
+            values = np.ascontiguousarray(values)
+            with open(self.part(name), "ab") as f:
+                values.tofile(f)
+            if mask is not None:
+                with open(self.part(name, "mask.npy"), "ab") as f:
+                    mask.tofile(f)
+            self.segments[name].append(
+                    (values.dtype, len(values), mask is not None))
+        self.nrows += len(dat)
+        return self
+
+    def close(self):
+        meta = {"nrows": self.nrows, "columns": []}
+        for name in self.columns or []:
+            # chunks can differ in dtype, e.g. if one has missing values
+            segments = self.segments[name]
+            dtype = np.result_type(*[d for d, n, m in segments])
+            self.write_part(name, "npy", dtype, 
+                    [(d, n, True) for d, n, m in segments])
+            info = {"name": name, **self.cats.get(name, {})}
+            if any(m for d, n, m in segments):
+                # chunks without missing values have no mask
+                self.write_part(name, "mask.npy", np.bool_, 
+                        [(np.bool_, n, m) for d, n, m in segments])
+                info["nullable"] = True
+            meta["columns"].append(info)
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def write_part(self, name, ext, dtype, segments):
+        """ Write a .part file to a .npy file of dtype, segments without
+        data in the .part file are left as zeros """
+        fname = os.path.join(self.path, f"{name}.{ext}")
+        if self.nrows == 0:
+            np.save(fname, np.empty(0, dtype = dtype))
+        else:
+            out = np.lib.format.open_memmap(fname, mode = "w+",
+                    dtype = dtype, shape = (self.nrows,))
+            k = 0
+            with open(self.part(name, ext), "rb") as f:
+                for d, n, stored in segments:
+                    if stored:
+                        out[k:k + n] = np.fromfile(f, dtype = d, count = n)
+                    else:
+                        out[k:k + n] = 0
+                    k += n
+            out.flush()
+            del out
+        if os.path.exists(self.part(name, ext)):
+            os.remove(self.part(name, ext))
+
+def write_cols(dat, path):
+    """
+    Write a dataframe to a column cache, see ColWriter
+
+    Parameters
+    ----------
+    dat : pandas dataframe
+    path : str
+        name of the folder
+    """
+    ColWriter(path).append(dat).close()
+
+def sort_cols(path, by):
+    """
+    Sort the rows of a column cache in place, one column at a time
+
+    Parameters
+    ----------
+    path : str
+        name of the folder
+    by : list
+        names of the columns to sort by
+    """
+    keys = read_cols(path, by)
+    keys = [keys[c].cat.codes if isinstance(keys[c].dtype, pd.CategoricalDtype)
+            else keys[c].to_numpy(dtype = np.float64, na_value = np.nan) 
+            if masked_values(keys[c])[1] is not None
+            else keys[c] for c in by]
+    order = np.lexsort([np.asarray(k) for k in reversed(keys)])
+    del keys
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    for info in meta["columns"]:
+        exts = ["npy", "mask.npy"] if info.get("nullable") else ["npy"]
+        for ext in exts:
+            fname = os.path.join(path, f"{info['name']}.{ext}")
+            np.save(fname, np.load(fname)[order])
+
+def read_cols(path, columns = None, mmap = True):
+    """
+    Read a dataframe from a column cache written by write_cols
+
+    Parameters
+    ----------
+    path : str
+        name of the folder
+    columns : list
+        read only these columns, default is all columns
+    mmap : bool 
+        memory-map the numeric columns instead of reading them
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    info = {c["name"]: c for c in meta["columns"]}
+    if columns is None:
+        columns = list(info.keys())
+    dat = {}
+    for name in columns:
+        if name not in info:
+            raise KeyError(f"ahri: column {name} not in {path}")
+        values = np.load(os.path.join(path, f"{name}.npy"),
+                mmap_mode = "r" if mmap else None)
+        if "categories" in info[name]:
+            values = pd.Categorical.from_codes(np.asarray(values),
+                    info[name]["categories"], ordered = info[name]["ordered"])
+        elif info[name].get("nullable"):
+            mask = np.load(os.path.join(path, f"{name}.mask.npy"))
+            values = masked_array(values, mask)
+        dat[name] = values
+    return(pd.DataFrame(dat, columns = columns, copy = False))
+
+
+
+def fingerprint(path, hash_content = False, hashes = None):
+    """
+    Fingerprint a file, or each file in a folder, by name, size and 
+    modification time, and optionally a hash of the contents
+
+    Parameters
+    ----------
+    path : str
+    hash_content : bool
+    hashes : dict
+        content hashes by name, size and modification time, so that an
+        unchanged file is only hashed once
+    """
+    if os.path.isdir(path):
+        return [fingerprint(os.path.join(path, f), hash_content, hashes) 
+                for f in sorted(os.listdir(path))]
+    st = os.stat(path)
+    res = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    if hash_content:
+        key = tuple(res)
+        if hashes is None or key not in hashes:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            if hashes is None:
+                hashes = {}
+            hashes[key] = sha.hexdigest()
+        res.append(hashes[key])
+    return res
+
+def args_key(args, fields = ("years", "age", "ageby", "agecat", "sex",
+        "drop_tasp", "area", "drop_bsid", "file_format")):
+    """
+    A hash of the SetArgs fields that change the derived datasets
+
+    Parameters
+    ----------
+    args : object
+        a SetArgs object
+    fields : list
+        names of the fields to hash
+    """
+    def canon(x):
+        if isinstance(x, dict):
+            return {str(k): canon(v) for k, v in x.items()}
+        if isinstance(x, (np.ndarray, list, tuple)):
+            return [canon(v) for v in x]
+        if isinstance(x, np.generic):
+            return x.item()
+        return x
+    vals = {f: canon(getattr(args, f, None)) for f in fields}
+    text = json.dumps(vals, sort_keys = True, default = str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def std_table(args):
+    """
+    Lookup tables for the age, sex and year standardization: the lower
+    and upper age bounds indexed by the Female code, with a flag for the
+    codes that are kept, and a year membership table starting at the
+    first year
+
+    Parameters
+    ----------
+    args : object
+        a SetArgs object
+    """
+    sdict = {"Fem": 1, "Mal": 0}
+    ncode = max(list(sdict.values()) + list(args.sex.values())) + 1
+    keep = np.zeros(ncode, dtype = bool)
+    lo = np.full(ncode, -np.inf)
+    hi = np.full(ncode, np.inf)
+    for s, code in args.sex.items():
+        keep[code] = True
+        if s in args.age:
+            lo[code], hi[code] = args.age[s]
+    years = np.asarray(args.years, dtype = np.int64)
+    ymin = years.min() if len(years) else 0
+    ytab = np.zeros(years.max() - ymin + 1 if len(years) else 0, 
+            dtype = bool)
+    ytab[years - ymin] = True
+    return {"keep": keep, "lo": lo, "hi": hi, "ymin": ymin, "ytab": ytab}
+
+
+def std_mask(table, female, age, year):
+    """
+    Mask of the rows inside the age, sex and year ranges of a std_table.
+    Rows with a missing age are kept, rows with a missing sex or year are 
+    dropped. Works on NumPy arrays, so it can be applied to chunks of rows 
+    as they are read.
+
+    Parameters
+    ----------
+    table : dict
+        from std_table
+    female : array
+        the Female codes
+    age : array
+    year : array
+    """
+    female = np.asarray(female, dtype = np.float64)
+    age = np.asarray(age, dtype = np.float64)
+    year = np.asarray(year, dtype = np.float64)
+    ncode = len(table["keep"])
+    mask = (female >= 0) & (female < ncode) & (female == np.floor(female))
+    code = np.where(mask, female, 0).astype(np.intp)
+    mask &= table["keep"][code]
+    mask &= ~(age < table["lo"][code]) & ~(age > table["hi"][code])
+    yidx = year - table["ymin"]
+    mask &= (yidx >= 0) & (yidx < len(table["ytab"])) & \
+        (yidx == np.floor(yidx))
+    yidx = np.where(mask, yidx, 0).astype(np.intp)
+    mask &= table["ytab"][yidx] if len(table["ytab"]) else False
+    return mask
+
 
 class DataProc:
     """
     A class that provides methods to read in the standard AHRI .dta files
-    (Stata files) and write them to .pkl format.
+    (Stata files) and write them to .pkl format. The processed datasets
+    have the compact dtypes of schema, with dates as days since 
+    date_origin.
 
     Attributes
     ----------
@@ -26,6 +461,12 @@ class DataProc:
         read in the Bounded Structures .dta dataset
     """
 
+    # names of the Surveillance variables in the .dta file
+    epi_names = {
+        'IndividualId':'IIntID', 'LocationId':'BSIntID', 
+        'CalendarYear': 'Year', 'Sex':'Female', 'Days':'ExpDays', 
+        'StartDate':'ObservationStart', 'EndDate':'ObservationEnd'}
+
     def __init__(self, args):
         """ 
         Parameters
@@ -35,42 +476,132 @@ class DataProc:
         """
         self.args = args
 
-    def proc_bst_dta(self, write_pkl = True):
+    def write_data(self, dat, name):
+        """ Write a processed dataset in the format set by args.file_format
+        
+        Parameters
+        ----------
+        dat : pandas dataframe
+        name : str 
+            "hiv", "epi" or "bst"
+        """
+        if self.args.file_format == "col":
+            path = getattr(self.args, f"{name}_col")
+            write_cols(dat, path)
+        else:
+            path = getattr(self.args, f"{name}_pkl")
+            dat.to_pickle(path)
+        if self.args.verbose:
+            print(f"File saved to {path}\n")
+
+    def read_dta(self, path, columns, chunksize = None):
+        """ Read columns of a .dta dataset, in chunks of rows if chunksize
+        is given
+
+        Parameters
+        ----------
+        path : str
+        columns : list
+        chunksize : int
+        """
+        prof = self.args.profiler
+        name = os.path.basename(path)
+        if chunksize is None:
+            with stage(prof, "read_dta", file = name) as rec:
+                dat = pd.read_stata(path, columns = columns)
+                rec["rows_out"] = len(dat)
+            yield dat
+            return
+        with pd.read_stata(path, columns = columns, 
+                chunksize = chunksize) as reader:
+            reader = iter(reader)
+            while True:
+                with stage(prof, "read_dta", file = name) as rec:
+                    dat = next(reader, None)
+                    rec["rows_out"] = 0 if dat is None else len(dat)
+                if dat is None:
+                    return
+                yield dat
+
+    def std_chunks(self, chunks):
+        """ Keep the rows of each chunk inside the age, sex and year ranges
+        of args, as set_data does. The area is not standardized here.
+
+        Parameters
+        ----------
+        chunks : iterable
+            processed chunks of the HIV or Surveillance dataset
+        """
+        table = std_table(self.args)
+        for dat in chunks:
+            yield dat[std_mask(table, dat["Female"], dat["Age"], 
+                dat["Year"])]
+
+    def stream_data(self, chunks, name, sort_by = None, write_pkl = True):
+        """ Write processed chunks as they are read. With a column cache 
+        only one chunk is held in memory and the cache is returned
+        memory-mapped; a .pkl file needs the whole dataset in memory.
+        Categorical variables keep all the value labels of the .dta file
+        as categories.
+
+        Parameters
+        ----------
+        chunks : iterable
+            processed chunks of a dataset
+        name : str 
+            "hiv", "epi" or "bst"
+        sort_by : list
+            columns to sort the dataset by
+        write_pk : bool
+        """
+        if write_pkl and self.args.file_format == "col":
+            path = getattr(self.args, f"{name}_col")
+            writer = ColWriter(path)
+            for dat in chunks:
+                writer.append(dat)
+            writer.close()
+            if sort_by is not None:
+                sort_cols(path, sort_by)
+            if self.args.verbose:
+                print(f"File saved to {path}\n")
+            return(read_cols(path))
+        dat = pd.concat(list(chunks))
+        if sort_by is not None:
+            dat = dat.sort_values(sort_by)
+        if write_pkl:
+            self.write_data(dat, name)
+        return(dat)
+
+    def proc_bst_dta(self, write_pkl = True, chunksize = None):
         """ Read in the Bounded Structures .dta dataset, harmonize variable
         names. 
 
         Parameters
         ----------
         write_pk : bool :
-            write the file to .pkl
+            write the file to .pkl, or to a column cache if
+            args.file_format is "col"
+        chunksize : int
+            read and write the dataset in chunks of this many rows
         """
         # Pandas throws an error for Isigodi
         dcols = ["BSIntId", "PIPSA", "IsUrbanOrRural"]
-        dat = pd.read_stata(self.args.bst_dta, columns = dcols) 
-        dat = dat.rename(columns = {'BSIntId': 'BSIntID'})
+        chunks = (compact(dat.rename(columns = {'BSIntId': 'BSIntID'}))
+                for dat in self.read_dta(self.args.bst_dta, dcols, chunksize))
+        if chunksize is not None:
+            return(self.stream_data(chunks, "bst", write_pkl = write_pkl))
+        dat = next(chunks)
         if write_pkl:
-            dat.to_pickle(self.args.bst_pkl)
-            if self.args.verbose:
-                print(f"File saved to {self.args.bst_pkl}\n")
+            self.write_data(dat, "bst")
         return(dat)
 
-    def proc_hiv_dta(self, write_pkl = True):
-        """ 
-        Read in the HIV .dta dataset, keep subset of HIV test variables,
-        harmonize variable names, drop irregular values for Men/Women,
-        keep only valid HIV test results, write the .pkl file
-
+    def proc_hiv_chunk(self, hiv):
+        """ Harmonize variable names and values of rows of the HIV dataset
+        
         Parameters
         ----------
-        write_pk : bool :
-            write the file to .pkl
+        hiv : pandas dataframe
         """
-
-        dcols = ["IIntId", "ResidencyBSIntId", "VisitDate",
-              "HIVResult", "Sex", "AgeAtVisit"]
-        # if (addvars is not None):
-            # dcols = dcols.append(addvars)
-        hiv = pd.read_stata(self.args.hiv_dta, columns = dcols)
         hiv = hiv.rename(columns = {
           'IIntId':'IIntID',
           'ResidencyBSIntId':'BSIntID',
@@ -78,50 +609,102 @@ class DataProc:
           'Sex':'Female'})
         hiv = hiv[hiv.Female.isin(['Female', 'Male'])]
         hiv = hiv.assign(Female = (hiv.Female=='Female').astype(int))
-        hiv = hiv.sort_values(['IIntID', 'VisitDate'])
         hiv = hiv[hiv.HIVResult.isin(['Negative', 'Positive'])]
         hiv['HIVNegative'] = hiv.VisitDate[hiv.HIVResult == 'Negative']
         hiv['HIVPositive'] = hiv.VisitDate[hiv.HIVResult == 'Positive']
         hiv['Year'] = pd.DatetimeIndex(hiv.VisitDate).year
+        return(compact(hiv))
+
+    def proc_hiv_dta(self, write_pkl = True, chunksize = None, 
+            standardize = False):
+        """ 
+        Read in the HIV .dta dataset, keep subset of HIV test variables,
+        harmonize variable names, drop irregular values for Men/Women,
+        keep only valid HIV test results, write the .pkl file
+
+        Parameters
+        ----------
+        write_pk : bool :
+            write the file to .pkl, or to a column cache if
+            args.file_format is "col"
+        chunksize : int
+            read and write the dataset in chunks of this many rows
+        standardize : bool
+            keep only the ages, sexes and years set in args, chunk by chunk
+        """
+
+        dcols = ["IIntId", "ResidencyBSIntId", "VisitDate",
+              "HIVResult", "Sex", "AgeAtVisit"]
+        # if (addvars is not None):
+            # dcols = dcols.append(addvars)
+        sort_by = ['IIntID', 'VisitDate']
+        chunks = (self.proc_hiv_chunk(hiv) 
+                for hiv in self.read_dta(self.args.hiv_dta, dcols, chunksize))
+        if standardize:
+            chunks = self.std_chunks(chunks)
+        if chunksize is not None:
+            return(self.stream_data(chunks, "hiv", sort_by, write_pkl))
+        hiv = next(chunks).sort_values(sort_by)
         if write_pkl:
-            hiv.to_pickle(self.args.hiv_pkl)
-            if self.args.verbose:
-                print(f"File saved to {self.args.hiv_pkl}\n")
+            self.write_data(hiv, "hiv")
         return(hiv)
 
-    def proc_epi_dta(self, addvars = None, write_pkl = True):     
+    def proc_epi_chunk(self, dat, dcols):
+        """ Harmonize variable names and values of rows of the 
+        Surveillance dataset
+        
+        Parameters
+        ----------
+        dat : pandas dataframe
+        dcols : list
+            variables to keep
+        """
+        dat = dat.rename(columns = self.epi_names)
+        dat = dat[dcols]
+        dat = dat[dat.Female.isin(['Female', 'Male'])]
+        dat = dat.assign(Female = (dat.Female=='Female').astype(int))
+        return(compact(dat))
+
+    def proc_epi_dta(self, addvars = None, write_pkl = True, chunksize = None,
+            standardize = False):
         """ 
         Read in the Surveillance .dta dataset, keep subset of variables,
         harmonize variable names, drop irregular values for Men/Women,
-        write the .pkl file
+        write the .pkl file. Only the kept variables are read from the
+        .dta file.
 
         Parameters
         ----------
         addvars: list 
             add variables to the subset of variables selected from the .dta dataset
         write_pk : bool :
-            write the file to .pkl
+            write the file to .pkl, or to a column cache if
+            args.file_format is "col"
+        chunksize : int
+            read and write the dataset in chunks of this many rows, 
+            which bounds the memory used with a column cache
+        standardize : bool
+            keep only the ages, sexes and years set in args, chunk by chunk
         """
 
         if self.args.verbose:
             print("Reading data, this may take time...")
-        dat = pd.read_stata(self.args.epi_dta)
-        dat = dat.rename(columns = {
-            'IndividualId':'IIntID', 'LocationId':'BSIntID', 
-            'CalendarYear': 'Year', 'Sex':'Female', 'Days':'ExpDays', 
-            'StartDate':'ObservationStart', 'EndDate':'ObservationEnd'})
         dcols = ['IIntID', 'BSIntID', 'Female', 'ObservationStart',
                 'ObservationEnd', 'Year', 'Age', 'DoB'] 
         if (addvars is not None):
             dcols = [dcols, addvars]
             dcols = [col for slist in dcols for col in slist]
-        dat = dat[dcols]
-        dat = dat[dat.Female.isin(['Female', 'Male'])]
-        dat = dat.assign(Female = (dat.Female=='Female').astype(int))
+        dta_names = {v: k for k, v in self.epi_names.items()}
+        vcols = [dta_names.get(col, col) for col in dcols]
+        chunks = (self.proc_epi_chunk(dat, dcols) 
+                for dat in self.read_dta(self.args.epi_dta, vcols, chunksize))
+        if standardize:
+            chunks = self.std_chunks(chunks)
+        if chunksize is not None:
+            return(self.stream_data(chunks, "epi", write_pkl = write_pkl))
+        dat = next(chunks)
         if write_pkl:
-            dat.to_pickle(self.args.epi_pkl)
-            if self.args.verbose:
-                print(f"File saved to {self.args.epi_pkl}\n")
+            self.write_data(dat, "epi")
         return(dat)
 
 
@@ -137,6 +720,12 @@ class DataMethods:
     set_data(self, dat)
         method to standardize transformation of the datasets
 
+    drop_tasp(self, dat, bdat)
+        drop the observations from the Northern (TasP) areas
+
+    drop_area(self, dat, bsid)
+        drop the observations from a sorted array of BSIntIDs
+
     get_repeat_testers(self, dat = None)
         method to create dataset of HIV repeat-testers
 
@@ -149,12 +738,27 @@ class DataMethods:
     get_birth_year(self)
         get the year of birth from the HIV and Surveillance .pkl datasets
 
+    get_birth_date(self)
+        get the date of birth from the Surveillance .pkl dataset
+
     calc_age_cat(self, dat, name)
         calculate age categories 
 
     get_pop_n(self)
         get number of all participants under surveillance by year and age group
 
+    get_resident_bsid(self, dat)
+        get the BSIntID of each individual at the latest HIV visit
+
+    strata_levels(self, by)
+        get the levels of the stratification variables
+
+    strata_codes(self, dat, by, levels)
+        get the stratum code of each row
+
+    get_pop_cells(self, by, levels, years, agecat = None)
+        get number of participants by stratum, year and age group
+
     """
 
     def __init__(self, args):
@@ -165,6 +769,184 @@ class DataMethods:
             a SetArgs object
         """
         self.args = args 
+        self._hashes = {}
+
+    def read_data(self, name, columns = None):
+        """
+        Read a processed dataset in the format set by args.file_format
+
+        Parameters
+        ----------
+        name : str
+            "hiv", "epi" or "bst"
+        columns : list
+            columns to read from a column cache. A .pkl file is always
+            read in full.
+        """
+        with stage(self.args.profiler, "read", data = name) as rec:
+            if self.args.file_format == "col":
+                dat = read_cols(getattr(self.args, f"{name}_col"), columns)
+            else:
+                dat = pd.read_pickle(getattr(self.args, f"{name}_pkl"))
+            rec["rows_out"] = len(dat)
+        return dat
+
+    def derived_key(self, fields = None):
+        """
+        Key of a derived dataset: a hash of the input file fingerprints
+        and of the SetArgs fields it depends on
+
+        Parameters
+        ----------
+        fields : list
+            the SetArgs fields, default is all fields used by args_key
+        """
+        ext = "col" if self.args.file_format == "col" else "pkl"
+        files = [fingerprint(getattr(self.args, f"{name}_{ext}"), 
+            self.args.cache_hash, self._hashes) 
+            for name in ["bst", "hiv", "epi"]]
+        akey = args_key(self.args) if fields is None else \
+            args_key(self.args, fields)
+        text = json.dumps([files, akey])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def load_derived(self, name, key = None):
+        """
+        Load a derived dataset from args.cache_dir, None if not cached
+
+        Parameters
+        ----------
+        name : str
+        key : str
+            the derived_key of the dataset, default is derived_key()
+        """
+        if self.args.cache_dir is None:
+            return None
+        key = self.derived_key() if key is None else key
+        path = os.path.join(self.args.cache_dir, key, f"{name}.pkl")
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def save_derived(self, name, dat, key = None):
+        """
+        Save a derived dataset to args.cache_dir 
+
+        Parameters
+        ----------
+        name : str
+        dat : object
+            a dataframe, or any object that can be pickled
+        key : str
+            the derived_key of the dataset, default is derived_key()
+        """
+        if self.args.cache_dir is None:
+            return
+        key = self.derived_key() if key is None else key
+        path = os.path.join(self.args.cache_dir, key)
+        os.makedirs(path, exist_ok = True)
+        # write to a temporary file, so other processes never load a 
+        # partly written dataset
+        fd, tmp = tempfile.mkstemp(dir = path, prefix = f"{name}.", 
+                suffix = ".tmp")
+        os.close(fd)
+        try:
+            pd.to_pickle(dat, tmp)
+            os.replace(tmp, os.path.join(path, f"{name}.pkl"))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def make_derived(self, name, fun, fields = None):
+        """
+        Load a derived dataset from args.cache_dir, or compute and save it
+
+        Parameters
+        ----------
+        name : str
+        fun : function
+            computes the dataset
+        fields : list
+            the SetArgs fields the dataset depends on, see derived_key
+        """
+        # a dataset computed from an assigned dataset is not in the cache
+        if self.args.cache_dir is None or self.assigned_upstream(name):
+            return fun()
+        key = self.derived_key(fields)
+        dat = self.load_derived(name, key)
+        if dat is None:
+            dat = fun()
+            self.save_derived(name, dat, key)
+        return dat
+
+    def tasp_bsid(self, bdat):
+        """
+        Sorted BSIntIDs of the Northern (TasP) areas
+
+        Parameters
+        ---------
+        bdat : pandas dataframe
+            a pandas dataframe from self.bst_data
+        """
+        pipsa = bdat["PIPSA"]
+        north = pipsa.notna() & ~pipsa.isin(["Southern PIPSA"])
+        return np.unique(bdat["BSIntID"][north].to_numpy(dtype = np.float64, 
+            na_value = np.nan))
+
+    def area_bsid(self, bdat):
+        """
+        Sorted BSIntIDs dropped by the drop_tasp, area and drop_bsid 
+        arguments. BSIntIDs with an unknown PIPSA or area are kept.
+
+        Parameters
+        ---------
+        bdat : pandas dataframe
+            a pandas dataframe from self.bst_data
+        """
+        bsid = [np.empty(0)]
+        if self.args.drop_tasp:
+            bsid.append(self.tasp_bsid(bdat))
+        if self.args.area is not None:
+            area = bdat["IsUrbanOrRural"]
+            drop = area.notna() & ~area.isin(self.args.area)
+            bsid.append(bdat["BSIntID"][drop].to_numpy(dtype = np.float64, 
+                na_value = np.nan))
+        if self.args.drop_bsid is not None:
+            bsid.append(np.asarray(self.args.drop_bsid, dtype = np.float64))
+        return np.unique(np.concatenate(bsid))
+
+    def memo(self, name, fun, fields = None):
+        """Compute a dataset, SetData keeps it until its SetArgs change"""
+        return fun()
+
+    def assigned_upstream(self, name):
+        """Datasets are only assigned in SetData"""
+        return False
+
+    @property
+    def excluded_bsid(self):
+        return self.memo("excluded_bsid", 
+                lambda: self.area_bsid(self.bst_data))
+
+    def drop_area(self, dat, bsid):
+        """
+        Method to drop the observations from a sorted array of BSIntIDs,
+        with a membership test on BSIntID. The index is reset before the
+        observations are dropped, as with a merge.
+
+        Parameters
+        ---------
+        dat : pandas dataframe
+            a pandas dataframe
+        bsid : array
+            sorted BSIntIDs, from tasp_bsid or area_bsid
+        """
+        dat = dat.reset_index(drop = True)
+        if len(bsid) == 0:
+            return dat
+        x = dat["BSIntID"].to_numpy(dtype = np.float64, na_value = np.nan)
+        found = id_lookup(bsid, np.ones(len(bsid), bool), x, fill = False)
+        return dat[~found]
 
     def drop_tasp(self, dat, bdat):
         """
@@ -179,12 +961,7 @@ class DataMethods:
             a pandas dataframe from self.bst_data
 
         """
-        bdat = bdat[["BSIntID", "PIPSA"]]
-        dat = pd.merge(dat, bdat, on="BSIntID", how="left")
-        dat = dat[dat["PIPSA"].isin(["Southern PIPSA", np.nan])]
-        dat = dat.drop(["PIPSA"], axis=1)
-        return dat
-
+        return self.drop_area(dat, self.tasp_bsid(bdat))
 
     def set_data(self, dat):
         """
@@ -196,16 +973,14 @@ class DataMethods:
             a pandas dataframe
         """
 
-        dat = dat[dat.Female.isin(list(self.args.sex.values()))]
-        for s in self.args.age.keys():
-            dat = dat[
-                ~((dat.Female == self.args.sex[s]) &
-                    (dat.Age < self.args.age[s][0])) &  
-                ~((dat.Female == self.args.sex[s]) &
-                    (dat.Age > self.args.age[s][1])) & 
-                dat.Year.isin(self.args.years)]
-        if (self.args.drop_tasp): 
-          dat = self.drop_tasp(dat, self.bst_data)
+        with stage(self.args.profiler, "set_data", len(dat)) as rec:
+            mask = std_mask(std_table(self.args), dat["Female"], 
+                    dat["Age"], dat["Year"])
+            dat = dat[mask]
+            if (self.args.drop_tasp or self.args.area is not None or 
+                    self.args.drop_bsid is not None): 
+              dat = self.drop_area(dat, self.excluded_bsid)
+            rec["rows_out"] = len(dat)
         return(dat)
 
     def get_dates(self, dat, var, name, f):
@@ -217,7 +992,7 @@ class DataMethods:
         dat : pandas dataframe
             name of dataset
         var : pd.datetime
-            variable of dates
+            variable of dates, or of days since date_origin
         name : str
             new name of new variable
         f : function
@@ -226,6 +1001,7 @@ class DataMethods:
         dat = dat[['IIntID', var]].dropna(subset=[var])
         dat = dat.groupby(['IIntID'], as_index=False)[var].agg(f)
         dat.columns = ['IIntID', name]
+        dat[name] = to_dates(dat[name])
         return dat
 
     def get_repeat_testers(self, dat):
@@ -240,29 +1016,35 @@ class DataMethods:
             a dataframe from from self.hiv_data
         """
 
-        obs_start = self.get_dates(dat, "HIVNegative", "obs_start", f = min)
-        early_pos = self.get_dates(dat, "HIVPositive", "early_pos", f = min)
-        late_neg = self.get_dates(dat, "HIVNegative", "late_neg", f = max)
-        late_pos = self.get_dates(dat, "HIVPositive", "late_pos", f = max)
-        dat = dat[['IIntID', 'Female']].drop_duplicates()
-        dfs = [dat, obs_start, late_neg, early_pos, late_pos]
-        dt = reduce(lambda left,right: \
-        pd.merge(left,right,on='IIntID', how='left'), dfs)
-        # drop if late neg after early pos
-        dt['late_neg_after'] = (dt.late_neg > dt.early_pos) & \
-        pd.notna(dt.late_neg) & pd.notna(dt.early_pos)
-        rt = dt[dt.late_neg_after==False]. \
-        drop(['late_neg_after', 'late_pos'], axis=1)
-        # drop if no neg test
-        rt = rt[-(pd.isna(rt.obs_start) & pd.isna(rt.late_neg))] 
-        # drop if only 1 neg test and no pos test
-        rt = rt[-((rt.obs_start == rt.late_neg) & pd.isna(rt.early_pos))]
-        rt['sero_event'] = pd.notna(rt.early_pos).astype(int)
+        with stage(self.args.profiler, "get_repeat_testers", 
+                len(dat)) as rec:
+            # one groupby for the earliest/latest neg and pos dates
+            dates = dat.groupby('IIntID').agg(
+                obs_start = ('HIVNegative', 'min'),
+                late_neg = ('HIVNegative', 'max'),
+                early_pos = ('HIVPositive', 'min'),
+                late_pos = ('HIVPositive', 'max'))
+            dates = dates.apply(to_dates)
+            dt = dat[['IIntID', 'Female']].drop_duplicates()
+            dt = dt.join(dates, on = 'IIntID').reset_index(drop = True)
+            # drop if late neg after early pos
+            dt['late_neg_after'] = (dt.late_neg > dt.early_pos) & \
+            pd.notna(dt.late_neg) & pd.notna(dt.early_pos)
+            rt = dt[dt.late_neg_after==False]. \
+            drop(['late_neg_after', 'late_pos'], axis=1)
+            # drop if no neg test
+            rt = rt[-(pd.isna(rt.obs_start) & pd.isna(rt.late_neg))] 
+            # drop if only 1 neg test and no pos test
+            rt = rt[-((rt.obs_start == rt.late_neg) & pd.isna(rt.early_pos))]
+            rt['sero_event'] = pd.notna(rt.early_pos).astype(int)
+            rec["rows_out"] = len(rt)
         return(rt)
 
     def get_birth_year(self):
         """
-        Get birthdates from the combined HIV and Surveillance .pkl datasets
+        Get birthdates from the combined HIV and Surveillance .pkl datasets,
+        the earliest birth year of each IIntID. The datasets are not 
+        changed.
 
         Parameters
         ----------
@@ -270,16 +1052,49 @@ class DataMethods:
         """
 
         edat = self.epi_data
-        edat["BirthYear"] = pd.DatetimeIndex(edat["DoB"]).year
-        edat = edat[["IIntID", "BirthYear"]]
+        edat = pd.DataFrame({"IIntID": edat["IIntID"],
+            "BirthYear": date_year(edat["DoB"])})
         hdat = self.hiv_data
-        hdat["BirthYear"] = pd.DatetimeIndex(hdat.VisitDate).year - hdat.Age
-        hdat = hdat[["IIntID", "BirthYear"]]
+        hdat = pd.DataFrame({"IIntID": hdat["IIntID"],
+            "BirthYear": date_year(hdat["VisitDate"]) - hdat["Age"]})
         dat = pd.concat([edat, hdat], axis = 0)
-        dat = dat.sort_values(["IIntID", "BirthYear"])
-        dat = dat.groupby(["IIntID"]).first()
+        dat = dat.groupby(["IIntID"]).min()
         return dat
 
+    def get_birth_date(self):
+        """
+        Get the date of birth of each IIntID, as days since date_origin,
+        from the Surveillance .pkl dataset. The earliest DoB is kept.
+
+        Parameters
+        ----------
+        None
+        """
+        edat = self.epi_data[["IIntID", "DoB"]].dropna(subset = ["DoB"])
+        edat = edat.assign(DoB = to_days(edat["DoB"]))
+        dat = edat.groupby("IIntID")["DoB"].min()
+        return dat.astype(np.float64)
+
+    def lookup_birth_year(self, ids):
+        """
+        Look up the birth year of each IIntID in self.birth_year, NaN if
+        the IIntID is not found
+
+        Parameters
+        ----------
+        ids : array
+            IIntID values
+        """
+        byear = self.birth_year
+        row = id_lookup(byear.index.to_numpy(), np.arange(len(byear)), 
+                np.asarray(ids))
+        if len(byear) == 0:
+            return np.full(len(row), np.nan)
+        res = byear.to_numpy()[row]
+        if (row < 0).any():
+            res = np.where(row >= 0, res, np.nan)
+        return res
+
     def calc_age(self, dat, ref_time, name = "Age"):
         """
         Calculate the age in years with respect to a reference time. 
@@ -288,14 +1103,15 @@ class DataMethods:
         ----------
         dat : pandas dataframe
         ref_time : obj : 
-            a datetime object from which the year can be extracted
+            a column of dates, or of days since date_origin
         name : str
             name of the new age variable
         """
-        bdat = self.get_birth_year()
-        dat = pd.merge(dat,  bdat, on = "IIntID", how = "left")
-        dat[name] = (pd.DatetimeIndex(
-            dat[ref_time]).year - dat["BirthYear"])
+        with stage(self.args.profiler, "calc_age", len(dat)) as rec:
+            byear = self.lookup_birth_year(dat["IIntID"])
+            dat = dat.assign(BirthYear = byear).reset_index(drop = True)
+            dat[name] = date_year(dat[ref_time]) - dat["BirthYear"]
+            rec["rows_out"] = len(dat)
         return dat
 
     def calc_age_cat(self, dat, name = "AgeCat"):
@@ -333,12 +1149,133 @@ class DataMethods:
             .reset_index()
         return dat
 
+    def get_resident_bsid(self, dat):
+        """
+        The BSIntID of each individual at the latest HIV visit with a
+        known BSIntID, indexed by IIntID
+
+        Parameters
+        ----------
+        dat : pandas dataframe
+            a dataframe from self.hiv_data
+        """
+        dat = dat[["IIntID", "VisitDate", "BSIntID"]].dropna(
+                subset = ["BSIntID"])
+        dat = dat.sort_values(["IIntID", "VisitDate"], kind = "stable")
+        dat = dat.drop_duplicates("IIntID", keep = "last")
+        return dat.set_index("IIntID")["BSIntID"]
+
+    def strata_levels(self, by):
+        """
+        The levels of each stratification variable: the Female codes of
+        args.sex, or the categories of an area variable of self.bst_data
+
+        Parameters
+        ----------
+        by : list
+            names of the variables, from strata_vars
+        """
+        levels = []
+        for var in by:
+            if var not in strata_vars:
+                raise ValueError(f"ahri: cannot stratify by {var}, use "
+                    f"one of {strata_vars}")
+            if var == "Female":
+                levels.append(np.unique(list(self.args.sex.values())))
+            else:
+                levels.append(np.asarray(
+                    pd.Categorical(self.bst_data[var]).categories))
+        return levels
+
+    def strata_codes(self, dat, by, levels):
+        """
+        The stratum code of each row, numbered in the order of the levels
+        of the by variables, with -1 for rows with a missing or unknown
+        value. The area variables are looked up by BSIntID in
+        self.bst_data.
+
+        Parameters
+        ----------
+        dat : pandas dataframe
+            a dataframe with Female and BSIntID columns
+        by : list
+            names of the variables
+        levels : list
+            from strata_levels
+        """
+        n = len(dat)
+        code = np.zeros(n, dtype = np.int64)
+        ok = np.ones(n, dtype = bool)
+        if any(var != "Female" for var in by):
+            bdat = self.bst_data
+            keys = bdat["BSIntID"].to_numpy(dtype = np.float64,
+                    na_value = np.nan)
+            x = dat["BSIntID"].to_numpy(dtype = np.float64,
+                    na_value = np.nan)
+            row = id_lookup(keys, np.arange(len(keys)), x)
+            ok &= row >= 0
+        for var, lev in zip(by, levels):
+            if var == "Female":
+                x = dat["Female"].to_numpy(dtype = np.float64,
+                        na_value = np.nan)
+            else:
+                cat = pd.Categorical(bdat[var], categories = lev)
+                x = cat.codes[row].astype(np.float64)
+                x[x < 0] = np.nan
+                lev = np.arange(len(lev))
+            pos = id_lookup(lev, np.arange(len(lev)), x)
+            ok &= pos >= 0
+            code = code * len(lev) + pos
+        return np.where(ok, code, -1)
+
+    def get_pop_cells(self, by, levels, years, agecat = None):
+        """
+        Get number of all participants under surveillance by stratum, year
+        and age group, as a stratum by year by age category array. The
+        stratum of a participant in a year is taken from the first
+        surveillance episode of the year.
+
+        Parameters
+        ----------
+        by : list
+            names of the stratification variables
+        levels : list
+            from strata_levels
+        years : array
+            the years of the array
+        agecat : list
+            the age intervals, default is args.agecat
+        """
+        dat = self.epi_data
+        dat = dat[["IIntID", "Year", "Age", "Female", "BSIntID",
+            "ObservationStart"]]
+        dat = dat.sort_values(["IIntID", "ObservationStart"],
+                kind = "stable")
+        dat = dat.drop_duplicates(["IIntID", "Year"])
+        code = self.strata_codes(dat, by, levels)
+        agecat = np.asarray(self.args.agecat if agecat is None else agecat)
+        age = dat["Age"].to_numpy(dtype = np.float64, na_value = np.nan)
+        # intervals are closed on the left, as in calc_age_cat
+        cat = np.searchsorted(agecat, age, side = "right") - 1
+        ncat = len(agecat) - 1
+        yidx = np.searchsorted(years, dat["Year"].to_numpy())
+        yidx = yidx.clip(max = len(years) - 1)
+        keep = (code >= 0) & (cat >= 0) & (cat < ncat) & \
+            (years[yidx] == dat["Year"].to_numpy())
+        nstrata = int(np.prod([len(lev) for lev in levels]))
+        cell = np.ravel_multi_index((code[keep], yidx[keep], cat[keep]),
+                (nstrata, len(years), ncat))
+        pop = np.bincount(cell, minlength = nstrata * len(years) * ncat)
+        return pop.reshape(nstrata, len(years), ncat)
+
 
 class SetData(DataMethods):
     """
     A class that provides methods to read in the standard AHRI .dta files
     (Stata files), write them to .pkl format, and standardize data
-    transformations across the datatsets.
+    transformations across the datatsets. The datasets are read and 
+    transformed when first used, and again after the SetArgs values that
+    they depend on change.
 
     Attributes
     ----------
@@ -353,17 +1290,176 @@ class SetData(DataMethods):
     bst_data 
        the bounded structures dataset, needed to drop PIP areas
 
+    excluded_bsid
+       the sorted BSIntIDs dropped by the area arguments
+
+    repeat_tester_data
+       the HIV repeat-testers, with Age at the latest HIV-negative date
+
+    birth_year
+       the birth year of each individual, indexed by IIntID
+
+    birth_date
+       the DoB of each individual as days since date_origin, indexed by 
+       IIntID
+
+    columns
+       the columns read from a column cache by dataset name, a dataset
+       not listed is read in full
+
+    core_cols
+       the columns of the hiv and epi datasets used by the incidence
+       calculations, to pass as columns
+
     """
 
-    def __init__(self, args):
+    core_cols = {"hiv": ["IIntID", "BSIntID", "VisitDate", "Female", "Age",
+            "HIVNegative", "HIVPositive", "Year"],
+        "epi": ["IIntID", "BSIntID", "Female", "ObservationStart", 
+            "Year", "Age", "DoB"]}
+    path_fields = ["hiv_dta", "epi_dta", "bst_dta", "hiv_pkl", "epi_pkl", 
+            "bst_pkl", "hiv_col", "epi_col", "bst_col"]
+    bst_fields = ["file_format"] + path_fields
+    area_fields = ["drop_tasp", "area", "drop_bsid"] + bst_fields
+    data_fields = ["years", "age", "sex"] + area_fields
+    # the SetArgs fields each memoized dataset depends on, datasets not
+    # listed depend on all fields used by args_key
+    memo_fields = {"bst_data": bst_fields, "excluded_bsid": area_fields,
+            "hiv_data": data_fields, "epi_data": data_fields,
+            "birth_year": data_fields, "birth_date": data_fields,
+            "repeat_tester_data": data_fields}
+    # the memoized datasets computed from each dataset, dropped when it
+    # is assigned
+    memo_deps = {"bst_data": ["excluded_bsid"],
+            "excluded_bsid": ["hiv_data", "epi_data"],
+            "hiv_data": ["birth_year", "repeat_tester_data"],
+            "epi_data": ["birth_year", "birth_date"],
+            "birth_year": ["repeat_tester_data"]}
+
+    def __init__(self, args, columns = None):
+        """
+        Parameters
+        ----------
+        args : object
+            a SetArgs object
+        columns : dict
+            the columns to read from a column cache, by dataset name 
+            ("hiv", "epi" or "bst"), such as core_cols. Default reads all
+            columns, as from a .pkl file.
+        """
         super().__init__(args)
         self.args = args
-        self.bst_data = pd.read_pickle(self.args.bst_pkl) 
-        self.hiv_data = self.set_data(pd.read_pickle(self.args.hiv_pkl))
-        self.epi_data = self.set_data(pd.read_pickle(self.args.epi_pkl))
+        self.columns = dict(columns or {})
+        self._memo = {}
+
+    def __copy__(self):
+        # a copy keeps its own datasets, so assigning one does not change
+        # the datasets of the original
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._memo = dict(self._memo)
+        return new
+
+    def memo(self, name, fun, fields = None):
+        """
+        Return a memoized dataset, computed again with fun if the SetArgs
+        values have changed since it was stored
+
+        Parameters
+        ----------
+        name : str
+        fun : function
+            computes the dataset
+        fields : list
+            the SetArgs fields the dataset depends on, default is 
+            memo_fields[name], or all fields used by args_key
+        """
+        key = self.memo_key(name, fields)
+        if name not in self._memo or self._memo[name][0] != key:
+            self._memo[name] = (key, fun(), False)
+        return self._memo[name][1]
+
+    def memo_key(self, name, fields = None):
+        fields = self.memo_fields.get(name) if fields is None else fields
+        return args_key(self.args) if fields is None else \
+            args_key(self.args, fields)
+
+    def set_memo(self, name, dat):
+        """Assign a dataset, and drop the datasets computed from it"""
+        self._memo[name] = (self.memo_key(name), dat, True)
+        self.drop_memo(name)
+
+    def drop_memo(self, name):
+        for dep in self.memo_deps.get(name, []):
+            self._memo.pop(dep, None)
+            self.drop_memo(dep)
+
+    def assigned_upstream(self, name):
+        """
+        Check if a dataset that name is computed from was assigned, and
+        is still used for the current SetArgs values
+
+        Parameters
+        ----------
+        name : str
+        """
+        for up, deps in self.memo_deps.items():
+            if name not in deps:
+                continue
+            entry = self._memo.get(up)
+            if entry is not None and entry[2] and \
+                    entry[0] == self.memo_key(up):
+                return True
+            if self.assigned_upstream(up):
+                return True
+        return False
+
+    def make_repeat_testers(self):
         rtdat  = self.get_repeat_testers(self.hiv_data)
-        self.repeat_tester_data = self.calc_age(rtdat, ref_time = "late_neg")
+        return self.calc_age(rtdat, ref_time = "late_neg")
+
+    @property
+    def bst_data(self):
+        return self.memo("bst_data", 
+                lambda: self.read_data("bst", self.columns.get("bst")))
+
+    @bst_data.setter
+    def bst_data(self, dat):
+        self.set_memo("bst_data", dat)
+
+    @property
+    def hiv_data(self):
+        return self.memo("hiv_data", 
+                lambda: self.set_data(self.read_data("hiv", self.columns.get("hiv"))))
+
+    @hiv_data.setter
+    def hiv_data(self, dat):
+        self.set_memo("hiv_data", dat)
+
+    @property
+    def epi_data(self):
+        return self.memo("epi_data", 
+                lambda: self.set_data(self.read_data("epi", self.columns.get("epi"))))
+
+    @epi_data.setter
+    def epi_data(self, dat):
+        self.set_memo("epi_data", dat)
 
+    @property
+    def birth_year(self):
+        return self.memo("birth_year", 
+                lambda: self.get_birth_year()["BirthYear"])
 
+    @property
+    def birth_date(self):
+        return self.memo("birth_date", self.get_birth_date)
 
+    @property
+    def repeat_tester_data(self):
+        return self.memo("repeat_tester_data", lambda: self.make_derived(
+            "repeat_tester_data", self.make_repeat_testers, 
+            self.memo_fields["repeat_tester_data"]))
 
+    @repeat_tester_data.setter
+    def repeat_tester_data(self, dat):
+        self.set_memo("repeat_tester_data", dat)
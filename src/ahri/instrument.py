@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+class Profiler:
+    """
+    Collect wall time, CPU time, rows in and out, and peak memory of the
+    stages of the incidence pipeline. Set it with args.update_profiler to
+    instrument DataProc, SetData and CalcInc. Each finished stage is a
+    record that is kept and passed to the hooks.
+
+    Stages are read_dta, read, set_data, get_repeat_testers, calc_age,
+    prep_for_imp, strata, impute, pre_split, split, aggregate, 
+    calc_gamma, imputations (a whole random-point run), bootstrap and
+    est_combine. The split 
+    stage is the fused split and aggregate kernel cypy.agg_split; 
+    aggregate is the Year by AgeCat table of agg_data.
+
+    Attributes
+    ----------
+    records : list
+        a dict per finished stage, with the keys stage, wall, cpu,
+        rows_in, rows_out, peak_mb and pid, plus any stage information
+        such as the dataset name or the imputation index
+    workers : bool
+        also time the stages of each random-point imputation, in the
+        pool workers, and collect their records
+    memory : bool
+        trace the peak memory (MB) of each stage with tracemalloc,
+        which slows down the stages. Memory of pool workers is not
+        traced.
+
+    Methods
+    -------
+    stage(self, name, rows_in = None, **info)
+        a context manager that times a stage and yields its record
+    add(self, record)
+        keep a record and pass it to the hooks
+    add_hook(self, hook)
+        call hook(record) for each finished stage
+    summary(self)
+        totals by stage
+    dump(self, path)
+        write the records and the summary to a .json file
+    """
+
+    def __init__(self, hooks = None, workers = False, memory = False):
+        """
+        Parameters
+        ----------
+        hooks : list
+            functions called with each finished record
+        workers : bool
+            time each imputation in the pool workers
+        memory : bool
+            trace the peak memory of each stage
+        """
+        self.records = []
+        self.hooks = list(hooks or [])
+        self.workers = workers
+        self.memory = memory
+        # peak memory of the open stages, so nested stages add up
+        self._peaks = []
+        self._trace = False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return self
+
+    def add(self, record):
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    @contextmanager
+    def stage(self, name, rows_in = None, **info):
+        rec = {"stage": name, "rows_in": rows_in, "rows_out": None, **info}
+        if self.memory:
+            if not self._peaks:
+                # stop tracing at the end only if it was started here
+                self._trace = not tracemalloc.is_tracing()
+                if self._trace:
+                    tracemalloc.start()
+            else:
+                self._peaks[-1] = max(self._peaks[-1],
+                        tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield rec
+        finally:
+            rec["wall"] = time.perf_counter() - t0
+            rec["cpu"] = time.process_time() - c0
+            rec["peak_mb"] = None
+            if self.memory:
+                peak = max(self._peaks.pop(),
+                        tracemalloc.get_traced_memory()[1])
+                rec["peak_mb"] = peak / 2**20
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                elif self._trace:
+                    tracemalloc.stop()
+            rec["pid"] = os.getpid()
+            self.add(rec)
+
+    def summary(self):
+        """Totals by stage: number of calls, wall and CPU seconds, rows in
+        and out, and the largest peak memory"""
+        cols = ["stage", "wall", "cpu", "rows_in", "rows_out", "peak_mb"]
+        dat = pd.DataFrame(self.records, columns = cols)
+        dat = dat.groupby("stage", sort = False).agg(
+                calls = ("wall", "size"), wall = ("wall", "sum"),
+                cpu = ("cpu", "sum"), rows_in = ("rows_in", "sum"),
+                rows_out = ("rows_out", "sum"), peak_mb = ("peak_mb", "max"))
+        return dat.reset_index()
+
+    def dump(self, path):
+        """Write the records and the summary to a .json file"""
+        out = {"records": self.records,
+                "summary": self.summary().to_dict(orient = "records")}
+        with open(path, "w") as f:
+            json.dump(out, f, indent = 1, default = to_json)
+
+
+def to_json(x):
+    """NumPy scalars as Python numbers, anything else as a string"""
+    return x.item() if hasattr(x, "item") else str(x)
+
+
+@contextmanager
+def stage(prof, name, rows_in = None, **info):
+    """
+    Time a stage with prof.stage, or do nothing if prof is None
+
+    Parameters
+    ----------
+    prof : object
+        a Profiler, or None
+    name : str
+        name of the stage
+    rows_in : int
+        rows going into the stage
+    info :
+        other information to keep in the record
+    """
+    if prof is None:
+        yield {}
+        return
+    with prof.stage(name, rows_in, **info) as rec:
+        yield rec
@@ -1,49 +1,146 @@
-import re
+import io
 import os
+import time
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
+from ahri.dataproc import SetData, to_days, date_origin
+
+# the unireg executable bundled with ahri
+unireg_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+        "unireg")
 
 class ReadUniReg:
-    def __init__(self, infile):
-        with open(infile) as f:
-            self.temp = [l.strip() for l in f if l.strip()]
-        # get start line of each result
-        self.slines = [i for i, ln in enumerate(self.temp)
-                if re.search("(Covariate|(Cov|V)ariance|Hazard)", ln)]
+    """
+    Read the output file of unireg. One pass over the file finds the byte
+    offset of each section, and stops at the hazard, which runs to the end
+    of the file. A section is parsed with NumPy when it is first asked 
+    for, or when it is named in sections.
+
+    Attributes
+    ----------
+    offsets : dict
+        the start and end byte of each section, the end of the hazard is
+        None (end of file)
+
+    Methods
+    -------
+    estimates(self)
+        the regression estimates, by covariate
+    covariance(self)
+        the variance or covariance matrix of the estimates
+    hazard(self)
+        the cumulative hazard, by time
+    """
+
+    section_names = ("estimates", "covariance", "hazard")
+
+    def __init__(self, infile, sections = None):
+        """
+        Parameters
+        ----------
+        infile : str
+            path to the unireg output file
+        sections : list
+            sections to read now, from estimates, covariance and hazard
+        """
+        self.infile = os.path.abspath(infile)
+        self.offsets = find_sections(infile)
+        self._sections = {}
+        for name in sections or []:
+            self.section(name)
+
+    def section(self, name):
+        """Parse a section once and keep it"""
+        if name not in self.section_names:
+            raise ValueError(f"ahri: unknown UniReg section {name}")
+        if name not in self._sections:
+            start, end = self.offsets[name]
+            with open(self.infile, "rb") as f:
+                f.seek(start)
+                if name == "hazard":
+                    dat = read_hazard(f)
+                elif name == "estimates":
+                    dat = read_estimates(f.read(end - start).decode())
+                else:
+                    dat = read_covariance(f.read(end - start).decode())
+            self._sections[name] = dat
+        return self._sections[name]
 
     def covariance(self):
-        offset = 0 if re.search("^Variance", self.temp[self.slines[1]]) != None else 1
-        dat = self.temp[self.slines[1] + offset:self.slines[2]]
-        dat = [re.sub(":", "", i) for i in dat]
-        dat = [ln.split("\t") for ln in dat]
-        # Add covariate label to make ncol equal
-        dat[0].insert(0, "Covariate")
-        dat = pd.DataFrame(dat[1:], columns = dat[0])
-        dat.set_index("Covariate", inplace = True)
-        dat = dat.astype(np.float64)
-        return dat
+        return self.section("covariance")
 
     def hazard(self):
-        dat = self.temp[self.slines[2] + 1:]
-        dat = [ln.split("\t") for ln in dat]
-        dat = pd.DataFrame(dat[1:], columns = dat[0])
-        dat = dat.astype(np.float64)
-        return dat
+        return self.section("hazard")
 
     def estimates(self):
-        # estimates
-        dat = self.temp[self.slines[0]:self.slines[1]]
-        dat = [ln.split("\t") for ln in dat]
-        dat = pd.DataFrame(dat[1:], columns = dat[0])
-        dat.set_index("Covariate", inplace = True)
-        dat = dat.astype(np.float64)
-        return dat
+        return self.section("estimates")
+
+
+def find_sections(infile):
+    """The byte offsets of the sections of a unireg output file"""
+    starts = {}
+    pos = 0
+    with open(infile, "rb") as f:
+        for ln in f:
+            if ln.startswith(b"Covariate\t"):
+                starts["estimates"] = pos
+            elif ln.startswith((b"Variance", b"Covariance")):
+                starts["covariance"] = pos
+            elif b"Hazard" in ln:
+                starts["hazard_title"] = pos
+                starts["hazard"] = pos + len(ln)
+                break
+            pos += len(ln)
+    if len(starts) < 4:
+        raise ValueError(f"ahri: {infile} is not a unireg output file")
+    return {"estimates": (starts["estimates"], starts["covariance"]),
+        "covariance": (starts["covariance"], starts["hazard_title"]),
+        "hazard": (starts["hazard"], None)}
+
+
+def read_estimates(block):
+    dat = np.loadtxt(io.StringIO(block), delimiter = "\t", dtype = str,
+            ndmin = 2)
+    dat = pd.DataFrame(dat[1:, 1:].astype(np.float64), 
+            columns = dat[0, 1:], index = pd.Index(dat[1:, 0], 
+                name = dat[0, 0]))
+    return dat
+
+
+def read_covariance(block):
+    # the title, a header of covariates for a matrix, then a row by 
+    # covariate with a tab before the covariate name
+    title, body = block.split("\n", 1)
+    if title.startswith("Variance"):
+        cols = ["Variance"]
+    else:
+        header, body = body.split("\n", 1)
+        cols = header.strip().split("\t")
+    dat = np.loadtxt(io.StringIO(body), delimiter = "\t", dtype = str,
+            ndmin = 2)
+    dat = pd.DataFrame(dat[:, 2:].astype(np.float64), columns = cols,
+            index = pd.Index(np.char.rstrip(dat[:, 1], ":"), 
+                name = "Covariate"))
+    return dat
+
+
+def read_hazard(f):
+    cols = f.readline().decode().strip().split("\t")
+    dat = np.loadtxt(f, delimiter = "\t", dtype = np.float64, ndmin = 2)
+    return pd.DataFrame(dat, columns = cols)
 
-tt = ReadUniReg(infile = "/home/alain/Seafile/Heidelberg/Projects/Inc4/data/res_dat_2.txt")
-tt = ReadUniReg(infile = "/home/alain/Seafile/AHRI_Data/intcens/res_dat_mnth.txt")
 
 class UniReg(ReadUniReg):
+    """
+    A UniReg model: the arguments of one run of the unireg executable.
+    After run, the model also reads its output file as a ReadUniReg, and
+    keeps the exit code, stdout, stderr, run time and any error of the 
+    run.
+    """
+
     def __init__(self,
         xpath, root, input, output, model, 
         convergence_threshold = 0.01,
@@ -58,11 +155,16 @@ class UniReg(ReadUniReg):
         self.subject_id = subject_id
         self.inf_char = inf_char
         self.r = r
+        self.returncode = None
+        self.stdout = self.stderr = self.error = None
+        self.elapsed = None
+        self.offsets = None
+        self._sections = {}
 
-    def run(self):
+    def command(self):
         cmd = [self.xpath, 
-            "--in", os.path.join(self.root, self.input), 
-            "--out", os.path.join(self.root, self.output), 
+            "--in", os.path.abspath(os.path.join(self.root, self.input)), 
+            "--out", os.path.abspath(os.path.join(self.root, self.output)), 
             "--model",  self.model,
             "--sep", '" "',
             "--inf_char", f'"{self.inf_char}"',
@@ -71,16 +173,299 @@ class UniReg(ReadUniReg):
         if self.subject_id != None:
             cmd.append("--subject_id")
             cmd.append(f"{self.subject_id}")
-        subprocess.Popen(cmd)
-        #
-        # ReadUniReg.__init__(self, os.path.join(self.root, self.output))
+        return cmd
+
+    def section(self, name):
+        """Parse a section of the output, once the model has run"""
+        if self.offsets is None:
+            if self.error is not None:
+                raise RuntimeError(f"ahri: {self.output}: {self.error}")
+            raise RuntimeError("ahri: run the UniReg model before reading "
+                "its output")
+        return super().section(name)
+
+    def run(self, timeout = None, check = True):
+        """
+        Run unireg, wait for it to finish and read the output file
+
+        Parameters
+        ----------
+        timeout : float
+            seconds before unireg is stopped, None waits
+        check : bool
+            raise a RuntimeError if unireg fails, otherwise the error is
+            kept in self.error
+        """
+        self.returncode = None
+        self.stdout = self.stderr = self.error = None
+        self.offsets = None
+        self._sections = {}
+        t0 = time.perf_counter()
+        try:
+            res = subprocess.run(self.command(),
+                    capture_output = True, text = True, timeout = timeout)
+            self.returncode = res.returncode
+            self.stdout, self.stderr = res.stdout, res.stderr
+            # unireg reports its errors on stdout
+            errors = [ln.strip() for ln in (res.stdout + res.stderr)
+                    .splitlines() if ln.strip().startswith("ERROR")]
+            if res.returncode != 0 or errors:
+                self.error = "\n".join(errors) or \
+                    f"unireg exited with code {res.returncode}"
+        except subprocess.TimeoutExpired as e:
+            self.stdout, self.stderr = e.stdout, e.stderr
+            self.error = f"unireg timed out after {timeout} s"
+        except OSError as e:
+            self.error = str(e)
+        self.elapsed = time.perf_counter() - t0
+        if self.error is None:
+            try:
+                ReadUniReg.__init__(self, os.path.join(self.root, 
+                    self.output))
+            except (OSError, ValueError) as e:
+                self.error = f"cannot read {self.output}: {e}"
+        if self.error is not None and check:
+            raise RuntimeError(f"ahri: {self.output}: {self.error}")
+        return self
+
+
+def _run_model(model, timeout):
+    return model.run(timeout = timeout, check = False)
+
+
+class UniRegRunner:
+    """
+    Run a batch of UniReg models concurrently. Each model runs unireg in
+    its own process, at most mcores at a time, which threads wait on. 
+    The exit code, stderr, run time and any error (a failed run or a 
+    timeout) of each model are kept, and the output of each finished 
+    model is read with ReadUniReg.
+
+    Methods
+    -------
+    run(self, models)
+        run the models and return them in the same order
+    summary(self, models)
+        the output, exit code, run time and error of each model
+    estimates(self, models)
+        the regression estimates of the models that finished
+    """
+
+    def __init__(self, root, xpath = None, mcores = None, timeout = None,
+            **defaults):
+        """
+        Parameters
+        ----------
+        root : str
+            folder of the input and output files
+        xpath : str
+            path to the unireg executable, default is the one bundled 
+            with ahri
+        mcores : int
+            number of models run at a time, default is the number of cores
+        timeout : float
+            seconds before a model is stopped, None waits
+        defaults :
+            UniReg arguments for all models, e.g. subject_id
+        """
+        self.root = root
+        self.xpath = unireg_path if xpath is None else xpath
+        self.mcores = os.cpu_count() if mcores is None else mcores
+        self.timeout = timeout
+        self.defaults = defaults
+
+    def make_model(self, spec):
+        """A UniReg model from a dict of UniReg arguments, with the 
+        defaults of the runner"""
+        if isinstance(spec, UniReg):
+            return spec
+        args = {"xpath": self.xpath, "root": self.root, **self.defaults, 
+                **spec}
+        return UniReg(**args)
+
+    def run(self, models):
+        """
+        Parameters
+        ----------
+        models : list
+            UniReg models, or dicts of UniReg arguments, which need at 
+            least input, output and model
+        """
+        models = [self.make_model(x) for x in models]
+        outs = [os.path.join(x.root, x.output) for x in models]
+        if len(set(outs)) < len(outs):
+            raise ValueError("ahri: models must have different output files")
+        with ThreadPoolExecutor(max_workers = self.mcores) as pool:
+            return list(pool.map(partial(_run_model, 
+                timeout = self.timeout), models))
+
+    def summary(self, models):
+        return pd.DataFrame({
+            "output": [x.output for x in models],
+            "model": [x.model for x in models],
+            "returncode": [x.returncode for x in models],
+            "elapsed": [x.elapsed for x in models],
+            "error": [x.error for x in models]})
+
+    def estimates(self, models):
+        res = [x.estimates().reset_index().assign(output = x.output)
+                for x in models if x.error is None]
+        if not res:
+            return pd.DataFrame()
+        return pd.concat(res, ignore_index = True)
+
+
+def unireg_panel(rtdat, dob, origin = 0):
+    """
+    The repeat-testers as UniReg panel data: a row at the first and last
+    negative test (Status 0) and at the first positive test (Status 1) of
+    each IIntID, with the Examination_Time in years since origin and the 
+    Age at each test. A repeat-tester with no positive test is right 
+    censored at the last negative test. Repeat-testers with no date of
+    birth are dropped.
+
+    Parameters
+    ----------
+    rtdat : pandas dataframe
+        a dataframe from repeat_tester_data
+    dob : array
+        date of birth of each row of rtdat, in days since date_origin
+    origin : int
+        time 0, in days since date_origin
+    """
+    days = np.column_stack([to_days(rtdat[x]).to_numpy(np.float64, 
+        na_value = np.nan) for x in ("obs_start", "late_neg", "early_pos")])
+    dob = np.asarray(dob, dtype = np.float64)
+    keep = ~np.isnan(days) & ~np.isnan(dob)[:, None]
+    keep[:, 1] &= days[:, 1] != days[:, 0]
+    # row-major, so the tests of each IIntID are in order
+    row, col = np.nonzero(keep)
+    day = days[row, col]
+    return pd.DataFrame({
+        "Subject_ID": rtdat["IIntID"].to_numpy()[row],
+        "Examination_Time": (day - origin) / 365.25,
+        "Status": (col == 2).astype(np.int8),
+        "Age": (day - dob[row]) / 365.25,
+        "Female": rtdat["Female"].to_numpy()[row].astype(np.int8)})
+
+
+def write_unireg(dat, path, chunk = 500000, digits = 4):
+    """
+    Write a dataframe as a UniReg input file, space separated with a 
+    header. Each chunk of rows is formatted with one format string and
+    written at once to a buffered file.
+
+    Parameters
+    ----------
+    dat : pandas dataframe
+        UniReg data, such as from unireg_panel
+    path : str
+        path to the input file
+    chunk : int
+        rows formatted at a time
+    digits : int
+        decimals of the float columns
+    """
+    cols = [dat[x].to_numpy() for x in dat.columns]
+    fmt = " ".join("%d" if x.dtype.kind in "biu" else f"%.{digits}f" 
+            for x in cols) + "\n"
+    with open(path, "w", buffering = 2**20) as f:
+        f.write(" ".join(dat.columns) + "\n")
+        for i in range(0, len(dat), chunk):
+            n = min(chunk, len(dat) - i)
+            vals = [None] * (n * len(cols))
+            for j, x in enumerate(cols):
+                vals[j::len(cols)] = x[i:i + n].tolist()
+            f.write((fmt * n) % tuple(vals))
+    return path
+
+
+class IntCens(SetData):
+    """
+    A class that exports the repeat-testers of SetData to UniReg, for 
+    interval-censored regression of the time to seroconversion.
+
+    Methods
+    -------
+    get_birth_days(self, ids)
+        date of birth of each IIntID
+    unireg_data(self, origin = None)
+        the repeat-testers as UniReg panel data
+    unireg(self, root, input, output, model, xpath, chunk, **kwargs)
+        write the UniReg input file and return its UniReg model
+    """
+
+    def __init__(self, args, columns = None):
+        SetData.__init__(self, args, columns)
+
+    def get_birth_days(self, ids):
+        """
+        Date of birth of each IIntID, in days since date_origin, from
+        self.birth_date, or from the middle of the birth year if there is
+        no date of birth. NaN if neither is known.
+
+        Parameters
+        ----------
+        ids : array
+            IIntID values
+        """
+        bdate = self.birth_date
+        dob = bdate.reindex(ids).to_numpy(np.float64)
+        byear = self.lookup_birth_year(ids)
+        fill = np.isnan(dob) & ~np.isnan(byear)
+        jan1 = (byear[fill] - 1970).astype("datetime64[Y]").astype(
+                "datetime64[D]") - np.datetime64(date_origin, "D")
+        dob[fill] = jan1.astype(np.float64) + 182
+        return dob
+
+    def unireg_data(self, origin = None):
+        """
+        The repeat-testers as UniReg panel data, see unireg_panel
 
+        Parameters
+        ----------
+        origin : str
+            date of time 0, default is 1 January of the first year of
+            args.years
+        """
+        if origin is None:
+            origin = f"{int(np.min(self.args.years))}-01-01"
+        origin = (np.datetime64(origin, "D") - 
+                np.datetime64(date_origin, "D")).astype(np.int64)
+        rtdat = self.repeat_tester_data
+        return unireg_panel(rtdat, self.get_birth_days(rtdat["IIntID"]),
+                origin)
 
-tt = UniReg(
-    xpath = "/home/alain/Seafile/Programs/Python/library/ahri_dev/src/ahri/unireg",
-    root = "/home/alain/Seafile/Programs/R/IntCens/IntCens2",
-    input = "time_dep_cov.txt",
-    output = "res_data1.txt",
-    model = "(Examination_Time, Status) = Age", 
-    subject_id= "Subject_ID", inf_char = "inf")
+    def unireg(self, root, input = "unireg_in.txt", 
+            output = "unireg_out.txt",
+            model = "(Examination_Time, Status) = Age + Female",
+            xpath = None, chunk = 500000, origin = None, **kwargs):
+        """
+        Write the repeat-testers to a UniReg input file and return the
+        UniReg model of the file, to run or to pass to a UniRegRunner
 
+        Parameters
+        ----------
+        root : str
+            folder of the input and output files
+        input : str
+            name of the input file
+        output : str
+            name of the output file
+        model : str
+            UniReg model
+        xpath : str
+            path to the unireg executable, default is the one bundled 
+            with ahri
+        chunk : int
+            rows written at a time
+        origin : str
+            date of time 0, see unireg_data
+        kwargs :
+            other UniReg arguments
+        """
+        write_unireg(self.unireg_data(origin), os.path.join(root, input), 
+                chunk = chunk)
+        xpath = unireg_path if xpath is None else xpath
+        return UniReg(xpath, root, input, output, model, 
+                subject_id = "Subject_ID", **kwargs)
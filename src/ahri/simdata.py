@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+
+class SimData:
+    """
+    A class that simulates the HIV, Surveillance and Bounded Structures
+    .dta datasets, with the AHRI variable names and value labels, at any
+    number of individuals. Individuals enter and leave surveillance,
+    live in one bounded structure, are offered an HIV test at yearly
+    visits and may seroconvert, so the datasets run through DataProc,
+    SetData and CalcInc like the released ones.
+
+    Methods
+    -------
+    sim_bst(self)
+        simulate the Bounded Structures dataset
+    sim_people(self, start, n)
+        simulate individuals start + 1 to start + n
+    sim_hiv(self, people)
+        simulate the HIV visits of individuals
+    sim_epi(self, people)
+        simulate the yearly surveillance episodes of individuals
+    write_dta(self)
+        write the three .dta datasets to the args paths
+    """
+
+    def __init__(self, args, n = 1000, seed = None, nbs = None,
+            years = None, chunk = 100000):
+        """
+        Parameters
+        ----------
+        args : object
+            a SetArgs object, the datasets are written to args.hiv_dta,
+            args.epi_dta and args.bst_dta
+        n : int
+            number of individuals
+        seed : int
+            seed of the simulation, None draws fresh entropy
+        nbs : int
+            number of bounded structures, default is one per 4
+            individuals
+        years : list
+            years under surveillance, default is args.years
+        chunk : int
+            individuals simulated at a time
+        """
+        self.args = args
+        self.n = n
+        self.seed = seed
+        self.nbs = max(1, n // 4) if nbs is None else nbs
+        years = args.years if years is None else years
+        self.start = np.datetime64(f"{int(np.min(years))}-01-01")
+        self.end = np.datetime64(f"{int(np.max(years))}-12-31")
+        self.chunk = chunk
+        self.rng = np.random.default_rng(seed)
+        self.bsid = np.sort(self.rng.choice(np.arange(1, 10 * self.nbs + 1),
+            self.nbs, replace = False)).astype(np.int32)
+
+    def sim_bst(self):
+        rng = self.rng
+        dat = pd.DataFrame({
+            "BSIntId": self.bsid,
+            "PIPSA": pd.Categorical(rng.choice(
+                ["Southern PIPSA", "Northern PIPSA"], self.nbs,
+                p = [0.8, 0.2]), ["Southern PIPSA", "Northern PIPSA"]),
+            "IsUrbanOrRural": pd.Categorical(rng.choice(
+                ["Rural", "Peri-Urban", "Urban"], self.nbs,
+                p = [0.6, 0.3, 0.1]), ["Peri-Urban", "Rural", "Urban"])})
+        return(dat)
+
+    def sim_people(self, start, n):
+        rng = self.rng
+        span = int((self.end - self.start) / np.timedelta64(1, "D"))
+        # half are under surveillance from the start, half enter later
+        entry = np.where(rng.random(n) < 0.5, 0,
+                rng.integers(0, int(span * 0.8) + 1, n))
+        exit = np.minimum(entry + rng.exponential(10 * 365, n)
+                .astype(np.int64) + 180, span)
+        age = rng.uniform(0, 70, n)
+        dob = entry - (age * 365.25).astype(np.int64)
+        # prevalent infections, then a yearly hazard between ages 15 to 50
+        female = rng.random(n) < 0.55
+        hazard = np.where(female, 0.035, 0.02)
+        onset = np.maximum(entry, dob + int(15 * 365.25))
+        sero = onset + (rng.exponential(1, n) / hazard * 365).astype(np.int64)
+        sero[sero > dob + int(50 * 365.25)] = span + 1
+        prev = rng.random(n) < np.where(age > 15, 0.2, 0)
+        sero[prev] = entry[prev] - 1
+        people = pd.DataFrame({
+            "IIntID": np.arange(start + 1, start + n + 1, dtype = np.int32),
+            "Female": female,
+            "BSIntID": rng.choice(self.bsid, n),
+            "Entry": self.start + entry.astype("timedelta64[D]"),
+            "Exit": self.start + exit.astype("timedelta64[D]"),
+            "DoB": self.start + dob.astype("timedelta64[D]"),
+            "Sero": self.start + sero.astype("timedelta64[D]")})
+        return(people)
+
+    def person_years(self, people):
+        """ One row per individual and calendar year under surveillance,
+        with the first and last day of the year under surveillance """
+        y0 = people.Entry.dt.year.to_numpy()
+        y1 = people.Exit.dt.year.to_numpy()
+        nyr = y1 - y0 + 1
+        idx = np.repeat(np.arange(len(people)), nyr)
+        year = y0[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(nyr) - nyr,
+                nyr)
+        jan1 = (year - 1970).astype("datetime64[Y]").astype("datetime64[ns]")
+        dec31 = (year - 1969).astype("datetime64[Y]").astype(
+                "datetime64[ns]") - np.timedelta64(1, "D")
+        first = np.maximum(jan1, people.Entry.to_numpy()[idx])
+        last = np.minimum(dec31, people.Exit.to_numpy()[idx])
+        return(idx, year, first, last)
+
+    def sim_hiv(self, people):
+        rng = self.rng
+        idx, year, first, last = self.person_years(people)
+        days = ((last - first) / np.timedelta64(1, "D")).astype(np.int64)
+        visit = first + (rng.random(len(idx)) * (days + 1)).astype(
+                "timedelta64[D]")
+        dob = people.DoB.to_numpy()[idx]
+        age = ((visit - dob) / np.timedelta64(1, "D") / 365.25).astype(int)
+        tested = (rng.random(len(idx)) < 0.4) & (age >= 15)
+        result = np.where(~tested, "Not applicable",
+                np.where(visit >= people.Sero.to_numpy()[idx],
+                    "Positive", "Negative"))
+        bsid = people.BSIntID.to_numpy()[idx].astype(np.float64)
+        bsid[rng.random(len(idx)) < 0.02] = np.nan
+        dat = pd.DataFrame({
+            "IIntId": people.IIntID.to_numpy()[idx],
+            "ResidencyBSIntId": bsid,
+            "VisitDate": visit,
+            "HIVResult": pd.Categorical(result,
+                ["Negative", "Positive", "Not applicable"]),
+            "Sex": pd.Categorical(np.where(people.Female.to_numpy()[idx],
+                "Female", "Male"), ["Male", "Female"]),
+            "AgeAtVisit": age.astype(np.int32)})
+        return(dat)
+
+    def sim_epi(self, people):
+        idx, year, first, last = self.person_years(people)
+        dob = people.DoB.to_numpy()[idx]
+        dat = pd.DataFrame({
+            "IndividualId": people.IIntID.to_numpy()[idx],
+            "LocationId": people.BSIntID.to_numpy()[idx].astype(np.int32),
+            "Sex": pd.Categorical(np.where(people.Female.to_numpy()[idx],
+                "Female", "Male"), ["Male", "Female"]),
+            "StartDate": first,
+            "EndDate": last,
+            "CalendarYear": year.astype(np.int16),
+            "Age": ((first - dob) / np.timedelta64(1, "D") / 365.25)
+                .astype(np.int16),
+            "DoB": dob,
+            "Days": ((last - first) / np.timedelta64(1, "D") + 1)
+                .astype(np.int16)})
+        return(dat)
+
+    def write_dta(self):
+        """ Write the HIV, Surveillance and Bounded Structures .dta
+        datasets. The individuals are simulated in chunks, but each
+        dataset is written from memory in one piece, as a .dta file 
+        cannot be appended to. The peak memory is about 2 KB per 
+        individual: 0.45 GB at 200k individuals, 2 GB at 1M and 9 GB at 
+        5M. """
+        hiv, epi = [], []
+        for start in range(0, self.n, self.chunk):
+            people = self.sim_people(start, min(self.chunk, self.n - start))
+            hiv.append(self.sim_hiv(people))
+            epi.append(self.sim_epi(people))
+        hiv = pd.concat(hiv, ignore_index = True)
+        epi = pd.concat(epi, ignore_index = True)
+        bst = self.sim_bst()
+        hiv.to_stata(self.args.hiv_dta, write_index = False,
+                convert_dates = {"VisitDate": "td"})
+        epi.to_stata(self.args.epi_dta, write_index = False,
+                convert_dates = {"StartDate": "td", "EndDate": "td",
+                    "DoB": "td"})
+        bst.to_stata(self.args.bst_dta, write_index = False)
+        if self.args.verbose:
+            print(f"Simulated {self.n} individuals, {len(hiv)} HIV visits "
+                f"and {len(epi)} episodes")
+        return(self)
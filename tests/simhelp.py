@@ -0,0 +1,29 @@
+from ahri.args import SetArgs
+from ahri.simdata import SimData
+from ahri.dataproc import DataProc
+
+
+def sim_args(root, n = 1500, sim_seed = 1, **kwargs):
+    """
+    Simulate n individuals with SimData in root, process the .dta datasets
+    with DataProc and return the SetArgs
+
+    Parameters
+    ----------
+    root : str
+        folder of the datasets, such as a temporary folder
+    n : int
+        number of individuals
+    sim_seed : int
+        seed of the simulation
+    kwargs :
+        other SetArgs arguments
+    """
+    args = SetArgs(root = root, verbose = False, **kwargs)
+    args.path_hiv_dta("hiv.dta")
+    args.path_epi_dta("epi.dta")
+    args.path_bst_dta("bst.dta")
+    SimData(args, n = n, seed = sim_seed).write_dta()
+    dread = DataProc(args)
+    dread.proc_bst_dta(); dread.proc_hiv_dta(); dread.proc_epi_dta()
+    return args
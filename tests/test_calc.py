@@ -6,9 +6,16 @@ from ahri.calc import CalcInc
 from ahri import calc
 from ahri import cypy
 from ahri.args import SetArgs
+from ahri.instrument import Profiler
+from simhelp import sim_args
 import numpy as np
 import pandas as pd
 import os 
+import copy
+import tempfile
+from unittest import mock
+import gc
+from multiprocessing import shared_memory
 
 # in ipython run, cd to file and 
 # %run test_calc.py
@@ -33,6 +40,23 @@ class TestAHRI(unittest.TestCase):
 
     # %timeit -n 10000 -r 7 sdat10 = cypy.pre_split(ndat)
 
+    def imp_dtest(self, seed = None, nsim = None, mcores = None, 
+            pop = True):
+        """ A copy of dtest with its own args, the imputation data of 
+        rtdat and, with pop, all population counts set to 1 """
+        dtest = copy.copy(self.dtest)
+        dtest.args = copy.copy(self.dtest.args)
+        if seed is not None:
+            dtest.args.update_seed(seed)
+        if nsim is not None:
+            dtest.args.update_nsim(nsim)
+        if mcores is not None:
+            dtest.args.mcores = mcores
+        dtest.idat = calc.prep_for_imp(self.rtdat.copy())
+        if pop:
+            dtest.pop_n = dtest.pop_n.assign(N = 1)
+        return dtest
+
     def test_pre_split(self):
         ndat0 = self.sdat[0][:, [0, 1, 2,  4, 5]]
         ndat1 = self.sdat[1][:, [0, 1, 6,  4, 5]]
@@ -75,6 +99,28 @@ class TestAHRI(unittest.TestCase):
         self.assertEqual(np.round(res[0], 8), 0.00092305)
         self.assertEqual(np.round(res[1] * 1e6, 7), 0.003919)
 
+    def test_adjust_all(self):
+        rng = np.random.default_rng(5)
+        count = rng.integers(0, 50, (3, 4, 6)).astype(np.intc)
+        pop = rng.integers(0, 500, (3, 4, 6)).astype(np.intc)
+        stpop = rng.uniform(0, 1000, (4, 6))
+        res = cypy.age_adjust_all(count, pop, stpop)
+        self.assertEqual(res.shape, (3, 4, 2))
+        for k in range(3):
+            for y in range(4):
+                ref = cypy.age_adjust(count[k, y], pop[k, y], stpop[y])
+                self.assertTrue(np.allclose(res[k, y], ref))
+        with self.assertRaises(ValueError):
+            cypy.age_adjust_all(count, pop, stpop[:3])
+        years = np.array([2005, 2006, 2007, 2008])
+        pop_dat = np.c_[np.repeat(years, 6), stpop.ravel()]
+        seen = np.ones((3, 4), dtype = bool)
+        seen[1, 2] = False
+        est = calc.calc_gamma_cells(years, count, pop * 365, pop_dat, seen)
+        self.assertEqual(est.shape, (11, 3))
+        self.assertTrue(np.allclose(est[:, 1:], res[seen]))
+        self.assertEqual(est[4:7, 0].tolist(), [2005, 2006, 2008])
+
     def test_rubin(self):
         betas = np.array([-1.128465, -1.096334, -1.123843, -1.114631, -1.096334])
         variances = [0.004627717, 0.004553212, 0.004616816, 0.004595274, 0.004553212]
@@ -84,6 +130,22 @@ class TestAHRI(unittest.TestCase):
         self.assertEqual(np.round(res[3], 6), -1.248716)
         self.assertEqual(np.round(res[4], 6), -0.975127)
 
+    def test_combine(self):
+        rng = np.random.default_rng(2)
+        est = np.c_[np.repeat([2005, 2006, 2007], [5, 1, 3]), 
+                rng.uniform(0, 0.05, 9), rng.uniform(0, 1e-4, 9)]
+        res = calc.est_combine(est[::-1])
+        self.assertEqual(res.Year.tolist(), [2005, 2006, 2007])
+        for k, year in enumerate([2005, 2006, 2007]):
+            x = est[est[:, 0] == year]
+            ref = calc.calc_rubin(x[:, 1], x[:, 2], year)
+            self.assertTrue(np.allclose(res.iloc[k].to_numpy(float), ref))
+        est = np.c_[est[:, 0], np.arange(9) % 2, est[:, 1:]]
+        res = calc.est_combine(est, keys = ["Year", "Female"])
+        self.assertEqual(res.columns.tolist(), 
+                ["Year", "Female", "Rate", "SE", "LCI", "UCI"])
+        self.assertEqual(res.Female.tolist(), [0, 1, 1, 0, 1])
+
     def test_split(self):
         s1 = np.array([153, 254, 2005, 2014, 1, 37], dtype = np.intc)
         res = cypy.split_long(s1)
@@ -116,6 +178,259 @@ class TestAHRI(unittest.TestCase):
         self.assertEqual(res[1, 1], s3[1])
 
 
+    def test_split_data(self):
+        pdat = np.array([[153, 254, 2005, 2014, 1, 37],
+            [153, 254, 2005, 2005, 0, 20],
+            [153, 254, 2005, 2006, 1, 20]], dtype = np.intc)
+        res = cypy.split_data(pdat)
+        self.assertEqual(res.shape[0], 13)
+        self.assertEqual(res.shape[1], 4)
+        self.assertTrue(np.array_equal(res,
+            np.vstack([cypy.split_long(di) for di in pdat])))
+
+
+    def test_agg_cells(self):
+        pdat = np.array([[153, 254, 2005, 2014, 1, 37],
+            [153, 254, 2005, 2005, 0, 20],
+            [153, 254, 2005, 2006, 1, 12]], dtype = np.intc)
+        years, events, days = calc.agg_cells(pdat, np.arange(15, 55, 5))
+        edat = cypy.split_data(pdat)
+        self.assertEqual(years.tolist(), list(range(2005, 2015)))
+        self.assertEqual(events.shape, (10, 7))
+        self.assertEqual(events.sum(), 1)
+        self.assertEqual(events[9, 6], 1)
+        self.assertEqual(days.sum(), edat[edat[:, 3] >= 15, 1].sum())
+        self.assertEqual(days[0, 1], 101)
+        self.assertEqual(days[0, 4], 365 - 153)
+        # the years outside year0 to year0 + nyear are skipped
+        lut, amin = calc.age_lut(np.arange(15, 55, 5))
+        ev, dy, sn = cypy.agg_split(pdat, lut, amin, 2006, 3, 7)
+        self.assertTrue(np.array_equal(dy[0], days[1:4]))
+        self.assertTrue(np.array_equal(sn[0], [1, 1, 1]))
+        self.assertEqual(ev.sum(), 0)
+
+
+    def test_rand_batch(self):
+        dtest = self.imp_dtest()
+        np.random.seed(3)
+        res = dtest.do_rand_batch(5, chunk = 2)
+        np.random.seed(3)
+        idates = calc.imp_random_batch(dtest.idat[1], 5)
+        ref = np.vstack([calc.calc_gamma(dtest.agg_data([dtest.idat[0],
+            np.c_[dtest.idat[1], idates[k]]]), dtest.pop_n) 
+            for k in range(5)])
+        self.assertEqual(res.shape, (75, 3))
+        self.assertTrue(np.array_equal(res, ref))
+
+
+    def test_imp_pool(self):
+        dtest = self.imp_dtest()
+        pool = calc.ImpPool(dtest.idat, dtest.pop_n, 
+                dtest.args.agecat, mcores = 2)
+        try:
+            res = pool.map(4, entropy = 1)
+            self.assertEqual(res.shape, (60, 3))
+            self.assertTrue(pool.matches(dtest.idat, dtest.pop_n,
+                dtest.args.agecat, 2))
+            self.assertTrue(np.array_equal(pool.map(2, 1, start = 2), 
+                res[30:]))
+        finally:
+            pool.close()
+
+
+    def test_shards(self):
+        dtest = self.imp_dtest(seed = 42, nsim = 6)
+        res = dtest.inc_randpoint(batch = True)
+        with tempfile.TemporaryDirectory() as tdir:
+            paths = [os.path.join(tdir, f"shard{i}.npz") for i in range(3)]
+            dtest.inc_shard(4, 6, paths[0], batch = True)
+            dtest.inc_shard(0, 4, paths[1], batch = True)
+            shards = calc.merge_shards(paths[:2])
+            self.assertTrue(res.equals(shards))
+            dtest.inc_shard(5, 6, paths[2], batch = True)
+            with self.assertRaises(ValueError):
+                calc.merge_shards(paths[1:])
+        self.assertTrue(res.equals(dtest.inc_randpoint(batch = True)))
+
+    def test_copy(self):
+        dtest = copy.copy(self.dtest)
+        pop_n, idat = self.dtest.pop_n, self.dtest.idat
+        dtest.pop_n = pop_n.assign(N = 1)
+        dtest.idat = [idat[0][:1], idat[1][:1]]
+        self.assertIs(self.dtest.pop_n, pop_n)
+        self.assertIs(self.dtest.idat, idat)
+
+    def test_memo_fields(self):
+        dtest = CalcInc(copy.deepcopy(self.dtest.args))
+        idat, pop_n = dtest.idat, dtest.pop_n
+        dtest.args.update_ageby(10)
+        self.assertIs(dtest.idat, idat)
+        self.assertIsNot(dtest.pop_n, pop_n)
+        dtest.repeat_tester_data = dtest.repeat_tester_data.iloc[:1]
+        self.assertEqual(len(dtest.idat[0]) + len(dtest.idat[1]), 1)
+
+    def test_pool_release(self):
+        dtest = self.imp_dtest(nsim = 2, mcores = 2, pop = False)
+        dtest.inc_randpoint()
+        names = [shm.name for shm in dtest._pool.blocks]
+        del dtest
+        gc.collect()
+        for name in names:
+            self.assertRaises(FileNotFoundError, 
+                    shared_memory.SharedMemory, name = name)
+
+    def test_profiler(self):
+        prof = Profiler(workers = True, memory = True)
+        seen = []
+        prof.add_hook(seen.append)
+        dtest = self.imp_dtest(seed = 7, nsim = 4, mcores = 2)
+        dtest.args.update_profiler(prof)
+        try:
+            res = dtest.inc_randpoint()
+        finally:
+            dtest.close_pool()
+        self.assertTrue(seen == prof.records)
+        stages = [r["stage"] for r in prof.records]
+        self.assertEqual(stages[-2:], ["imputations", "est_combine"])
+        imps = [r["imp"] for r in prof.records if r["stage"] == "impute"]
+        self.assertEqual(sorted(imps), [0, 1, 2, 3])
+        self.assertEqual(prof.records[-1]["rows_in"], 4 * len(res))
+        self.assertTrue(prof.records[-1]["peak_mb"] > 0)
+        summ = prof.summary().set_index("stage")
+        self.assertEqual(summ.loc["split", "calls"], 4)
+        prof.records = []
+        dtest.args.update_profiler(None)
+        self.assertTrue(res.equals(dtest.inc_randpoint(batch = True)))
+        dtest.close_pool()
+        self.assertEqual(prof.records, [])
+
+
+    def test_strata(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            sargs = sim_args(tdir, sim_seed = 5, seed = 3, nsim = 4, 
+                    drop_tasp = False)
+            dtest = CalcInc(sargs)
+            res = dtest.inc_strata(["Female"], midpoint = True)
+            # a sex stratum is the same as restricting the data to that sex
+            for sex, code in [("Fem", 1), ("Mal", 0)]:
+                targs = copy.deepcopy(sargs)
+                targs.update_age({sex: sargs.age[sex]})
+                ref = CalcInc(targs).inc_midpoint()
+                got = res[res.Female == code].drop(columns = "Female")
+                self.assertTrue(np.allclose(ref.to_numpy(float), 
+                    got.to_numpy(float)))
+            res = dtest.inc_strata(["Female", "IsUrbanOrRural"])
+            self.assertEqual(list(res.columns[:3]), 
+                    ["Year", "Female", "IsUrbanOrRural"])
+            self.assertTrue(res.IsUrbanOrRural.isin(
+                ["Rural", "Peri-Urban", "Urban"]).all())
+            # one stratum left, with the same imputed dates
+            sargs.update_drop_tasp(True)
+            res = dtest.inc_strata(["PIPSA"])
+            ref = dtest.inc_randpoint(batch = True)
+            self.assertTrue((res.PIPSA == "Southern PIPSA").all())
+            self.assertTrue(np.allclose(ref.to_numpy(float), 
+                res.drop(columns = "PIPSA").to_numpy(float)))
+            with self.assertRaises(ValueError):
+                dtest.inc_strata(["Age"])
+
+    def test_boot(self):
+        dtest = self.imp_dtest(seed = 11, nsim = 3, mcores = 2)
+        # the contributions of the individuals add up to the cells
+        lut, amin = calc.age_lut(dtest.args.agecat)
+        ndat = np.array(dtest.idat[0][:, [0, 1, 2, 4, 5]], dtype = np.intc)
+        pdat = cypy.pre_split(ndat)
+        year0 = int(pdat[:, 2].min())
+        nyear = int(pdat[:, 3].max()) - year0 + 1
+        ncat = len(dtest.args.agecat) - 1
+        ev, dy, seen = calc.contrib_cells(ndat, lut, amin, year0, nyear, 
+                ncat)
+        ref = cypy.agg_split(pdat, lut, amin, year0, nyear, ncat)
+        self.assertTrue(np.array_equal(ev.sum(axis = 0).A.ravel(),
+            ref[0].ravel()))
+        self.assertTrue(np.array_equal(dy.sum(axis = 0).A.ravel(),
+            ref[1].ravel()))
+        self.assertTrue(np.array_equal(seen, ref[2][0].astype(bool)))
+        # unit weights give the point estimates in every replicate
+        ones = lambda ncl, entropy, start, stop, method: \
+            np.ones((stop - start, ncl), dtype = np.uint8)
+        with mock.patch.object(calc, "boot_weights", ones):
+            res = dtest.inc_boot(4, batch = True)
+        self.assertTrue(np.allclose(res.Rate, res.LCI))
+        self.assertTrue(np.allclose(res.Rate, res.UCI))
+        res = dtest.inc_boot(20, batch = True)
+        self.assertTrue((res.LCI <= res.UCI).all())
+        self.assertTrue(res[["Year", "Rate"]].equals(
+            dtest.inc_randpoint(batch = True)[["Year", "Rate"]]))
+        try:
+            pool = dtest.inc_boot(20)
+        finally:
+            dtest.close_pool()
+        self.assertTrue(res.equals(pool))
+        with self.assertRaises(ValueError):
+            dtest.inc_boot(2, method = "jackknife", batch = True)
+
+    def test_cube(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            sargs = sim_args(tdir, sim_seed = 2, seed = 8, nsim = 6, 
+                    drop_tasp = False)
+            dtest = CalcInc(sargs)
+            cube = dtest.inc_cube()
+            self.assertEqual(cube.events.shape[:2], (6, 2))
+            self.assertTrue(cube.estimate().equals(
+                dtest.inc_randpoint(batch = True)))
+            self.assertTrue(np.allclose(
+                dtest.inc_cube(midpoint = True).estimate().to_numpy(float),
+                dtest.inc_midpoint().to_numpy(float)))
+            # new age categories are the same as a rebuilt CalcInc
+            targs = copy.deepcopy(sargs)
+            targs.update_ageby(10)
+            ref = CalcInc(targs).inc_randpoint(batch = True)
+            res = cube.estimate(agecat = targs.agecat)
+            self.assertTrue(np.allclose(ref.to_numpy(float), 
+                res.to_numpy(float)))
+            res = cube.sweep([{"age": {"Fem": [15, 24]}, "ageby": 10},
+                {"years": range(2010, 2015)}])
+            self.assertEqual(list(res.columns[:2]), ["Config", "Year"])
+            self.assertEqual(res[res.Config == 1].Year.tolist(), 
+                    list(range(2010, 2015)))
+            # only the person-time of females aged 15 to 24 is kept
+            years, events, days, seen, pop = cube.cells([15, 20, 25], 
+                    {"Fem": [15, 24]})
+            self.assertEqual(days.sum(), cube.days[:, 1, :, 15:25].sum())
+
+    def test_lexis(self):
+        day = lambda x: int((np.datetime64(x) - 
+            np.datetime64("2000-01-01")).astype(int))
+        # born 1990-12-15, followed from 2005-11-01 to 2006-03-01
+        ab = calc.birthdays([day("1990-12-15")], [15, 16, 20])
+        self.assertEqual(ab[0, 0], day("2005-12-15"))
+        leap = calc.birthdays([day("1996-02-29")], [1, 4])
+        self.assertEqual(leap.tolist(), [[day("1997-03-01"), 
+            day("2000-02-29")]])
+        cbreak = calc.period_breaks(2005, 2006)
+        ev, dy, sn = cypy.lexis_split(
+            np.array([day("2005-11-01")], dtype = np.intc),
+            np.array([day("2006-03-01")], dtype = np.intc),
+            np.ones(1, dtype = np.intc), np.zeros(1, dtype = np.intc),
+            cbreak, ab)
+        self.assertEqual(dy[0].tolist(), [[17, 0], [59, 0]])
+        self.assertEqual(ev[0].tolist(), [[0, 0], [1, 0]])
+        self.assertEqual(sn[0].tolist(), [1, 1])
+        with self.assertRaises(ValueError):
+            calc.period_breaks(2005, 2006, 5)
+        # quarters add up to years
+        dtest = self.imp_dtest(seed = 5, nsim = 3, pop = False)
+        starts, ev1, dy1, sn1 = dtest.lexis_cells()
+        starts, ev4, dy4, sn4 = dtest.lexis_cells(4)
+        self.assertEqual(ev4.shape[1], 4 * ev1.shape[1])
+        shape = (3, -1, 4, ev1.shape[2])
+        self.assertTrue(np.array_equal(ev1, ev4.reshape(shape).sum(2)))
+        self.assertTrue(np.array_equal(dy1, dy4.reshape(shape).sum(2)))
+        res = dtest.inc_lexis(4)
+        self.assertEqual(list(res.columns[:2]), ["Year", "Period"])
+        self.assertTrue(res.Period.isin([1, 2, 3, 4]).all())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,18 @@
 import unittest
 import sys
 from ahri import args
+from ahri import dataproc
 from ahri.args import SetFiles, SetArgs
 from ahri.dataproc import DataProc, SetData, DataMethods
+from simhelp import sim_args
+from ahri.instrument import Profiler
+import json
 import numpy as np
 import pandas as pd
 import os
+import tempfile
+import copy
+from unittest import mock
 # import package_resources
 
 # in ipython run
@@ -70,6 +77,16 @@ class TestAHRI(unittest.TestCase):
               [3455, 6496, 9305, 15588, 16563, 17843])
 
 
+    def test_repeat_testers(self):
+        dmeth = DataMethods(self.targs)
+        rtdat = dmeth.get_repeat_testers(self.hdat)
+        self.assertEqual(rtdat.IIntID.tolist(), [740, 795, 800, 1356, 1436])
+        self.assertEqual(rtdat.sero_event.tolist(), [0, 1, 0, 1, 0])
+        late_neg = dmeth.get_dates(self.hdat, "HIVNegative", "late_neg", f = "max")
+        self.assertEqual(rtdat.late_neg.tolist(), late_neg.late_neg.tolist())
+        self.assertEqual(str(rtdat.early_pos[1].date()), "2011-08-20")
+        self.assertTrue(pd.isna(rtdat.early_pos[0]))
+
     def test_get_hiv1(self):
         self.targs.update_years(np.arange(2007, 2015))
         self.targs.update_age({"Fem": [40, 80]})
@@ -121,6 +138,252 @@ class TestAHRI(unittest.TestCase):
             (pop_n.Year == 2004), "N"].tolist(), [2.0])
         self.assertEqual(pop_n.loc[(pop_n.AgeCat.astype(str) == "[15, 35)") &
             (pop_n.Year == 2014), "N"].tolist(), [4.0])
+
+    def test_cols(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            cargs = SetArgs(root = tdir, verbose = False, file_format = "col")
+            for f in ["hiv", "epi", "bst"]:
+                path = getattr(self.targs, f"{f}_dta")
+                getattr(cargs, f"path_{f}_dta")(path)
+            dread = DataProc(cargs)
+            bdat = dread.proc_bst_dta()
+            hdat = dread.proc_hiv_dta()
+            edat = dread.proc_epi_dta()
+            self.assertTrue(os.path.isdir(cargs.hiv_col))
+            cdat = dataproc.read_cols(cargs.hiv_col)
+            self.assertEqual(cdat.columns.tolist(), hdat.columns.tolist())
+            self.assertTrue(cdat.equals(hdat.reset_index(drop = True)))
+            cdat = dataproc.read_cols(cargs.epi_col, ["Age", "IIntID"])
+            self.assertEqual(cdat.columns.tolist(), ["Age", "IIntID"])
+            self.assertEqual(np.sum(cdat.Age), np.sum(edat.Age))
+            dtest = SetData(cargs)
+            # all columns are read, as from the .pkl datasets
+            pargs = copy.deepcopy(cargs)
+            pargs.update_file_format("pkl")
+            pread = DataProc(pargs)
+            pread.proc_bst_dta(); pread.proc_hiv_dta(); pread.proc_epi_dta()
+            for name in ["hiv_data", "epi_data"]:
+                pd.testing.assert_frame_equal(
+                    getattr(dtest, name).reset_index(drop = True),
+                    getattr(SetData(pargs), name).reset_index(drop = True))
+            self.assertEqual(SetData(cargs, columns = SetData.core_cols)
+                .hiv_data.columns.tolist(), SetData.core_cols["hiv"])
+            self.assertEqual(dtest.bst_data.PIPSA.tolist(), bdat.PIPSA.tolist())
+            dmeth = DataMethods(cargs)
+            dmeth.bst_data = bdat
+            self.assertEqual(len(dtest.epi_data), len(dmeth.set_data(edat)))
+
+    def test_chunks(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            cargs = SetArgs(root = tdir, verbose = False, file_format = "col")
+            for f in ["hiv", "epi", "bst"]:
+                path = getattr(self.targs, f"{f}_dta")
+                getattr(cargs, f"path_{f}_dta")(path)
+            dread = DataProc(cargs)
+            hdat = dread.proc_hiv_dta(chunksize = 6)
+            pd.testing.assert_frame_equal(hdat.copy(), 
+                self.hdat.reset_index(drop = True), check_categorical = False)
+            edat = dread.proc_epi_dta(addvars = ["ExpDays"], chunksize = 50)
+            self.assertEqual(edat.shape, (self.edat.shape[0], 9))
+            self.assertTrue(edat.iloc[:, :8].equals(
+                self.edat.reset_index(drop = True)))
+            cargs.update_file_format("pkl")
+            bdat = dread.proc_bst_dta(chunksize = 3, write_pkl = False)
+            pd.testing.assert_frame_equal(bdat, self.bdat, 
+                check_categorical = False)
+
+    def test_derived_cache(self):
+        targs = copy.deepcopy(self.targs)
+        targs.update_years(np.arange(2004, 2019))
+        targs.update_age({"Fem": [15, 54], "Mal": [15, 54]})
+        targs.update_drop_tasp(True)
+        with tempfile.TemporaryDirectory() as tdir:
+            targs.update_cache_dir(tdir)
+            dtest = SetData(targs)
+            self.assertEqual(len(dtest.repeat_tester_data), 2)
+            key = dtest.derived_key(SetData.data_fields)
+            self.assertEqual(os.listdir(os.path.join(tdir, key)),
+                ["repeat_tester_data.pkl"])
+            with mock.patch.object(SetData, "get_repeat_testers",
+                    side_effect = AssertionError):
+                dtest2 = SetData(targs)
+                self.assertTrue(dtest2.repeat_tester_data.equals(
+                    dtest.repeat_tester_data))
+            # assigned datasets are used instead of the cache, and drop
+            # the datasets computed from them
+            dtest3 = SetData(targs)
+            hiv = dtest3.hiv_data
+            rtid = dtest.repeat_tester_data.IIntID.iloc[0]
+            dtest3.hiv_data = hiv[hiv.IIntID == rtid]
+            self.assertEqual(dtest3.repeat_tester_data.IIntID.tolist(), 
+                    [rtid])
+            dtest3.bst_data = dtest3.bst_data
+            self.assertNotIn("hiv_data", dtest3._memo)
+            self.assertNotIn("repeat_tester_data", dtest3._memo)
+            self.assertEqual(len(dtest3.repeat_tester_data), 2)
+            # the repeat-testers do not depend on the age categories
+            targs.update_ageby(10)
+            self.assertEqual(dtest.derived_key(SetData.data_fields), key)
+            self.assertNotEqual(dtest.derived_key(), 
+                    dtest2.derived_key(SetData.data_fields))
+            targs.update_years(np.arange(2005, 2019))
+            self.assertNotEqual(dtest.derived_key(SetData.data_fields), key)
+            # each input file is hashed once
+            targs.update_cache_dir(tdir, hash_files = True)
+            with mock.patch.object(dataproc.hashlib, "sha256", 
+                    wraps = dataproc.hashlib.sha256) as sha:
+                for i in range(2):
+                    dtest = SetData(targs)
+                    dtest.repeat_tester_data
+                    dtest.derived_key()
+                    nhash = [c.args for c in sha.call_args_list].count(())
+                    self.assertEqual(nhash, 3 * (i + 1))
+
+    def test_lazy(self):
+        targs = copy.deepcopy(self.targs)
+        targs.update_years(np.arange(2004, 2019))
+        targs.update_age({"Fem": [15, 54], "Mal": [15, 54]})
+        targs.update_drop_tasp(True)
+        dtest = SetData(targs)
+        with mock.patch.object(SetData, "read_data", 
+                wraps = dtest.read_data) as read:
+            hiv = dtest.hiv_data
+            self.assertEqual([c.args[0] for c in read.call_args_list],
+                ["hiv", "bst"])
+            self.assertIs(dtest.hiv_data, hiv)
+            targs.update_age({"Fem": [15, 54]})
+            self.assertEqual(np.unique(dtest.hiv_data.Female).tolist(), [1])
+            self.assertEqual(read.call_count, 3)
+            # the datasets do not depend on the age categories
+            hiv, rtdat = dtest.hiv_data, dtest.repeat_tester_data
+            nread = read.call_count
+            targs.update_ageby(10)
+            self.assertIs(dtest.hiv_data, hiv)
+            self.assertIs(dtest.repeat_tester_data, rtdat)
+            self.assertEqual(read.call_count, nread)
+        # a new input path reads the dataset again
+        with tempfile.TemporaryDirectory() as tdir:
+            hdat = dtest.read_data("hiv")
+            hdat = hdat[hdat.IIntID == dtest.hiv_data.IIntID.iloc[0]]
+            hdat.to_pickle(os.path.join(tdir, "hiv.pkl"))
+            targs.path_hiv_pkl(os.path.join(tdir, "hiv.pkl"))
+            self.assertEqual(dtest.hiv_data.IIntID.nunique(), 1)
+
+    def test_birth_year(self):
+        targs = copy.deepcopy(self.targs)
+        dtest = SetData(targs)
+        byear = dtest.birth_year
+        self.assertTrue(byear.index.is_monotonic_increasing)
+        self.assertNotIn("BirthYear", dtest.hiv_data.columns)
+        self.assertNotIn("BirthYear", dtest.epi_data.columns)
+        ids = np.append(byear.index[::-1], -1)
+        res = dtest.lookup_birth_year(ids)
+        self.assertTrue(np.array_equal(res[:-1], byear.to_numpy()[::-1]))
+        self.assertTrue(np.isnan(res[-1]))
+        rtdat = dtest.get_repeat_testers(dtest.hiv_data)
+        bdat = dtest.get_birth_year()
+        adat = pd.merge(rtdat, bdat, on = "IIntID", how = "left")
+        adat["Age"] = adat["late_neg"].dt.year - adat["BirthYear"]
+        pd.testing.assert_frame_equal(
+            dtest.calc_age(rtdat, ref_time = "late_neg"), adat)
+
+    def test_std_mask(self):
+        targs = copy.deepcopy(self.targs)
+        targs.update_years(np.arange(2005, 2012))
+        targs.update_age({"Fem": [20, 40]})
+        table = dataproc.std_table(targs)
+        mask = dataproc.std_mask(table, [1, 1, 0, 1, np.nan, 1], 
+            [25, 41, 25, np.nan, 25, 25], [2005, 2005, 2005, 2011, 2005, 
+                np.nan])
+        self.assertEqual(mask.tolist(), 
+                [True, False, False, True, False, False])
+        targs.update_drop_tasp(False)
+        hdat = DataMethods(targs).set_data(self.hdat)
+        with tempfile.TemporaryDirectory() as tdir:
+            cargs = SetArgs(root = tdir, verbose = False, file_format = "col")
+            cargs.update_years(np.arange(2005, 2012))
+            cargs.update_age({"Fem": [20, 40]})
+            cargs.path_hiv_dta(targs.hiv_dta)
+            cdat = DataProc(cargs).proc_hiv_dta(chunksize = 6, 
+                    standardize = True)
+            self.assertEqual(cdat.IIntID.tolist(), hdat.IIntID.tolist())
+            self.assertEqual(cdat.Age.tolist(), hdat.Age.tolist())
+
+    def test_area(self):
+        targs = copy.deepcopy(self.targs)
+        dmeth = DataMethods(targs)
+        self.assertEqual(dmeth.tasp_bsid(self.bdat).tolist(), [616])
+        targs.update_area(["Rural"])
+        targs.update_drop_bsid([17843])
+        self.assertEqual(dmeth.area_bsid(self.bdat).tolist(), 
+            [616, 3455, 9305, 15588, 17843])
+        hdat = dmeth.drop_area(self.hdat, dmeth.area_bsid(self.bdat))
+        self.assertTrue(hdat.BSIntID.dropna().isin([6496, 16563]).all())
+        targs.update_drop_tasp(False)
+        targs.update_area(None)
+        dtest = SetData(targs)
+        self.assertEqual(dtest.excluded_bsid.tolist(), [17843])
+        self.assertNotIn(17843, dtest.hiv_data.BSIntID.dropna().tolist())
+
+    def test_schema(self):
+        dtypes = self.hdat.dtypes.astype(str).to_dict()
+        self.assertEqual(dtypes, {"IIntID": "int32", "BSIntID": "Int32",
+            "VisitDate": "Int32", "HIVResult": "category", "Female": "int8",
+            "Age": "int16", "HIVNegative": "Int32", "HIVPositive": "Int32",
+            "Year": "int16"})
+        self.assertEqual(str(self.edat.DoB.dtype), "Int32")
+        self.assertEqual(str(self.bdat.BSIntID.dtype), "Int32")
+        visit = dataproc.to_dates(self.hdat.VisitDate)
+        self.assertEqual(dataproc.to_days(visit).tolist(), 
+                self.hdat.VisitDate.tolist())
+        self.assertEqual(dataproc.date_year(self.hdat.VisitDate).tolist(),
+                self.hdat.Year.tolist())
+        targs = copy.deepcopy(self.targs)
+        dtest = SetData(targs)
+        self.assertTrue(dtest.hiv_data.dtypes.equals(self.hdat.dtypes))
+        dat = pd.DataFrame({"a": pd.array([1, None, 3], dtype = "Int32")})
+        with tempfile.TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, "dat")
+            dataproc.ColWriter(path).append(dat.iloc[:1].astype("int32")) \
+                .append(dat.iloc[1:]).close()
+            self.assertTrue(dataproc.read_cols(path).equals(dat))
+
+    def test_simdata(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            sargs = sim_args(tdir, n = 500, sim_seed = 4)
+            dmeth = DataMethods(sargs)
+            bdat = dmeth.read_data("bst")
+            hdat = dmeth.read_data("hiv")
+            edat = dmeth.read_data("epi")
+            self.assertEqual(len(np.unique(edat.IIntID)), 500)
+            self.assertTrue(np.isin(hdat.IIntID, edat.IIntID).all())
+            self.assertTrue(edat.BSIntID.isin(bdat.BSIntID).all())
+            self.assertTrue((edat.Year >= 2005).all())
+            self.assertTrue((edat.Year <= 2019).all())
+            rtdat = SetData(sargs).repeat_tester_data
+            self.assertTrue(rtdat.sero_event.sum() > 0)
+            sero = rtdat[rtdat.sero_event == 1]
+            self.assertTrue((sero.late_neg < sero.early_pos).all())
+
+    def test_profiler(self):
+        targs = copy.deepcopy(self.targs)
+        targs.update_profiler(Profiler())
+        dtest = SetData(targs)
+        rtdat = dtest.repeat_tester_data
+        stages = [r["stage"] for r in targs.profiler.records]
+        self.assertEqual(stages[:2], ["read", "set_data"])
+        self.assertIn("get_repeat_testers", stages)
+        self.assertEqual(stages[-1], "calc_age")
+        self.assertEqual(targs.profiler.records[-1]["rows_out"], len(rtdat))
+        rec = targs.profiler.records[1]
+        self.assertEqual(rec["rows_out"], len(dtest.hiv_data))
+        with tempfile.TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, "prof.json")
+            targs.profiler.dump(path)
+            with open(path) as f:
+                out = json.load(f)
+            self.assertEqual(len(out["records"]), len(stages))
+            self.assertEqual(out["summary"][0]["stage"], "read")
     
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from ahri.dataproc import date_origin
+from simhelp import sim_args
+from ahri.intcens import ReadUniReg, UniReg, UniRegRunner, unireg_path
+from ahri.intcens import IntCens, unireg_panel, write_unireg
+
+
+def write_unireg_input(path, n = 100, seed = 1):
+    """ Interval-censored test data in the UniReg input format """
+    rng = np.random.default_rng(seed)
+    age = rng.uniform(15, 50, n).round(1)
+    sero = rng.exponential(10, n) * np.exp(-0.02 * (age - 30))
+    rows = []
+    for i in range(n):
+        times = np.cumsum(rng.uniform(0.5, 1.5, rng.integers(1, 6)))
+        for t in times.round(3):
+            rows.append((i, t, int(t >= sero[i]), age[i]))
+    dat = pd.DataFrame(rows, columns = ["Subject_ID", "Examination_Time",
+        "Status", "Age"])
+    dat.to_csv(path, sep = " ", index = False)
+
+
+unireg_out = """Command issued:
+unireg --in in.txt --out out.txt --model "(Examination_Time, Status) = Age + Fem"
+
+Num Subjects: 200
+Log-Likelihood at the final estimates: -236.488
+###############################################################
+Estimation of the Regression Parameters:
+
+Covariate\tEstimate\tStd_Error\tZ-Stat\tP-value
+Age\t-0.0443\t0.0164\t-2.704\t0.0068
+Fem\t-0.2605\t0.2238\t-1.164\t0.2444
+
+Covariance Matrix for the Estimates:
+\t\tAge\tFem
+\tAge:\t0.00026\t-0.00031
+\tFem:\t-0.00031\t0.0501
+
+Estimation of the Cummulative Hazard Function:
+Time\tEstimate
+0.531\t5.3e-29
+0.551\t1.1e-22
+0.558\t7.3e-14
+"""
+
+
+class TestReadUniReg(unittest.TestCase):
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, "out.txt")
+            with open(path, "w") as f:
+                f.write(unireg_out)
+            res = ReadUniReg(path, sections = ["estimates"])
+            self.assertEqual(list(res._sections), ["estimates"])
+            est = res.estimates()
+            self.assertEqual(est.index.tolist(), ["Age", "Fem"])
+            self.assertEqual(est.columns.tolist(), ["Estimate", "Std_Error",
+                "Z-Stat", "P-value"])
+            self.assertEqual(est.loc["Fem", "Estimate"], -0.2605)
+            cov = res.covariance()
+            self.assertEqual(cov.columns.tolist(), ["Age", "Fem"])
+            self.assertEqual(cov.loc["Age", "Fem"], -0.00031)
+            haz = res.hazard()
+            self.assertEqual(haz.shape, (3, 2))
+            self.assertEqual(haz.Time.tolist(), [0.531, 0.551, 0.558])
+            self.assertRaises(ValueError, res.section, "variance")
+            with open(path, "w") as f:
+                f.write(unireg_out.split("Estimation of the Cumm")[0])
+            self.assertRaises(ValueError, ReadUniReg, path)
+
+    def test_not_run(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            mod = UniReg(os.path.join(tdir, "none"), tdir, "in.txt",
+                    "out.txt", "(Examination_Time, Status) = Age")
+            with self.assertRaisesRegex(RuntimeError, "run the UniReg"):
+                mod.estimates()
+            mod.run(check = False)
+            self.assertIsNotNone(mod.error)
+            with self.assertRaisesRegex(RuntimeError, "out.txt"):
+                mod.hazard()
+
+    def test_panel(self):
+        rtdat = pd.DataFrame({"IIntID": [1, 2, 3, 4],
+            "Female": [1, 0, 1, 0],
+            "obs_start": pd.to_datetime(["2001-01-01", "2002-01-01",
+                "2003-01-01", "2004-01-01"]),
+            "late_neg": pd.to_datetime(["2002-01-01", "2002-01-01",
+                "2004-01-01", "2005-01-01"]),
+            "early_pos": pd.to_datetime([None, "2003-01-01", None, None]),
+            "sero_event": [0, 1, 0, 0]})
+        dob = np.array([-3653, 0, np.nan, 366])
+        dat = unireg_panel(rtdat, dob, origin = 366)
+        self.assertEqual(dat.Subject_ID.tolist(), [1, 1, 2, 2, 4, 4])
+        self.assertEqual(dat.Status.tolist(), [0, 0, 0, 1, 0, 0])
+        self.assertEqual(dat.Examination_Time[0], 0)
+        self.assertTrue(np.allclose(dat.Age - dat.Examination_Time, 
+            [11.0, 11.0, 1.0, 1.0, 0, 0], atol = 0.01))
+        with tempfile.TemporaryDirectory() as tdir:
+            path = write_unireg(dat, os.path.join(tdir, "in.txt"), chunk = 4)
+            res = pd.read_csv(path, sep = " ")
+            self.assertEqual(res.columns.tolist(), dat.columns.tolist())
+            self.assertTrue(np.allclose(res.to_numpy(), dat.to_numpy(), 
+                atol = 1e-4))
+            with open(path) as f:
+                self.assertEqual(f.readlines()[1], "1 0.0000 0 11.0034 1\n")
+
+
+@unittest.skipUnless(sys.platform.startswith("linux") and
+        os.access(unireg_path, os.X_OK), "needs the bundled unireg")
+class TestUniReg(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.root = self.tdir.name
+        write_unireg_input(os.path.join(self.root, "in.txt"))
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_run(self):
+        mod = UniReg(unireg_path, self.root, "in.txt", "out.txt",
+                "(Examination_Time, Status) = Age",
+                subject_id = "Subject_ID").run()
+        self.assertEqual(mod.returncode, 0)
+        self.assertIsNone(mod.error)
+        self.assertEqual(mod.estimates().index.tolist(), ["Age"])
+        self.assertEqual(mod.covariance().shape, (1, 1))
+        self.assertTrue(np.all(np.diff(mod.hazard().Estimate) >= 0))
+        bad = UniReg(unireg_path, self.root, "none.txt", "bad.txt",
+                "(Examination_Time, Status) = Age", 
+                subject_id = "Subject_ID")
+        self.assertRaises(RuntimeError, bad.run)
+        # a rerun does not keep the error of the failed run
+        write_unireg_input(os.path.join(self.root, "none.txt"))
+        bad.run()
+        self.assertEqual(bad.returncode, 0)
+        self.assertIsNone(bad.error)
+
+    def test_relative_root(self):
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(self.root))
+        try:
+            mod = UniReg(unireg_path, os.path.basename(self.root), "in.txt",
+                    "out.txt", "(Examination_Time, Status) = Age",
+                    subject_id = "Subject_ID").run()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(mod.estimates().index.tolist(), ["Age"])
+
+    def test_runner(self):
+        runner = UniRegRunner(self.root, mcores = 2,
+                subject_id = "Subject_ID")
+        model = "(Examination_Time, Status) = Age"
+        mods = runner.run([
+            {"input": "in.txt", "output": "out1.txt", "model": model},
+            {"input": "none.txt", "output": "out2.txt", "model": model},
+            {"input": "in.txt", "output": "out3.txt", "model": model,
+                "r": 1.0}])
+        dat = runner.summary(mods)
+        self.assertEqual(dat.output.tolist(), ["out1.txt", "out2.txt",
+            "out3.txt"])
+        self.assertEqual(dat.returncode[0], 0)
+        self.assertNotEqual(dat.returncode[1], 0)
+        self.assertTrue(dat.error[1].startswith("ERROR"))
+        self.assertTrue(dat.error[[0, 2]].isna().all())
+        est = runner.estimates(mods)
+        self.assertEqual(est.output.tolist(), ["out1.txt", "out3.txt"])
+        self.assertNotEqual(est.Estimate[0], est.Estimate[1])
+        # a timeout is an error of the model, not of the batch
+        mods = UniRegRunner(self.root, timeout = 0.01,
+                subject_id = "Subject_ID").run([
+                    {"input": "in.txt", "output": "out4.txt", "model": model}])
+        self.assertIn("timed out", mods[0].error)
+        self.assertRaises(ValueError, runner.run, [
+            {"input": "in.txt", "output": "out1.txt", "model": model}] * 2)
+
+    def test_export(self):
+        sargs = sim_args(self.root, sim_seed = 6, seed = 4, drop_tasp = False)
+        dtest = IntCens(sargs)
+        rtdat = dtest.repeat_tester_data
+        # with no DoB, the birth day is the middle of the birth year
+        ids = rtdat.IIntID.to_numpy()[:2]
+        dob = dtest.get_birth_days(ids)
+        edat = dtest.epi_data.copy()
+        edat.loc[edat.IIntID == ids[0], "DoB"] = pd.NA
+        dtest.epi_data = edat
+        byear = dtest.lookup_birth_year(ids[:1])[0]
+        mid = (pd.Timestamp(f"{int(byear)}-01-01") - date_origin).days + 182
+        self.assertTrue(np.array_equal(dtest.get_birth_days(ids),
+            [mid, dob[1]]))
+        dat = dtest.unireg_data()
+        self.assertEqual(dat.Status.sum(), rtdat.sero_event.sum())
+        self.assertTrue((dat.Examination_Time >= 0).all())
+        self.assertTrue((dat.groupby("Subject_ID").Examination_Time
+            .diff().dropna() > 0).all())
+        mod = dtest.unireg(self.root).run()
+        self.assertEqual(mod.estimates().index.tolist(), ["Age", "Female"])
+
+if __name__ == '__main__':
+    unittest.main()